@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+from elasticsearch import Elasticsearch
+
+import tracdash
+from tracdash import benchmark
+
+
+def main():
+	tracdash.init_logging(console=True, file=True)
+
+	# ElasticSearch ip:port addresses
+	es_ips = ['127.0.0.1']
+	
+	# what to measure
+	command = sys.argv[1]
+	
+	if command == 'index':
+		# index names holding the same tweets, the first is the baseline
+		# (e.g. imported with index_profile 'default' and 'aggregation')
+		es = Elasticsearch(es_ips, timeout=(60*5))
+		benchmark.compare_indexes(es, sys.argv[2:], force_merge=True)
+	elif command == 'rt_filter':
+		# index with the tweet_kind field (imported with it, or added with rederive)
+		es = Elasticsearch(es_ips, timeout=(60*5))
+		benchmark.measure_rt_filters(es, sys.argv[2])
+	elif command == 'geo':
+		# NUTS level (1, 2 or 3) to look up random points in
+		level = int(sys.argv[2])
+		geo_helper = tracdash.init_geo(level)
+		benchmark.measure_geo_lookups(geo_helper, level)
+	elif command == 'tokeniser':
+		# jsonl.gz file of tweets to tokenise, and optionally Unicode's WordBreakTest.txt
+		# (https://www.unicode.org/Public/12.0.0/ucd/auxiliary/WordBreakTest.txt) to verify against
+		texts = benchmark.read_texts(sys.argv[2])
+		test_file = sys.argv[3] if len(sys.argv) > 3 else None
+		benchmark.verify_word_breaks(test_file, texts)
+		benchmark.measure_tokenise(texts)
+	elif command == 'properties':
+		# unicode property table lookups
+		benchmark.measure_property_lookups()
+	else:
+		print("unknown benchmark: {}".format(command))
+
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+import tracdash
+
+
+def main():
+	tracdash.init_logging(console=True, file=True)
+
+	# simplification tolerance in degrees (e.g. 0.0001 is about 10m), 0 keeps the boundaries as they are
+	simplify_tolerance = 0.0
+	if len(sys.argv) > 1:
+		simplify_tolerance = float(sys.argv[1])
+	
+	# lookup grid cell size in degrees, 0 for no grids
+	grid_resolution = tracdash.helpers.GRID_RESOLUTION
+	if len(sys.argv) > 2:
+		grid_resolution = float(sys.argv[2])
+	
+	# written next to the shape files, where init_geo looks for them
+	tracdash.build_geo_artefact(simplify_tolerance=simplify_tolerance)
+	if grid_resolution > 0:
+		tracdash.build_geo_grids(resolution=grid_resolution)
+
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+import tracdash
+
+
+def main():
+	tracdash.init_logging(console=False, file=True)
+
+	# ElasticSearch ip:port addresses
+	es_ips = ['127.0.0.1']
+	
+	# shared work queue (SQLite database on storage reachable by every host)
+	queue_path = sys.argv[1]
+	
+	# ElasticSearch index name to update
+	index_name = sys.argv[2]
+	
+	# optional file containing list of jsonl.gz files to add to the queue
+	# (hosts joining an existing queue can leave it out)
+	files = None
+	if len(sys.argv) > 3:
+		files = []
+		with open(sys.argv[3]) as f:
+			for line in f:
+				line = line.strip()
+				if line:
+					files.append(line)
+	
+	tracdash.import_queue(queue_path, es_ips, index_name, files=files)
+
+
+
+if __name__ == "__main__":
+	main()
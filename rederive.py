@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+import tracdash
+
+
+def main():
+	tracdash.init_logging(console=False, file=True)
+
+	# ElasticSearch ip:port addresses
+	es_ips = ['127.0.0.1']
+	
+	# ElasticSearch index name to update
+	index_name = sys.argv[1]
+	
+	# comma separated list of derived fields to recompute (e.g. types,bi_grams,websites)
+	fields = [field.strip() for field in sys.argv[2].split(',') if field.strip()]
+	
+	# optional file containing list of jsonl.gz files to re-derive from
+	# otherwise fields are re-derived from the stored fields in the index
+	files = None
+	if len(sys.argv) > 3:
+		files = []
+		with open(sys.argv[3]) as f:
+			for line in f:
+				line = line.strip()
+				if line:
+					files.append(line)
+	
+	tracdash.rederive_fields(es_ips, index_name, fields, files=files)
+
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,139 @@
+import asyncio, threading
+
+import pytest
+
+from tracdash import helpers
+from tracdash.bulk import AsyncBulkSender
+from tracdash.exceptions import BulkInsertException
+
+
+
+class _FakeClient:
+	"""Answers each bulk request once its event is set."""
+	def __init__(self):
+		self.requests = []
+	
+	async def bulk(self, index, body):
+		event = threading.Event()
+		self.requests.append(event)
+		while not event.is_set():
+			await asyncio.sleep(0.01)
+		return { 'errors': 'error' in body, 'items': body.splitlines()[::2] }
+	
+	async def close(self):
+		pass
+
+
+class _FakeSender(AsyncBulkSender):
+	async def _create_client(self, es_ips, timeout, es_options):
+		return _FakeClient()
+
+
+def _body(n):
+	return '{ "index" : {} }\n{}\n' * n
+
+
+def _wait(condition):
+	for i in range(500):
+		if condition():
+			return
+		threading.Event().wait(0.01)
+	raise AssertionError("timed out")
+
+
+def test_sent_counts_completed_requests():
+	sender = _FakeSender(['localhost'], 'test', max_in_flight=2)
+	try:
+		sender.submit(_body(3), "tweets.jsonl.gz", 1)
+		sender.submit(_body(5), "tweets.jsonl.gz", 2)
+		_wait(lambda: len(sender.es.requests) == 2)
+		assert sender.sent == 0
+		
+		# counted as each request completes, before the sender is flushed
+		sender.es.requests[1].set()
+		_wait(lambda: sender.sent == 5)
+		sender.es.requests[0].set()
+		assert sender.flush() == 8
+		assert sender.sent == 8
+	finally:
+		sender.close()
+
+
+def test_submit_blocks_while_max_in_flight():
+	sender = _FakeSender(['localhost'], 'test', max_in_flight=2)
+	try:
+		sender.submit(_body(1), "tweets.jsonl.gz", 1)
+		sender.submit(_body(1), "tweets.jsonl.gz", 2)
+		_wait(lambda: len(sender.es.requests) == 2)
+		
+		submitted = threading.Event()
+		def submit():
+			sender.submit(_body(1), "tweets.jsonl.gz", 3)
+			submitted.set()
+		thread = threading.Thread(target=submit)
+		thread.start()
+		assert not submitted.wait(0.2)
+		
+		# a completed request frees a slot
+		sender.es.requests[0].set()
+		assert submitted.wait(5)
+		thread.join()
+		_wait(lambda: len(sender.es.requests) == 3)
+		for request in sender.es.requests:
+			request.set()
+		assert sender.flush() == 3
+	finally:
+		sender.close()
+
+
+def test_failed_request(tmp_path, monkeypatch):
+	monkeypatch.setattr(helpers, 'logging_path', str(tmp_path))
+	sender = _FakeSender(['localhost'], 'test', max_in_flight=2)
+	try:
+		sender.submit('{ "index" : {} }\n{ "error" : 1 }\n', "tweets.jsonl.gz", 1)
+		sender.submit(_body(2), "tweets.jsonl.gz", 2)
+		_wait(lambda: len(sender.es.requests) == 2)
+		for request in sender.es.requests:
+			request.set()
+		
+		# raised by flush, after waiting for the other request
+		with pytest.raises(BulkInsertException):
+			sender.flush()
+		assert sender.sent == 2
+		assert sender.flush() == 0
+		
+		# and by the next submit, rather than sending more
+		sender.submit('{ "index" : {} }\n{ "error" : 1 }\n', "tweets.jsonl.gz", 3)
+		_wait(lambda: len(sender.es.requests) == 3)
+		sender.es.requests[2].set()
+		_wait(lambda: all(future.done() for future in sender.pending))
+		with pytest.raises(BulkInsertException):
+			sender.submit(_body(1), "tweets.jsonl.gz", 4)
+		assert len(sender.es.requests) == 3
+		
+		# discard waits for the request, ignoring the error
+		sender.discard()
+		assert sender.pending == []
+	finally:
+		sender.close()
+
+
+def test_cancel_drops_outstanding_requests():
+	sender = _FakeSender(['localhost'], 'test', max_in_flight=2)
+	try:
+		sender.submit(_body(1), "tweets.jsonl.gz", 1)
+		sender.submit(_body(1), "tweets.jsonl.gz", 2)
+		_wait(lambda: len(sender.es.requests) == 2)
+		
+		# without waiting for answers
+		sender.cancel()
+		assert sender.pending == []
+		assert sender.sent == 0
+		
+		# and the slots are free again
+		sender.submit(_body(4), "tweets.jsonl.gz", 3)
+		_wait(lambda: len(sender.es.requests) == 3)
+		sender.es.requests[2].set()
+		assert sender.flush() == 4
+	finally:
+		sender.close()
@@ -0,0 +1,56 @@
+from tracdash.cache import LRUCache
+
+
+
+def test_get_put():
+	cache = LRUCache(2)
+	assert cache.get('a') is None
+	assert cache.get('a', 0) == 0
+	cache.put('a', 1)
+	assert cache.get('a') == 1
+	cache.put('a', 2)
+	assert cache.get('a') == 2
+	assert len(cache) == 1
+
+
+def test_evicts_least_recently_used():
+	cache = LRUCache(2)
+	cache.put('a', 1)
+	cache.put('b', 2)
+	# a is now more recently used than b
+	cache.get('a')
+	cache.put('c', 3)
+	assert len(cache) == 2
+	assert cache.get('b') is None
+	assert cache.get('a') == 1
+	assert cache.get('c') == 3
+
+
+def test_put_refreshes():
+	cache = LRUCache(2)
+	cache.put('a', 1)
+	cache.put('b', 2)
+	cache.put('a', 3)
+	cache.put('c', 4)
+	assert cache.get('b') is None
+	assert cache.get('a') == 3
+
+
+def test_stats():
+	cache = LRUCache(10)
+	assert cache.hit_rate() == 0.0
+	cache.put('a', 1)
+	cache.get('a')
+	cache.get('a')
+	cache.get('b')
+	cache.get('c')
+	assert cache.hits == 2 and cache.misses == 2
+	assert cache.hit_rate() == 0.5
+	assert cache.stats() == "50.0% (2/4)"
+	
+	cache.reset_stats()
+	assert cache.hits == 0 and cache.misses == 0
+	assert cache.get('a') == 1
+	
+	cache.clear()
+	assert len(cache) == 0
@@ -0,0 +1,52 @@
+from tracdash.frequencies import FrequencyCounter, build_reference_types, load_frequencies, merge_frequency_tables
+
+
+
+DAY_1 = 1584007200000		# 2020-03-12 10:00 UTC
+DAY_2 = DAY_1 + 24 * 60 * 60 * 1000
+
+
+def _doc(tweet_id, timestamp, types, hashtags=[], websites=[], tweet_kind='original'):
+	return { 'tweet_id': tweet_id, 'timestamp': timestamp, 'types': types, 'hashtags': hashtags, 'websites': websites, 'tweet_kind': tweet_kind }
+
+
+def _count(directory, name, docs):
+	counter = FrequencyCounter()
+	for doc in docs:
+		counter.add(doc)
+	counter.write(directory, name)
+	return counter
+
+
+def test_frequency_tables(tmp_path):
+	directory = str(tmp_path)
+	counter = _count(directory, "a.jsonl.gz", [
+		_doc('1', DAY_1, ['stay', 'home'], ['covid19'], ['bbc.co.uk']),
+		# an original seen again, e.g. embedded in another retweet
+		_doc('1', DAY_1, ['stay', 'home'], ['covid19'], ['bbc.co.uk']),
+		_doc('2', DAY_2, ['home'], tweet_kind='rt')
+	])
+	assert counter.docs == 2
+	_count(directory, "b.jsonl.gz", [ _doc('3', DAY_1, ['home', 'nhs']) ])
+	merge_frequency_tables(directory)
+	
+	assert load_frequencies(directory, 'types') == { 'home': 3, 'stay': 1, 'nhs': 1 }
+	assert load_frequencies(directory, 'types', start_date='2020-03-12', end_date='2020-03-12') == { 'home': 2, 'stay': 1, 'nhs': 1 }
+	assert load_frequencies(directory, 'kinds', start_date='2020-03-13') == { 'rt': 1 }
+	assert load_frequencies(directory, 'hashtags') == { 'covid19': 1 }
+	
+	# a re-imported file replaces its partial table rather than being counted twice
+	_count(directory, "b.jsonl.gz", [ _doc('3', DAY_1, ['home', 'nhs']) ])
+	merge_frequency_tables(directory)
+	assert load_frequencies(directory, 'types') == { 'home': 3, 'stay': 1, 'nhs': 1 }
+
+
+def test_build_reference_types(tmp_path):
+	directory = str(tmp_path)
+	_count(directory, "a.jsonl.gz", [ _doc(str(i), DAY_1, ['home'] + (['nhs'] if i < 2 else [])) for i in range(4) ])
+	merge_frequency_tables(directory)
+	
+	output_file = str(tmp_path / "reference.txt")
+	assert build_reference_types(directory, output_file, min_proportion=0.5) == 4
+	with open(output_file) as f:
+		assert f.read() == "1.0\thome\n0.5\tnhs\n"
@@ -0,0 +1,83 @@
+import random
+from types import SimpleNamespace
+
+import pandas as pd
+
+from tracdash.gazetteer import Automaton, Gazetteer, normalise
+
+
+
+def _search(patterns, text):
+	automaton = Automaton()
+	for pattern in patterns:
+		automaton.add(pattern, pattern)
+	automaton.build()
+	return sorted(automaton.search(text))
+
+
+def test_automaton_overlapping():
+	assert _search(['he', 'she', 'his', 'hers'], 'ushers') == [(4, 'he'), (4, 'she'), (6, 'hers')]
+
+
+def test_automaton_against_find():
+	rand = random.Random(1)
+	for i in range(200):
+		patterns = { ''.join(rand.choice('ab') for j in range(rand.randint(1, 4))) for k in range(5) }
+		text = ''.join(rand.choice('ab') for j in range(30))
+		expected = sorted(
+			(start + len(pattern), pattern)
+			for pattern in patterns
+			for start in range(len(text))
+			if text.startswith(pattern, start)
+		)
+		assert _search(patterns, text) == expected
+
+
+def test_normalise():
+	assert normalise("Stockton-on-Tees!") == ' stockton on tees '
+	assert normalise("  Ynys Môn ") == ' ynys mon '
+
+
+def _gazetteer():
+	geo_helper = SimpleNamespace(
+		gdf_level_1=pd.DataFrame({
+			'CODE': ['UKI', 'UKL', 'UKM', 'UKN', 'UKK'],
+			'NAME': ['London', 'Wales', 'Scotland', 'Northern Ireland', 'South West (England)']
+		}),
+		gdf_level_2=pd.DataFrame({'CODE': ['UKM7', 'UKD3'], 'NAME': ['Eastern Scotland', 'Greater Manchester']}),
+		gdf_level_3=pd.DataFrame({'CODE': ['UKM77', 'UKD33'], 'NAME': ['Perth and Kinross, and Stirling', 'Manchester']}))
+	return Gazetteer(geo_helper)
+
+
+def _code(match):
+	if match is None:
+		return None
+	level, regions = match
+	return regions[level - 1][0]
+
+
+def test_gazetteer_match():
+	gazetteer = _gazetteer()
+	assert _code(gazetteer.match("Manchester")) == 'UKD33'
+	assert _code(gazetteer.match("London, UK")) == 'UKI'
+	assert _code(gazetteer.match("Belfast, Northern Ireland")) == 'UKN'
+	assert gazetteer.match("Manchester")[1][1] == ('UKD3', 'Greater Manchester')
+	assert gazetteer.match("somewhere") is None
+
+
+def test_gazetteer_places_outside_uk():
+	gazetteer = _gazetteer()
+	for location in ["New South Wales", "London, Ontario", "Perth, WA", "Manchester, New Hampshire",
+			# every name ruled out, with a UK signal left
+			"London, Ontario, UK", "Manchester, New Hampshire via UK", "Wales, New South Wales", "Perth, Australia | England"]:
+		assert gazetteer.match(location) is None, location
+	# only a place after the name rules it out
+	assert _code(gazetteer.match("NYC / London")) == 'UKI'
+
+
+def test_gazetteer_ambiguous_names():
+	gazetteer = _gazetteer()
+	assert gazetteer.match("Perth") is None
+	assert gazetteer.match("South West") is None
+	assert _code(gazetteer.match("Perth, Scotland")) == 'UKM77'
+	assert _code(gazetteer.match("South West, UK")) == 'UKK'
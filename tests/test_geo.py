@@ -0,0 +1,110 @@
+import random
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import Polygon, box
+
+from tracdash import geo
+
+
+
+CRS = "EPSG:4326"
+
+
+def _gdf():
+	# overlapping regions (the first row wins), a hole, and edges off the grid lines
+	return gpd.GeoDataFrame({
+			'CODE': ['UKA', 'UKB', 'UKC', 'UKD'],
+			'NAME': ['A', 'B', 'C', 'D']
+		},
+		geometry=[
+			box(0.0, 0.0, 1.0, 1.0),
+			Polygon([(0.5, 0.5), (2.03, 0.5), (1.27, 1.91)]),
+			Polygon([(2.0, 0.0), (3.0, 0.0), (3.0, 1.0), (2.0, 1.0)], [[(2.25, 0.25), (2.75, 0.25), (2.75, 0.75), (2.25, 0.75)]]),
+			box(0.1, 1.5, 0.9, 2.0)
+		],
+		crs=CRS)
+
+
+def _points(n, seed=1):
+	rand = random.Random(seed)
+	points = [ (rand.uniform(-0.5, 3.5), rand.uniform(-0.5, 2.5)) for i in range(n) ]
+	# and some on cell and region edges
+	points += [ (x / 10.0, y / 10.0) for x in range(-2, 33) for y in range(-2, 23, 3) ]
+	return points
+
+
+def _grid_index(gdf, resolution=0.1):
+	index = geo.GeoIndex(gdf)
+	index.grid = geo.GeoGrid.build(index, gdf.total_bounds, resolution)
+	return index
+
+
+def test_index_search_matches_search_geo():
+	gdf = _gdf()
+	index = geo.GeoIndex(gdf)
+	for lng, lat in _points(2000):
+		assert index.search(lng, lat) == geo.GeoHelper.search_geo(gdf, lng, lat, CRS), (lng, lat)
+
+
+def test_index_search_batch_matches_search():
+	gdf = _gdf()
+	index = geo.GeoIndex(gdf)
+	points = _points(1000, seed=3)
+	lngs = [lng for lng, lat in points]
+	lats = [lat for lng, lat in points]
+	assert index.search_batch(gdf, lngs, lats) == [ index.search(lng, lat) for lng, lat in points ]
+
+
+def test_index_skips_missing_geometries():
+	gdf = _gdf()
+	gdf.loc[0, 'geometry'] = None
+	index = geo.GeoIndex(gdf)
+	assert index.rows == [1, 2, 3]
+	# the overlap goes to the next row
+	assert index.search(0.75, 0.6) == ('UKB', 'B')
+	assert index.search(0.2, 0.2) == (None, None)
+	
+	helper = geo.GeoHelper(CRS, gdf_1=gdf)
+	assert helper.search_nuts_1(0.2, 1.8) == ('UKD', 'D')
+	assert helper.search_nuts_2(0.2, 1.8) == (None, None)
+	assert helper.search_nuts_batch(2, [0.2], [1.8]) == [(None, None)]
+
+
+def test_grid_search_matches_search_geo():
+	gdf = _gdf()
+	index = _grid_index(gdf)
+	stats = index.grid.stats()
+	assert stats['inside'] > 0 and stats['boundary'] > 0
+	for lng, lat in _points(2000):
+		assert index.search(lng, lat) == geo.GeoHelper.search_geo(gdf, lng, lat, CRS), (lng, lat)
+
+
+def test_grid_search_batch_matches_search():
+	gdf = _gdf()
+	index = _grid_index(gdf)
+	exact = geo.GeoIndex(gdf)
+	points = _points(1000, seed=2)
+	lngs = [lng for lng, lat in points]
+	lats = [lat for lng, lat in points]
+	assert index.search_batch(gdf, lngs, lats) == [ exact.search(lng, lat) for lng, lat in points ]
+
+
+def test_grid_save_load(tmp_path):
+	gdf = _gdf()
+	index = _grid_index(gdf)
+	path = str(tmp_path / "grid")
+	index.grid.save(path, index.digest(index.grid.resolution))
+	
+	loaded = geo.GeoGrid.load(path, geo.GeoIndex(gdf))
+	assert (loaded.cells == index.grid.cells).all()
+	
+	with pytest.raises(ValueError):
+		geo.GeoGrid.load(path, geo.GeoIndex(gdf), resolution=0.05)
+	
+	# same bounds, different geometry
+	other = _gdf()
+	other.loc[1, 'geometry'] = Polygon([(0.5, 0.5), (2.03, 0.5), (1.27, 1.91), (1.0, 1.2)])
+	assert tuple(other.total_bounds) == tuple(gdf.total_bounds)
+	with pytest.raises(ValueError):
+		geo.GeoGrid.load(path, geo.GeoIndex(other))
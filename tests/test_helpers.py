@@ -0,0 +1,69 @@
+import os, random, logging
+
+import geopandas as gpd
+from shapely.geometry import Polygon, box
+
+from tracdash import helpers
+
+
+
+def test_tweet_kind():
+	assert helpers.tweet_kind(False, False, False) == 'original'
+	assert helpers.tweet_kind(True, False, False) == 'rt'
+	assert helpers.tweet_kind(False, True, True) == 'qt+re'
+	assert helpers.tweet_kind(True, True, True) == 'rt+qt+re'
+
+
+def test_tweet_kinds():
+	assert helpers.tweet_kinds() == ['original']
+	assert sorted(helpers.tweet_kinds(include_rt=True)) == sorted(['original', 'rt', 'rt+qt', 'rt+re', 'rt+qt+re'])
+	assert len(helpers.tweet_kinds(True, True, True)) == 8
+
+
+def test_tweet_kinds_match_flags():
+	# a kind is kept if the tweet has none of the flags, or any included one
+	for include in [(False, False, True), (True, False, True), (False, True, False)]:
+		kinds = helpers.tweet_kinds(*include)
+		for flags in [(a, b, c) for a in [False, True] for b in [False, True] for c in [False, True]]:
+			kept = not any(flags) or any(f and i for f, i in zip(flags, include))
+			assert (helpers.tweet_kind(*flags) in kinds) == kept
+
+
+def _write_nuts_shp(shp_path):
+	# each level splits the regions of the one above, with an overlap and a hole
+	geometries = {
+		1: [box(0.0, 0.0, 2.0, 2.0), box(2.0, 0.0, 4.0, 2.0)],
+		2: [box(0.0, 0.0, 1.0, 2.0), Polygon([(0.8, 0.0), (2.0, 0.0), (2.0, 2.0)]), box(2.0, 0.0, 4.0, 2.0)],
+		3: [box(0.0, 0.0, 1.0, 1.0), box(0.0, 1.0, 1.0, 2.0), Polygon([(0.8, 0.0), (2.0, 0.0), (2.0, 2.0)]),
+			Polygon([(2.0, 0.0), (4.0, 0.0), (4.0, 2.0), (2.0, 2.0)], [[(2.5, 0.5), (3.5, 0.5), (3.5, 1.5), (2.5, 1.5)]])]
+	}
+	for level, shp_file in [(1, helpers.NUTS_1_SHP_FILE), (2, helpers.NUTS_2_SHP_FILE), (3, helpers.NUTS_3_SHP_FILE)]:
+		code, name = helpers.NUTS_COLUMNS[level]
+		n = len(geometries[level])
+		gpd.GeoDataFrame({
+				code: [ "UK{}{}".format(level, i) for i in range(n) ],
+				name: [ "Region {}.{}".format(level, i) for i in range(n) ]
+			},
+			geometry=geometries[level],
+			crs="EPSG:4326").to_file(os.path.join(shp_path, shp_file))
+
+
+def _searches(geohelper, points):
+	return [ (geohelper.search_nuts_1(lng, lat), geohelper.search_nuts_2(lng, lat), geohelper.search_nuts_3(lng, lat)) for lng, lat in points ]
+
+
+def test_geo_artefact_round_trip(tmp_path, caplog):
+	shp_path = str(tmp_path)
+	_write_nuts_shp(shp_path)
+	rand = random.Random(1)
+	points = [ (rand.uniform(-0.5, 4.5), rand.uniform(-0.5, 2.5)) for i in range(500) ]
+	
+	from_shp = helpers.init_geo(3, shp_path=shp_path, grid_path=False)
+	artefact = helpers.build_geo_artefact(shp_path=shp_path)
+	caplog.set_level(logging.INFO)
+	from_artefact = helpers.init_geo(3, shp_path=shp_path, artefact=artefact, grid_path=False)
+	assert "Loaded NUTS Level 3 from artefact" in caplog.text
+	
+	assert from_artefact.gdf_level_3['CODE'].tolist() == ["UK30", "UK31", "UK32", "UK33"]
+	assert _searches(from_artefact, points) == _searches(from_shp, points)
+	assert len(set(_searches(from_shp, points))) > 5
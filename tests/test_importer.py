@@ -0,0 +1,388 @@
+import gzip, json, threading, time
+from types import SimpleNamespace
+
+import pytest
+
+from tracdash import importer, helpers
+from tracdash.cache import LRUCache
+from tracdash.exceptions import IndexCreationException
+
+
+
+def test_in_sample_without_id():
+	assert not importer.in_sample(None, 10)
+
+
+def test_in_sample_every_tweet():
+	assert all(importer.in_sample(str(i), 1) for i in range(1000))
+
+
+def test_in_sample_proportion():
+	ids = [str(1200000000000000000 + i) for i in range(100000)]
+	for modulo in [10, 100]:
+		kept = sum(importer.in_sample(tweet_id, modulo) for tweet_id in ids)
+		assert abs(kept - len(ids) / modulo) < 0.1 * len(ids) / modulo
+
+
+def test_in_sample_nested():
+	# the same hash for every modulo, so smaller samples are subsets of larger ones
+	ids = [str(i) for i in range(100000)]
+	small = { tweet_id for tweet_id in ids if importer.in_sample(tweet_id, 1000) }
+	large = { tweet_id for tweet_id in ids if importer.in_sample(tweet_id, 100) }
+	assert small and small <= large
+
+
+def _nested_fields(properties):
+	return [ field for field, mapping in properties.items() if mapping.get('type') == 'nested' ]
+
+
+def test_index_profiles_no_sort_with_nested_fields():
+	# ElasticSearch refuses to create an index with both
+	for name, definition in importer.INDEX_PROFILES.items():
+		if _nested_fields(definition['mappings']['properties']):
+			settings = definition.get('settings', {}).get('index', {})
+			assert 'sort.field' not in settings and 'sort' not in settings, name
+
+
+def test_client_balances_nodes(monkeypatch):
+	monkeypatch.setattr(importer, '_es_ips', ['es1', 'es2', 'es3'])
+	es = importer._create_client()
+	pool = es.transport.connection_pool
+	assert len(pool.connections) == 3
+	assert type(pool.selector).__name__ == 'RoundRobinSelector'
+	
+	# sniffing (on start, so not here) finds the rest of the cluster
+	assert 'sniff_on_start' not in importer._es_options()
+	monkeypatch.setattr(importer, '_es_sniff', True)
+	assert importer._es_options()['sniff_on_connection_fail']
+
+
+def test_worker_client_reused(tmp_path, monkeypatch):
+	clients = []
+	def create_client():
+		clients.append(object())
+		return clients[-1]
+	monkeypatch.setattr(importer, '_create_client', create_client)
+	monkeypatch.setattr(importer, '_bulk_in_flight', 1)
+	for name in ['_es', '_sender', '_progress']:
+		monkeypatch.setattr(importer, name, None)
+	
+	# one per worker, for all the files it imports
+	importer._init_worker()
+	path = _skipped_lines_file(tmp_path)
+	assert importer._import_file(path) == "+ " + path
+	assert importer._import_file(path) == "+ " + path
+	assert len(clients) == 1 and importer._es is clients[0]
+
+
+class _FakeIndices:
+	def __init__(self, res):
+		self.res = res
+		self.put = []
+	
+	def create(self, index, body, ignore):
+		return self.res
+	
+	def get_field_mapping(self, index, fields):
+		return { index: { 'mappings': { field: {} for field in fields.split(',') if field != 'tweet_kind' } } }
+	
+	def put_mapping(self, index, body):
+		self.put.append(body)
+
+
+def _create_index(monkeypatch, res):
+	indices = _FakeIndices(res)
+	monkeypatch.setattr(importer, '_create_client', lambda: SimpleNamespace(indices=indices))
+	monkeypatch.setattr(importer, '_index_name', 'test')
+	importer._create_index()
+	return indices
+
+
+def test_create_index(monkeypatch):
+	assert _create_index(monkeypatch, { 'acknowledged': True }).put == []
+	
+	# an existing index gets the fields added since it was created
+	indices = _create_index(monkeypatch, { 'error': { 'type': 'resource_already_exists_exception' }, 'status': 400 })
+	assert indices.put == [{ 'properties': { 'tweet_kind': importer.INDEX_DEFINITION['mappings']['properties']['tweet_kind'] } }]
+	
+	with pytest.raises(IndexCreationException):
+		_create_index(monkeypatch, { 'error': { 'type': 'illegal_argument_exception' }, 'status': 400 })
+
+
+class _FakeSender:
+	def __init__(self):
+		self.calls = []
+		self.sent = 0
+	
+	def flush(self):
+		self.calls.append('flush')
+		return 0
+	
+	def discard(self):
+		self.calls.append('discard')
+	
+	def cancel(self):
+		self.calls.append('cancel')
+
+
+def _skipped_lines_file(tmp_path, n=10):
+	path = str(tmp_path / "tweets.jsonl.gz")
+	with gzip.open(path, 'wt') as f:
+		for i in range(n):
+			f.write('{"info": {"activity_count": 1}}\n')
+	return path
+
+
+def test_import_file_cancelled(tmp_path, monkeypatch):
+	path = _skipped_lines_file(tmp_path)
+	sender = _FakeSender()
+	cancel = threading.Event()
+	monkeypatch.setattr(importer, '_es', object())
+	monkeypatch.setattr(importer, '_sender', sender)
+	monkeypatch.setattr(importer, '_cancel_file', cancel)
+	
+	assert importer._import_file(path) == "+ " + path
+	assert sender.calls == ['flush']
+	
+	# the file's bulks still in flight are dropped, not waited for
+	cancel.set()
+	sender.calls.clear()
+	assert importer._import_file(path) == "! " + path
+	assert sender.calls == ['cancel']
+
+
+def test_process_batch_aborted(monkeypatch):
+	abort = threading.Event()
+	abort.set()
+	monkeypatch.setattr(importer, '_batch_abort', abort)
+	# skipped without being parsed
+	assert importer._process_batch(("tweets.jsonl.gz", 3, [(0, b'not json')])) == (3, 0, 0, [], [], {})
+
+
+def _tweet(i):
+	tweet = {
+		'id_str': str(1000000 + i),
+		'created_at': "Thu Mar 12 10:00:00 +0000 2020",
+		'lang': 'en',
+		'truncated': False,
+		'text': "stay home #covid19 @someone number {}".format(i),
+		'user': { 'screen_name': "user{}".format(i % 3), 'description': "", 'verified': False, 'location': "London",
+			'followers_count': i, 'friends_count': 1, 'listed_count': 0, 'favourites_count': 2, 'statuses_count': 3,
+			'created_at': "Wed Oct 10 20:19:24 +0000 2018" },
+		'entities': { 'hashtags': [{ 'text': "covid19" }], 'user_mentions': [{ 'screen_name': "someone" }], 'symbols': [], 'urls': [] },
+		'retweet_count': 0,
+		'favorite_count': 0,
+		'source': "<a href=\"x\">Twitter</a>"
+	}
+	if i % 2 == 0:
+		tweet['retweeted_status'] = _tweet(i + 500001)
+	return tweet
+
+
+def _tweets_file(tmp_path, n):
+	path = str(tmp_path / "tweets.jsonl.gz")
+	with gzip.open(path, 'wt') as f:
+		for i in range(n):
+			f.write(json.dumps(_tweet(i)) + "\n")
+		f.write('{"info": {"activity_count": ' + str(n) + '}}\n')
+	return path
+
+
+def _collect_bulks(monkeypatch):
+	docs = {}
+	def insert_bulk(es, body, file, n, sender=None):
+		lines = body.splitlines()
+		for action, doc in zip(lines[::2], lines[1::2]):
+			docs[json.loads(action)['index']['_id']] = json.loads(doc)
+		return len(lines) // 2
+	monkeypatch.setattr(importer, '_insert_bulk', insert_bulk)
+	return docs
+
+
+def test_import_file_batched_matches_per_line(tmp_path, monkeypatch):
+	helpers.init_tokeniser()
+	path = _tweets_file(tmp_path, 25)
+	monkeypatch.setattr(importer, '_geo_helper', helpers.init_geo(0))
+	monkeypatch.setattr(importer, '_es', object())
+	monkeypatch.setattr(importer, '_sender', None)
+	
+	docs = _collect_bulks(monkeypatch)
+	assert importer._import_file(path) == "+ " + path
+	assert docs
+	
+	# the batches processed in this process, in file order
+	monkeypatch.setattr(importer, '_create_client', lambda: object())
+	monkeypatch.setattr(importer, '_batch_lines', 4)
+	monkeypatch.setattr(importer, '_batch_ordered', True)
+	monkeypatch.setattr(importer, '_pool_size', 1)
+	pool = SimpleNamespace(imap=map, imap_unordered=map)
+	batched = _collect_bulks(monkeypatch)
+	assert importer._import_file_batched(pool, path) == "+ " + path
+	assert batched == docs
+
+
+class _FakeTuneClient:
+	def __init__(self, bulk_delay=0.0):
+		self.bulk_delay = bulk_delay
+		self.indices = SimpleNamespace(create=self.create, delete=self.delete)
+		self.created = []
+		self.deleted = []
+		self.bulk_indices = set()
+	
+	def create(self, index, body, ignore):
+		self.created.append(index)
+	
+	def delete(self, index, ignore):
+		self.deleted.append(index)
+	
+	def bulk(self, index, body):
+		self.bulk_indices.add(index)
+		time.sleep(self.bulk_delay)
+		return { 'errors': False, 'items': body.splitlines()[::2] }
+
+
+def _auto_tune(tmp_path, monkeypatch, files, rates, bulk_delay=0.0):
+	helpers.init_tokeniser()
+	path = _tweets_file(tmp_path, 25)
+	es = _FakeTuneClient(bulk_delay)
+	monkeypatch.setattr(importer, '_geo_helper', helpers.init_geo(0))
+	monkeypatch.setattr(importer, '_create_client', lambda: es)
+	monkeypatch.setattr(importer, '_index_name', 'test')
+	monkeypatch.setattr(importer, '_es_ips', ['localhost'])
+	monkeypatch.setattr(importer.multiprocessing, 'cpu_count', lambda: 16)
+	monkeypatch.setattr(importer, '_auto_tune_pool_rate', lambda size: rates[size])
+	return importer._auto_tune([path] * files), es
+
+
+def test_auto_tune_pool_size(tmp_path, monkeypatch):
+	# doubled while that gains at least AUTO_TUNE_POOL_GAIN
+	(pool_size, bulk_in_flight), es = _auto_tune(tmp_path, monkeypatch, 8, { 1: 100, 2: 190, 4: 300, 8: 320 })
+	assert pool_size == 4
+	
+	# the calibration bulk goes to a scratch index, deleted after
+	assert es.bulk_indices == { 'test' + importer.AUTO_TUNE_INDEX_SUFFIX }
+	assert es.created == es.deleted == [ 'test' + importer.AUTO_TUNE_INDEX_SUFFIX ]
+	
+	# no more workers than files
+	(pool_size, bulk_in_flight), es = _auto_tune(tmp_path, monkeypatch, 2, { 1: 100, 2: 190, 4: 300, 8: 320 })
+	assert pool_size == 2
+
+
+def test_auto_tune_slow_bulks(tmp_path, monkeypatch):
+	# bulks far slower than the transform: more in flight, up to AUTO_TUNE_BULKS_PER_NODE, rather than more workers
+	(pool_size, bulk_in_flight), es = _auto_tune(tmp_path, monkeypatch, 8, { 1: 100, 2: 200, 4: 400, 8: 800 }, bulk_delay=1.0)
+	assert pool_size == 1
+	assert bulk_in_flight == importer.AUTO_TUNE_BULKS_PER_NODE
+
+
+def test_auto_tune_without_docs(tmp_path, monkeypatch):
+	path = _skipped_lines_file(tmp_path)
+	monkeypatch.setattr(importer, '_pool_size', 3)
+	monkeypatch.setattr(importer, '_bulk_in_flight', 2)
+	assert importer._auto_tune([path]) == (3, 2)
+
+
+def test_cached_text_types(monkeypatch):
+	helpers.init_tokeniser()
+	text = "RT Stay home #covid19 #StayHome @someone https://t.co/abc café"
+	monkeypatch.setattr(importer, '_text_cache', None)
+	uncached = importer._cached_text_types(text, {'covid19'})
+	other_hashtags = importer._cached_text_types(text, {'stayhome'})
+	
+	cache = LRUCache(10)
+	monkeypatch.setattr(importer, '_text_cache', cache)
+	assert importer._cached_text_types(text, {'covid19'}) == uncached
+	# the same text with other hashtags (e.g. another retweet of it) hits, filtered for its own hashtags
+	assert importer._cached_text_types(text, {'stayhome'}) == other_hashtags
+	assert (cache.hits, cache.misses) == (1, 1)
+	assert other_hashtags != uncached
+
+
+def test_cached_profile_types(monkeypatch):
+	helpers.init_tokeniser()
+	bio = "I love the NHS and café culture #life https://t.co/abc"
+	monkeypatch.setattr(importer, '_profile_cache', None)
+	uncached = importer._cached_profile_types("user1", bio)
+	changed = importer._cached_profile_types("user1", bio + " and dogs")
+	
+	cache = LRUCache(10)
+	monkeypatch.setattr(importer, '_profile_cache', cache)
+	assert importer._cached_profile_types("user1", bio) == uncached
+	assert importer._cached_profile_types("user1", bio) == uncached
+	assert (cache.hits, cache.misses) == (1, 1)
+	
+	# a changed bio, or another user, is a miss
+	assert importer._cached_profile_types("user1", bio + " and dogs") == changed
+	assert importer._cached_profile_types("user2", bio) == uncached
+	assert (cache.hits, cache.misses) == (1, 3)
+
+
+class _FakeGeoHelper:
+	"""Regions by the integer part of the longitude, recording each lookup."""
+	def __init__(self):
+		self.lookups = []
+	
+	def _search(self, level, lng, lat):
+		self.lookups.append((level, lng, lat))
+		return ("UK{}{}".format(level, int(lng)), "region")
+	
+	def search_nuts_1(self, lng, lat):
+		return self._search(1, lng, lat)
+	
+	def search_nuts_2(self, lng, lat):
+		return self._search(2, lng, lat)
+	
+	def search_nuts_3(self, lng, lat):
+		return self._search(3, lng, lat)
+	
+	def search_nuts_batch(self, level, lngs, lats):
+		return [ self._search(level, lng, lat) for lng, lat in zip(lngs, lats) ]
+
+
+def _geo_cache(monkeypatch, precision):
+	geohelper = _FakeGeoHelper()
+	cache = LRUCache(100)
+	monkeypatch.setattr(importer, '_geo_helper', geohelper)
+	monkeypatch.setattr(importer, '_geo_search_level', 3)
+	monkeypatch.setattr(importer, '_geo_cache', cache)
+	monkeypatch.setattr(importer, '_geo_cache_precision', precision)
+	return geohelper, cache
+
+
+def test_geo_cache_place_key(monkeypatch):
+	geohelper, cache = _geo_cache(monkeypatch, 2)
+	
+	# a place is keyed by its id and the level searched, not its (unrounded) centre
+	key, lng, lat = importer._nuts_key(1.23456, 51.5, 3, place_id='abc')
+	assert key == ('place', 'abc', 3) and (lng, lat) == (1.23456, 51.5)
+	regions = importer._cached_nuts_regions(1.23456, 51.5, 3, place_id='abc')
+	assert importer._cached_nuts_regions(1.23456, 51.5, 3, place_id='abc') == regions
+	assert len(geohelper.lookups) == 3 and (cache.hits, cache.misses) == (1, 1)
+	
+	# another place at the same point, or the same place searched to another level, is looked up again
+	importer._cached_nuts_regions(1.23456, 51.5, 3, place_id='def')
+	assert importer._cached_nuts_regions(1.23456, 51.5, 1, place_id='abc') == ('UK11', 'region', None, None, None, None)
+	assert cache.misses == 3
+
+
+def test_geo_cache_point_key(monkeypatch):
+	geohelper, cache = _geo_cache(monkeypatch, 1)
+	
+	# points are keyed (and looked up) rounded to the precision, so nearby points share an entry
+	assert importer._nuts_key(1.96, 51.52, 3) == ((2.0, 51.5, 3), 2.0, 51.5)
+	regions = importer._cached_nuts_regions(1.96, 51.52, 3)
+	assert regions[0] == 'UK12'
+	assert importer._cached_nuts_regions(2.04, 51.48, 3) == regions
+	assert geohelper.lookups == [(1, 2.0, 51.5), (2, 2.0, 51.5), (3, 2.0, 51.5)]
+	
+	# batched, each distinct key is looked up once, and cached
+	docs = [ {} for i in range(4) ]
+	pending = [(docs[0], 5.01, 50.0, 3, None), (docs[1], 4.99, 50.0, 3, None), (docs[2], 2.01, 51.5, 3, None), (docs[3], 7.0, 50.0, 1, 'abc')]
+	monkeypatch.setattr(importer, '_geo_pending', pending)
+	geohelper.lookups.clear()
+	importer._assign_nuts_regions()
+	assert pending == []
+	assert [ doc['geo_nuts1_code'] for doc in docs ] == ['UK15', 'UK15', 'UK12', 'UK17']
+	assert docs[3]['geo_nuts2_code'] is None
+	assert sorted(geohelper.lookups) == [(1, 5.0, 50.0), (1, 7.0, 50.0), (2, 5.0, 50.0), (3, 5.0, 50.0)]
+	assert importer._geo_cache.get(('place', 'abc', 1)) == ('UK17', 'region', None, None, None, None)
@@ -0,0 +1,58 @@
+import os, gzip, pstats
+
+from tracdash import helpers, importer
+from tracdash.profiler import FileProfiler, merge_profiles, profile_path
+
+
+
+def _work(n):
+	return sum(i * i for i in range(n))
+
+
+def test_profiler_stops_after_max_tweets(tmp_path):
+	profiler = FileProfiler(str(tmp_path / "a.prof"), max_tweets=2)
+	profiler.start()
+	profiler.tick(1)
+	assert profiler.running
+	profiler.tick(2)
+	assert not profiler.running
+	_work(1000)
+	profiler.write()
+	
+	# nothing after the stop is counted
+	stats = pstats.Stats(str(tmp_path / "a.prof"))
+	assert not any(function == '_work' for (path, line, function) in stats.stats)
+
+
+def test_merge_profiles(tmp_path, monkeypatch):
+	monkeypatch.setattr(helpers, 'logging_path', str(tmp_path))
+	assert merge_profiles("run1") is None
+	
+	for file in ["a.jsonl.gz", "b.jsonl.gz"]:
+		profiler = FileProfiler(profile_path("run1", file))
+		profiler.start()
+		_work(1000)
+		profiler.write()
+	
+	report_file = merge_profiles("run1")
+	with open(report_file) as f:
+		report = f.read()
+	assert report.startswith("2 worker profiles")
+	assert "_work" in report
+	stats = pstats.Stats(str(tmp_path / "prof_run1.prof"))
+	assert [ calls for (path, line, function), (cc, calls, tt, ct, callers) in stats.stats.items() if function == '_work' ] == [2]
+
+
+def test_process_file_profiled(tmp_path, monkeypatch):
+	monkeypatch.setattr(helpers, 'logging_path', str(tmp_path))
+	monkeypatch.setattr(importer, '_profile_run', "run2")
+	monkeypatch.setattr(importer, '_profile_tweets', None)
+	monkeypatch.setattr(importer, '_es', object())
+	monkeypatch.setattr(importer, '_sender', None)
+	
+	path = str(tmp_path / "tweets.jsonl.gz")
+	with gzip.open(path, 'wt') as f:
+		f.write('{"info": {"activity_count": 0}}\n')
+	
+	assert importer._process_file(path) == "+ " + path
+	assert os.path.exists(profile_path("run2", path))
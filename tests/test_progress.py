@@ -0,0 +1,19 @@
+import multiprocessing, time
+
+from tracdash.progress import ProgressMonitor
+
+
+
+def test_poll_returns_when_ready():
+	monitor = ProgressMonitor(multiprocessing.Queue(), [], 60)
+	start = time.time()
+	monitor.poll(60, lambda: True)
+	assert time.time() - start < 1
+
+
+def test_poll_receives_until_timeout():
+	progress_queue = multiprocessing.Queue()
+	progress_queue.put(("tweets.jsonl.gz", 100, 10, 12, False))
+	monitor = ProgressMonitor(progress_queue, [], 60)
+	monitor.poll(1)
+	assert monitor.status()['docs'] == 12
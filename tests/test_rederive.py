@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from tracdash import helpers, importer, rederive
+from tracdash.exceptions import BulkInsertException
+
+
+
+class _FakeClient:
+	def __init__(self, statuses=None):
+		self.statuses = statuses or {}
+		self.updates = {}
+	
+	def bulk(self, index, body):
+		lines = body.splitlines()
+		items = []
+		for action, doc in zip(lines[::2], lines[1::2]):
+			doc_id = json.loads(action)['update']['_id']
+			self.updates[doc_id] = json.loads(doc)['doc']
+			items.append({ 'update': { '_id': doc_id, 'status': self.statuses.get(doc_id, 200) } })
+		return { 'errors': any(item['update']['status'] >= 300 for item in items), 'items': items }
+
+
+def _rederive_slice(monkeypatch, fields, slices, slice_id, hits):
+	queries = []
+	def scan(es, query, index, size, scroll):
+		queries.append(query)
+		return iter(hits)
+	es = _FakeClient()
+	monkeypatch.setattr(rederive, 'scan', scan)
+	monkeypatch.setattr(rederive, '_fields', fields)
+	monkeypatch.setattr(rederive, '_slices', slices)
+	monkeypatch.setattr(rederive, '_query', None)
+	monkeypatch.setattr(importer, '_es', es)
+	monkeypatch.setattr(importer, '_index_name', 'test')
+	return rederive._rederive_slice(slice_id), queries[0], es
+
+
+def test_rederive_slice(monkeypatch):
+	hits = [
+		{ '_id': '1', '_source': { 'is_retweet': True, 'is_quote': False, 'is_reply': False, 'urls': ["https://www.bbc.co.uk/news/1"] } },
+		{ '_id': '2', '_source': { 'is_retweet': False, 'is_quote': True, 'is_reply': True, 'urls': [] } }
+	]
+	result, query, es = _rederive_slice(monkeypatch, ['tweet_kind', 'websites'], 4, 2, hits)
+	assert result == "+ slice 2"
+	
+	# each worker scrolls its own slice, fetching only the sources of the fields
+	assert query['slice'] == { 'id': 2, 'max': 4 }
+	assert query['_source'] == ['is_quote', 'is_reply', 'is_retweet', 'urls']
+	assert query['query'] == { 'match_all': {} }
+	
+	# partial updates of just those fields
+	assert es.updates['1']['tweet_kind'] == 'rt'
+	assert es.updates['1']['websites']
+	assert es.updates['2'] == { 'tweet_kind': 'qt+re', 'websites': [] }
+	assert sorted(es.updates['1']) == ['tweet_kind', 'websites']
+
+
+def test_rederive_single_slice(monkeypatch):
+	result, query, es = _rederive_slice(monkeypatch, ['tweet_kind'], 1, 0, [])
+	assert 'slice' not in query
+	assert es.updates == {}
+
+
+def test_update_bulk_missing_and_failed(tmp_path, monkeypatch):
+	monkeypatch.setattr(helpers, 'logging_path', str(tmp_path))
+	monkeypatch.setattr(importer, '_index_name', 'test')
+	
+	# tweets not in the index are skipped
+	es = _FakeClient({ '2': 404 })
+	assert rederive._update_docs(es, [('1', { 'tweet_kind': 'original' }), ('2', { 'tweet_kind': 'rt' })], "slice 0") == 1
+	
+	es = _FakeClient({ '2': 400 })
+	with pytest.raises(BulkInsertException):
+		rederive._update_docs(es, [('1', { 'tweet_kind': 'original' }), ('2', { 'tweet_kind': 'rt' })], "slice 0")
+
+
+def test_rederive_unknown_stored_field(monkeypatch):
+	monkeypatch.setattr(importer, '_create_client', lambda: None)
+	monkeypatch.setattr(importer, '_put_missing_mappings', lambda es, fields: None)
+	for name in ['_geo_search_level', '_geo_helper', '_es_ips', '_index_name', '_pool_size']:
+		monkeypatch.setattr(importer, name, getattr(importer, name))
+	for name in ['_fields', '_slices', '_query']:
+		monkeypatch.setattr(rederive, name, getattr(rederive, name))
+	
+	# only from the raw files
+	with pytest.raises(ValueError):
+		rederive.rederive_fields(['localhost'], 'test', ['tweet_kind', 'tweet_geo_coord'])
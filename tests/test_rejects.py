@@ -0,0 +1,42 @@
+import json
+
+from tracdash import helpers, importer, rejects
+
+
+
+def _records(path):
+	with open(path, encoding='utf-8') as f:
+		return [ json.loads(line) for line in f ]
+
+
+def test_reject_file_appended(tmp_path, monkeypatch):
+	monkeypatch.setattr(helpers, 'logging_path', str(tmp_path))
+	
+	# a second run of the same file keeps the first run's rejects
+	for offset in [10, 250]:
+		writer = rejects.RejectWriter("tweets.jsonl.gz", 1.0)
+		writer.add(offset, b'{not json', ValueError("bad"))
+		writer.close()
+	
+	records = _records(rejects.reject_path("tweets.jsonl.gz"))
+	assert [ record['offset'] for record in records ] == [10, 250]
+	assert list(rejects.read_rejects(rejects.reject_path("tweets.jsonl.gz"))) == [b'{not json', b'{not json']
+
+
+def test_replay_keeps_original_offsets(tmp_path, monkeypatch):
+	monkeypatch.setattr(helpers, 'logging_path', str(tmp_path))
+	monkeypatch.setattr(importer, '_create_client', lambda: object())
+	# set by replay_rejects
+	for name in ['_geo_search_level', '_geo_helper', '_es_ips', '_index_name']:
+		monkeypatch.setattr(importer, name, getattr(importer, name))
+	
+	writer = rejects.RejectWriter("tweets.jsonl.gz", 1.0)
+	writer.add(10, b'{not json', ValueError("bad"))
+	writer.add(250, b'\xff\xfe garbage', ValueError("bad"))
+	writer.close()
+	
+	reject_file = rejects.reject_path("tweets.jsonl.gz")
+	rejects.replay_rejects([reject_file], ['localhost'], 'test')
+	
+	records = _records(rejects.reject_path(reject_file))
+	assert [ (record['file'], record['offset']) for record in records ] == [("tweets.jsonl.gz", 10), ("tweets.jsonl.gz", 250)]
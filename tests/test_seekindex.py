@@ -0,0 +1,45 @@
+import gzip
+
+from tracdash.seekindex import SeekIndex, SeekIndexWriter
+
+
+
+def _write(tmp_path, lines):
+	path = str(tmp_path / "tweets.jsonl.gz")
+	with gzip.open(path, 'wb') as f:
+		f.write(b''.join(lines))
+	return path
+
+
+def test_seek_index_lookup(tmp_path):
+	lines = [b'{"id_str": "30"}\n', b'{"id_str": "10"}\n', b'{"id_str": "20"}\n']
+	path = _write(tmp_path, lines)
+	
+	writer = SeekIndexWriter(path)
+	offset = 0
+	for line, tweet_id in zip(lines, [30, 10, 20]):
+		writer.add(str(tweet_id), offset, len(line))
+		offset += len(line)
+	writer.write(None)
+	
+	index = SeekIndex(path)
+	try:
+		assert index.locate("20") == (2 * len(lines[0]), len(lines[2]))
+		assert index.read_line("10") == lines[1]
+		assert index.locate("15") is None
+	finally:
+		index.close()
+
+
+def test_seek_index_empty(tmp_path):
+	# a file without docs gets a zero length seek file
+	path = _write(tmp_path, [b'{"info": {"activity_count": 0}}\n'])
+	SeekIndexWriter(path).write(None)
+	
+	index = SeekIndex(path)
+	try:
+		assert index.locate("10") is None
+		assert index.read_line("10") is None
+		assert index.lookup(["10"]) == []
+	finally:
+		index.close()
@@ -0,0 +1,66 @@
+import random
+from array import array
+from collections import defaultdict
+
+from tracdash import unicodetokeniser
+from tracdash.unicodetokeniser import helpers
+
+
+
+def _class_examples():
+	# a codepoint of each word break class
+	unicodetokeniser.load()
+	examples = {}
+	for cp, c in enumerate(helpers.get_classes(range(helpers.MAX_CODEPOINT))):
+		examples.setdefault(c, cp)
+	return sorted(examples.values())
+
+
+def test_tokenise():
+	assert unicodetokeniser.tokenise('') == []
+	assert unicodetokeniser.tokenise("can't stop") == ["can't", ' ', 'stop']
+	assert unicodetokeniser.tokenise('a.b.c 3.14 #tag') == ['a.b.c', ' ', '3.14', ' ', '#', 'tag']
+	assert unicodetokeniser.tokenise('\U0001F468\u200d\U0001F469 東京') == ['\U0001F468\u200d\U0001F469', ' ', '東', '京']
+	assert unicodetokeniser.tokenise('\U0001F1EC\U0001F1E7\U0001F1EB\U0001F1F7') == ['\U0001F1EC\U0001F1E7\U0001F1EB\U0001F1F7']
+
+
+def test_tokenise_matches_rules():
+	# random strings over a codepoint of every class, so every table entry the rules could reach is tried
+	rand = random.Random(1)
+	alphabet = [ chr(cp) for cp in _class_examples() if cp != 0 ] + list("a1.,'\" \n\r\u00e9\u05d0\u30a2\u0301")
+	for i in range(5000):
+		text = ''.join(rand.choice(alphabet) for j in range(rand.randint(1, 12)))
+		assert unicodetokeniser.tokenise(text) == unicodetokeniser.tokenise_rules(text), [hex(ord(c)) for c in text]
+
+
+def test_property_table_matches_values():
+	rand = random.Random(1)
+	values = array('I', bytes(helpers.MAX_CODEPOINT * 4))
+	for i in range(200):
+		start = rand.randrange(helpers.MAX_CODEPOINT)
+		value = rand.choice([1, 2, 1 << 18])
+		for cp in range(start, min(start + rand.randint(1, 1000), helpers.MAX_CODEPOINT)):
+			values[cp] |= value
+	table = helpers.PropertyTable(values, 'I')
+	
+	assert table.nbytes() < len(values) * values.itemsize
+	assert table.get(helpers.MAX_CODEPOINT) == 0
+	for i in range(100000):
+		cp = rand.randrange(helpers.MAX_CODEPOINT)
+		assert table.get(cp) == values[cp]
+	for cp in range(0, helpers.MAX_CODEPOINT, helpers.BLOCK_SIZE):
+		assert table.get(cp) == values[cp] and table.get(cp + helpers.BLOCK_MASK) == values[cp + helpers.BLOCK_MASK]
+
+
+def test_property_tables_match_dicts():
+	# as the tables replaced: a dict of the properties of each listed codepoint
+	unicodetokeniser.load()
+	word_props = defaultdict(int)
+	helpers.read_props(word_props, 'WordBreakProperty.txt', helpers._word_props_map)
+	helpers.read_props(word_props, 'emoji-data.txt', helpers._word_props_map, only='Extended_Pictographic')
+	grapheme_props = defaultdict(int)
+	helpers.read_props(grapheme_props, 'GraphemeBreakProperty.txt', helpers._grapheme_props_map)
+	
+	for cp in range(helpers.MAX_CODEPOINT):
+		assert helpers.get_word_property(cp) == word_props.get(cp, 0), hex(cp)
+		assert helpers.get_grapheme_property(cp) == grapheme_props.get(cp, 0), hex(cp)
@@ -0,0 +1,80 @@
+import time, threading
+
+from tracdash import importer, workqueue
+from tracdash.workqueue import WorkQueue
+
+
+
+def _queue(tmp_path, lease_time=60):
+	queue = WorkQueue(str(tmp_path / "queue.db"), lease_time)
+	queue.add(['a', 'b'])
+	return queue
+
+
+def _state(queue, file):
+	return queue.connection().execute("SELECT state, owner, attempts FROM work WHERE file = ?", (file,)).fetchone()
+
+
+def test_claim_and_finish(tmp_path):
+	queue = _queue(tmp_path)
+	assert queue.add(['a', 'c']) == 1
+	assert queue.claim('w1') == 'a'
+	assert queue.claim('w2') == 'b'
+	assert queue.claim('w3') == 'c'
+	assert queue.claim('w4') is None
+	
+	queue.finish('w1', 'a', True)
+	queue.finish('w2', 'b', False)
+	assert _state(queue, 'a')[0] == 'done'
+	assert _state(queue, 'b')[0] == 'failed'
+	assert queue.unfinished() == 1
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+	queue = _queue(tmp_path, lease_time=0.05)
+	assert queue.claim('w1') == 'a'
+	assert queue.heartbeat('w1', 'a')
+	assert queue.claim('w2') == 'b'
+	
+	time.sleep(0.1)
+	assert queue.claim('w3') == 'a'
+	assert _state(queue, 'a') == ('claimed', 'w3', 2)
+	
+	# the first owner has lost it, and can't finish it
+	assert not queue.heartbeat('w1', 'a')
+	queue.finish('w1', 'a', False)
+	assert _state(queue, 'a') == ('claimed', 'w3', 2)
+
+
+def test_abandoned_work_fails_after_max_attempts(tmp_path):
+	queue = WorkQueue(str(tmp_path / "queue.db"), 0.01)
+	queue.add(['a'])
+	for attempt in range(workqueue.MAX_ATTEMPTS):
+		assert queue.claim('w{}'.format(attempt)) == 'a'
+		time.sleep(0.02)
+	assert queue.claim('w') is None
+	assert _state(queue, 'a')[0] == 'failed'
+	assert queue.unfinished() == 0
+
+
+def test_worker_stops_file_on_lost_lease(tmp_path, monkeypatch):
+	path = str(tmp_path / "queue.db")
+	monkeypatch.setattr(workqueue, '_queue_path', path)
+	monkeypatch.setattr(workqueue, '_lease_time', 0.2)
+	monkeypatch.setattr(workqueue, 'HEARTBEAT_INTERVAL', 0.05)
+	queue = WorkQueue(path, 0.2)
+	queue.add(['a'])
+	
+	def process_file(file):
+		# another worker takes the file over (and finishes it) while it is imported
+		other = WorkQueue(path, 60)
+		other.connection().execute("UPDATE work SET owner = 'other', state = 'done' WHERE file = ?", (file,))
+		assert importer._cancel_file.wait(5)
+		return "! " + file
+	monkeypatch.setattr(importer, '_process_file', process_file)
+	
+	result = workqueue._queue_worker(0)
+	assert result == "! a\tlease lost"
+	assert importer._cancel_file is None
+	# not marked failed over the other worker's result
+	assert _state(queue, 'a')[:2] == ('done', 'other')
@@ -1,7 +1,12 @@
 
 from .helpers import init_logging
-from .helpers import init_geo
+from .helpers import init_geo, build_geo_artefact, build_geo_grids
 
 from .importer import import_files
+from .rederive import rederive_fields
+from .seekindex import lookup_tweets
+from .workqueue import import_queue
+from .frequencies import count_frequencies, build_reference_types
+from .rejects import replay_rejects
 
 from .app.route import prepare_app
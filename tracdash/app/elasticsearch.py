@@ -16,6 +16,7 @@ import diskcache
 from hashlib import md5
 
 from ..exceptions import SearchException
+from ..helpers import tweet_kinds
 from ..stopwords import SEED_STOPWORDS, STOPWORDS_EN
 from ..unicodetokeniser.util import contains_digit
 from .util import info, exception
@@ -40,6 +41,9 @@ KEYNESS_SM_THRESHOLD = 1.1
 CANDIDATE_KEYWORDS_SIZE = 100000
 CANDIDATE_NGRAMS_SIZE = 100000
 
+# 'script' (RT_FILTER), 'tweet_kind' (terms filter), or 'auto': tweet_kind once every document has it
+RT_FILTER_MODE = 'auto'
+
 
 RT_FILTER = {
   "script": {
@@ -456,7 +460,7 @@ CORPUS_USERS_COUNT = {
 
 
 class ESHelper:
-	def __init__(self, es_instance, index_name, start_date=START_DATE, end_date=END_DATE, cache_path=None):
+	def __init__(self, es_instance, index_name, start_date=START_DATE, end_date=END_DATE, cache_path=None, rt_filter=RT_FILTER_MODE):
 		self.es = es_instance
 		self.index_name = index_name
 		self.start_date = start_date
@@ -467,6 +471,7 @@ class ESHelper:
 		if cache_path is not None:
 			self.init_cache(cache_path)
 		
+		self.init_rt_filter(rt_filter)
 		self.init_stats()
 		self.init_reference_types()
 	
@@ -478,6 +483,29 @@ class ESHelper:
 		info("Using Elastic Search cache at {}".format(cache_path))
 	
 	
+	def init_rt_filter(self, mode=RT_FILTER_MODE):
+		# indexes with the tweet_kind field (imported or rederived) are filtered with a cacheable terms query
+		# rather than the RT_FILTER script, which is run on every document
+		# in auto mode only when every document has it, or documents not yet rederived would drop out of the views
+		self.use_tweet_kind = (mode == 'tweet_kind')
+		if mode == 'auto':
+			try:
+				res = self.es.indices.get_field_mapping(index=self.index_name, fields="tweet_kind")
+				keyword = all(
+					index['mappings'].get('tweet_kind', {}).get('mapping', {}).get('tweet_kind', {}).get('type') == 'keyword'
+					for index in res.values()
+				) and len(res) > 0
+				if keyword:
+					total = self.es.count(index=self.index_name)['count']
+					with_kind = self.es.count(index=self.index_name, body={ "query": { "exists": { "field": "tweet_kind" } } })['count']
+					self.use_tweet_kind = total > 0 and with_kind == total
+					if not self.use_tweet_kind:
+						info("tweet_kind on {} of {} documents".format(with_kind, total))
+			except Exception as e:
+				exception("tweet_kind mapping check failed", e)
+		info("RT filter: {}".format("tweet_kind" if self.use_tweet_kind else "script"))
+	
+	
 	def init_stats(self):
 		self.max_total_documents = 0
 		self.min_total_documents = 0
@@ -567,11 +595,15 @@ class ESHelper:
 	
 	
 	def add_rt_filter(self, agg, include_rt=False, include_qt=False, include_re=False):
-		for filter in agg['query']['bool']['filter']:
+		filters = agg['query']['bool']['filter']
+		for i, filter in enumerate(filters):
 			if 'script' in filter:
-				filter['script']['script']['params']['rt'] = include_rt
-				filter['script']['script']['params']['qt'] = include_qt
-				filter['script']['script']['params']['re'] = include_re
+				if self.use_tweet_kind:
+					filters[i] = { "terms": { "tweet_kind": tweet_kinds(include_rt, include_qt, include_re) } }
+				else:
+					filter['script']['script']['params']['rt'] = include_rt
+					filter['script']['script']['params']['qt'] = include_qt
+					filter['script']['script']['params']['re'] = include_re
 	
 	
 	def add_wildcard_filter(self, agg, field, search):
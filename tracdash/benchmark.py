@@ -0,0 +1,377 @@
+"""
+Measurements for comparing changes to the importer, index and dashboard queries.
+Results are logged and returned as dicts so runs can be compared.
+"""
+
+import sys, time, logging, itertools, random, gzip, json
+from collections import defaultdict
+from copy import deepcopy
+from statistics import median
+
+
+
+AGG_REPEATS = 5
+
+
+
+def _timed(f, *args, **kwargs):
+	start = time.perf_counter()
+	result = f(*args, **kwargs)
+	return result, time.perf_counter() - start
+
+
+
+GEO_LOOKUPS = 10000
+TOKENISER_TEXTS = 100000
+PROPERTY_LOOKUPS = 1000000
+
+
+
+##########
+# index
+##########
+
+def measure_index_size(es, index_name, force_merge=False):
+	"""
+	Store size, doc count and segment memory of an index.
+	Set force_merge to merge to one segment first, so indexes built differently compare fairly.
+	"""
+	if force_merge:
+		es.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=60*60)
+		es.indices.refresh(index=index_name)
+
+	stats = es.indices.stats(index=index_name, metric='store,docs,segments')['_all']['primaries']
+	result = {
+		'index': index_name,
+		'docs': stats['docs']['count'],
+		'store_bytes': stats['store']['size_in_bytes'],
+		'segments': stats['segments']['count'],
+		'segments_memory_bytes': stats['segments']['memory_in_bytes']
+	}
+
+	logging.info("index size\t{}\t{} docs\t{:.1f} MB\t{} segments\t{:.1f} MB segment memory".format(
+		index_name, result['docs'], result['store_bytes'] / 1000000, result['segments'], result['segments_memory_bytes'] / 1000000))
+	return result
+
+
+
+def dashboard_aggregations():
+	"""The aggregations behind the dashboard's main views, as name -> query body."""
+	from .app.elasticsearch import AGG_LIST, DAY_TOTALS, CORPUS_USERS_COUNT, CORPUS_SIZE_RT
+
+	aggs = {}
+	for field in ['types', 'bi_grams', 'tri_grams', 'hashtags', 'websites', 'urls', 'username']:
+		agg = deepcopy(AGG_LIST)
+		agg['aggs']['counts']['terms']['field'] = field
+		aggs[field] = agg
+
+	aggs['day_totals'] = deepcopy(DAY_TOTALS)
+	aggs['users_count'] = deepcopy(CORPUS_USERS_COUNT)
+	aggs['users_count']['size'] = 0
+	aggs['rt_counts'] = deepcopy(CORPUS_SIZE_RT)
+	return aggs
+
+
+
+def measure_aggregations(es, index_name, repeats=AGG_REPEATS):
+	"""
+	Latency of the dashboard aggregations: the first run of each, then the median of repeats more.
+	Run straight after an import (or a refresh with new documents) to see the cost of building
+	global ordinals on first use; the request cache is bypassed throughout.
+	"""
+	results = {}
+	for name, agg in dashboard_aggregations().items():
+		_, first = _timed(es.search, index=index_name, body=agg, request_cache=False)
+		times = []
+		for i in range(repeats):
+			_, elapsed = _timed(es.search, index=index_name, body=agg, request_cache=False)
+			times.append(elapsed)
+
+		results[name] = { 'first': first, 'median': median(times) if times else None }
+		logging.info("aggregation\t{}\t{}\tfirst {:.3f}s\tmedian {}".format(
+			index_name, name, first, "{:.3f}s".format(results[name]['median']) if times else '-'))
+
+	return results
+
+
+
+def compare_indexes(es, index_names, force_merge=False, repeats=AGG_REPEATS):
+	"""Size and aggregation latency of indexes holding the same tweets (e.g. imported with different index profiles)."""
+	results = {}
+	for index_name in index_names:
+		results[index_name] = {
+			'size': measure_index_size(es, index_name, force_merge=force_merge),
+			'aggregations': measure_aggregations(es, index_name, repeats=repeats)
+		}
+
+	base = index_names[0]
+	for index_name in index_names[1:]:
+		logging.info("index size vs {}\t{}\t{:+.1f}%".format(base, index_name,
+			100.0 * (results[index_name]['size']['store_bytes'] / max(results[base]['size']['store_bytes'], 1) - 1)))
+		for name, timing in results[index_name]['aggregations'].items():
+			base_timing = results[base]['aggregations'][name]
+			logging.info("aggregation vs {}\t{}\t{}\tspeedup first {:.2f}x\tmedian {}".format(base, index_name, name,
+				base_timing['first'] / max(timing['first'], 1e-9),
+				"{:.2f}x".format(base_timing['median'] / max(timing['median'], 1e-9)) if timing['median'] else '-'))
+
+	return results
+
+
+
+def measure_rt_filters(es, index_name, field='types', repeats=AGG_REPEATS):
+	"""
+	Latency of a dashboard aggregation on field with the RT_FILTER script and with the tweet_kind terms filter,
+	for all eight include_rt / include_qt / include_re combinations (the index must have tweet_kind).
+	"""
+	from .app.elasticsearch import AGG_LIST, RT_FILTER
+	from .helpers import tweet_kinds
+
+	results = {}
+	for include in itertools.product([False, True], repeat=3):
+		script_filter = deepcopy(RT_FILTER)
+		script_filter['script']['script']['params'] = dict(zip(['rt', 'qt', 're'], include))
+		kind_filter = { "terms": { "tweet_kind": tweet_kinds(*include) } }
+
+		timings = {}
+		totals = {}
+		for name, rt_filter in [('script', script_filter), ('tweet_kind', kind_filter)]:
+			agg = deepcopy(AGG_LIST)
+			agg['aggs']['counts']['terms']['field'] = field
+			filters = agg['query']['bool']['filter']
+			filters[[i for i, f in enumerate(filters) if 'script' in f][0]] = rt_filter
+
+			times = []
+			for i in range(repeats):
+				res, elapsed = _timed(es.search, index=index_name, body=agg, request_cache=False)
+				times.append(elapsed)
+			timings[name] = median(times)
+			totals[name] = res['aggregations']['total']['value']
+
+		key = "rt={:d} qt={:d} re={:d}".format(*include)
+		results[key] = timings
+		if totals['script'] != totals['tweet_kind']:
+			logging.warning("rt filter totals differ\t{}\t{}\tscript {}\ttweet_kind {}".format(index_name, key, totals['script'], totals['tweet_kind']))
+		logging.info("rt filter\t{}\t{}\tscript {:.3f}s\ttweet_kind {:.3f}s\tspeedup {:.2f}x".format(
+			index_name, key, timings['script'], timings['tweet_kind'], timings['script'] / max(timings['tweet_kind'], 1e-9)))
+
+	return results
+
+
+
+##########
+# geo
+##########
+
+def random_points(gdf, n, seed=0):
+	"""Uniform random (lng, lat) points over the bounds of a level's regions."""
+	rand = random.Random(seed)
+	min_x, min_y, max_x, max_y = gdf.total_bounds
+	return [ (rand.uniform(min_x, max_x), rand.uniform(min_y, max_y)) for i in range(n) ]
+
+
+
+def measure_geo_lookups(geo_helper, level, n=GEO_LOOKUPS, seed=0):
+	"""
+	Lookups/sec of the GeoHelper search for a NUTS level against the exhaustive search_geo,
+	checking both give the same region for every point.
+	"""
+	gdf = getattr(geo_helper, 'gdf_level_{}'.format(level))
+	search = getattr(geo_helper, 'search_nuts_{}'.format(level))
+	points = random_points(gdf, n, seed)
+
+	expected, reference_time = _timed(lambda: [ geo_helper.search_geo(gdf, lng, lat, geo_helper.crs) for lng, lat in points ])
+	found, search_time = _timed(lambda: [ search(lng, lat) for lng, lat in points ])
+
+	mismatches = sum(1 for a, b in zip(expected, found) if a != b)
+	if mismatches:
+		logging.warning("geo lookup mismatches\tlevel {}\t{} of {}".format(level, mismatches, n))
+
+	result = {
+		'level': level,
+		'lookups': n,
+		'matched': sum(1 for code, name in found if code is not None),
+		'mismatches': mismatches,
+		'reference_per_sec': n / max(reference_time, 1e-9),
+		'per_sec': n / max(search_time, 1e-9)
+	}
+	logging.info("geo lookups\tlevel {}\t{} points\t{} in regions\tsearch_geo {:.0f}/s\tsearch_nuts_{} {:.0f}/s\tspeedup {:.1f}x".format(
+		level, n, result['matched'], result['reference_per_sec'], level, result['per_sec'], result['per_sec'] / max(result['reference_per_sec'], 1e-9)))
+	return result
+
+
+
+##########
+# tokeniser
+##########
+
+def read_texts(file, n=TOKENISER_TEXTS):
+	"""Up to n tweet texts (extended where there is one) from a jsonl.gz file."""
+	texts = []
+	with gzip.open(file) as f:
+		for line in f:
+			if len(texts) >= n:
+				break
+			try:
+				tweet = json.loads(line)
+			except ValueError:
+				continue
+			if 'extended_tweet' in tweet:
+				texts.append(tweet['extended_tweet'].get('full_text', ''))
+			elif 'text' in tweet:
+				texts.append(tweet['text'])
+	return texts
+
+
+
+def read_word_break_tests(test_file):
+	"""(codepoints, break positions) for each case in Unicode's WordBreakTest.txt."""
+	tests = []
+	with open(test_file, encoding='utf-8') as f:
+		for line in f:
+			line = line.split('#')[0].strip()
+			if not line:
+				continue
+			cps = []
+			breaks = []
+			for field in line.split():
+				if field == '\u00f7':
+					breaks.append(len(cps))
+				elif field != '\u00d7':
+					cps.append(int(field, 16))
+			# the start and end of the text are always breaks, tokens don't mark them
+			tests.append((cps, [b for b in breaks if 0 < b < len(cps)]))
+	return tests
+
+
+
+def _token_breaks(tokens):
+	breaks = list(itertools.accumulate(len(token) for token in tokens))
+	return breaks[:-1]
+
+
+
+def verify_word_breaks(test_file=None, texts=None):
+	"""
+	Check the word break table gives the same breaks as is_word_break: for every combination of
+	codepoint classes, then as tokenise against tokenise_rules over the cases in Unicode's
+	WordBreakTest.txt (test_file) and texts. Also logs how many test cases the (simplified) rules pass.
+	Returns the number of differences, which should be 0.
+	"""
+	from . import unicodetokeniser
+	from .unicodetokeniser import helpers as uh
+
+	unicodetokeniser.load()
+	table, n, n_rr, ll_classes, rr_classes = uh.get_word_break_table()
+
+	# a codepoint of each class
+	examples = {}
+	for cp, c in enumerate(uh.get_classes(range(uh.MAX_CODEPOINT))):
+		examples.setdefault(c, cp)
+
+	differences = 0
+	combinations = 0
+	for ll, l, r, rr in itertools.product(sorted(examples), repeat=4):
+		combinations += 1
+		expected = uh.is_word_break(examples[ll], examples[l], examples[r], examples[rr])
+		found = table[((ll_classes[ll] * n + l) * n + r) * n_rr + rr_classes[rr]] == 1
+		if expected != found:
+			differences += 1
+	logging.info("word break table\t{} classes\t{} combinations\t{} differences".format(len(examples), combinations, differences))
+
+	if test_file is not None:
+		tests = read_word_break_tests(test_file)
+		passed = 0
+		test_differences = 0
+		for cps, breaks in tests:
+			text = uh.get_unicode(cps)
+			tokens = unicodetokeniser.tokenise(text)
+			if tokens != unicodetokeniser.tokenise_rules(text):
+				test_differences += 1
+			if _token_breaks(tokens) == breaks:
+				passed += 1
+		differences += test_differences
+		logging.info("word break tests\t{}\t{} cases\t{} differences\t{} pass (rules simplified from TR29)".format(
+			test_file, len(tests), test_differences, passed))
+
+	if texts is not None:
+		text_differences = sum(1 for text in texts if unicodetokeniser.tokenise(text) != unicodetokeniser.tokenise_rules(text))
+		differences += text_differences
+		logging.info("word break texts\t{} texts\t{} differences".format(len(texts), text_differences))
+
+	return differences
+
+
+
+def measure_tokenise(texts):
+	"""Texts/sec tokenised with the word break table and with is_word_break."""
+	from . import unicodetokeniser
+
+	unicodetokeniser.load()
+
+	_, rules_time = _timed(lambda: [ unicodetokeniser.tokenise_rules(text) for text in texts ])
+	_, table_time = _timed(lambda: [ unicodetokeniser.tokenise(text) for text in texts ])
+
+	result = {
+		'texts': len(texts),
+		'codepoints': sum(len(text) for text in texts),
+		'rules_per_sec': len(texts) / max(rules_time, 1e-9),
+		'per_sec': len(texts) / max(table_time, 1e-9)
+	}
+	logging.info("tokenise\t{} texts\t{} codepoints\ttokenise_rules {:.0f}/s\ttokenise {:.0f}/s\tspeedup {:.1f}x".format(
+		result['texts'], result['codepoints'], result['rules_per_sec'], result['per_sec'], result['per_sec'] / max(result['rules_per_sec'], 1e-9)))
+	return result
+
+
+
+def measure_property_lookups(n=PROPERTY_LOOKUPS, seed=0):
+	"""
+	Build time, memory and lookups/sec of the two-stage word and grapheme property tables,
+	against dicts of every listed codepoint as they were stored before; checking both agree.
+	Dict memory counts the dicts and their key and value objects, so is approximate.
+	"""
+	from .unicodetokeniser import helpers as uh
+
+	def tables():
+		uh.load_grapheme_props()
+		uh.load_word_props()
+		return uh._word_props, uh._grapheme_props
+
+	def dicts():
+		word = defaultdict(int)
+		grapheme = defaultdict(int)
+		uh.read_props(grapheme, 'GraphemeBreakProperty.txt', uh._grapheme_props_map)
+		uh.read_props(word, 'WordBreakProperty.txt', uh._word_props_map)
+		uh.read_props(word, 'emoji-data.txt', uh._word_props_map, only='Extended_Pictographic')
+		return dict(word), dict(grapheme)
+
+	(word_table, grapheme_table), table_time = _timed(tables)
+	(word_dict, grapheme_dict), dict_time = _timed(dicts)
+
+	table_bytes = word_table.nbytes() + grapheme_table.nbytes()
+	dict_bytes = sum(sys.getsizeof(d) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in d.items()) for d in [word_dict, grapheme_dict])
+
+	# as tokenise sees them, mostly assigned codepoints
+	rand = random.Random(seed)
+	listed = sorted(set(word_dict) | set(grapheme_dict))
+	cps = [ rand.choice(listed) if rand.random() < 0.5 else rand.randrange(uh.MAX_CODEPOINT) for i in range(n) ]
+
+	mismatches = sum(1 for cp in cps if word_table.get(cp) != word_dict.get(cp, 0) or grapheme_table.get(cp) != grapheme_dict.get(cp, 0))
+	if mismatches:
+		logging.warning("property lookup mismatches\t{} of {}".format(mismatches, n))
+
+	_, dict_lookup_time = _timed(lambda: [ (word_dict.get(cp, 0), grapheme_dict.get(cp, 0)) for cp in cps ])
+	_, table_lookup_time = _timed(lambda: [ (word_table.get(cp), grapheme_table.get(cp)) for cp in cps ])
+
+	result = {
+		'lookups': n,
+		'mismatches': mismatches,
+		'table_build': table_time,
+		'dict_build': dict_time,
+		'table_bytes': table_bytes,
+		'dict_bytes': dict_bytes,
+		'table_per_sec': n / max(table_lookup_time, 1e-9),
+		'dict_per_sec': n / max(dict_lookup_time, 1e-9)
+	}
+	logging.info("property tables\tbuild {:.2f}s\t{:.2f} MB\t{:.0f} lookups/s".format(table_time, table_bytes / 1000000, result['table_per_sec']))
+	logging.info("property dicts\tbuild {:.2f}s\t{:.2f} MB\t{:.0f} lookups/s".format(dict_time, dict_bytes / 1000000, result['dict_per_sec']))
+	return result
@@ -0,0 +1,134 @@
+import asyncio, logging, threading
+
+from elasticsearch import AsyncElasticsearch
+
+from . import helpers
+from .exceptions import BulkInsertException
+
+
+
+class AsyncBulkSender:
+	"""
+	Sends ElasticSearch bulk requests from an asyncio event loop running in a background thread,
+	keeping up to max_in_flight requests outstanding at once.
+	Requests are balanced round robin across all es_ips by the client connection pool.
+	submit() blocks while max_in_flight requests are outstanding,
+	so the caller (i.e. tokenisation) cannot run unboundedly ahead of ElasticSearch.
+	"""
+	def __init__(self, es_ips, index_name, max_in_flight=4, timeout=(60*60), **es_options):
+		self.index_name = index_name
+		self.max_in_flight = max_in_flight
+
+		self.slots = threading.BoundedSemaphore(max_in_flight)
+		self.lock = threading.Lock()
+		self.pending = []
+		self.sent = 0		# documents inserted by completed requests so far, for progress reporting
+
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self._run_loop, name="bulk", daemon=True)
+		self.thread.start()
+
+		self.es = self._call(self._create_client(es_ips, timeout, es_options))
+
+
+	def _run_loop(self):
+		asyncio.set_event_loop(self.loop)
+		self.loop.run_forever()
+
+
+	def _call(self, coro):
+		return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+	async def _create_client(self, es_ips, timeout, es_options):
+		# created inside the loop so the aiohttp session is bound to it
+		return AsyncElasticsearch(es_ips, timeout=timeout, maxsize=self.max_in_flight, **es_options)
+
+
+	async def _send(self, body, file, n):
+		res = await self.es.bulk(index=self.index_name, body=body)
+		if res['errors']:
+			helpers.dump_es_error(res, file, n)
+			logging.warning('bulk insert error\t{}\t{}\t{}'.format( file, n, len(res['items']) ))
+			raise BulkInsertException('es.bulk returned errors')
+		else:
+			logging.info('bulk insert success\t{}\t{}\t{}'.format( file, n, len(res['items']) ))
+			return len(res['items'])
+
+
+	def _done(self, future):
+		if not future.cancelled() and future.exception() is None:
+			with self.lock:
+				self.sent += future.result()
+		self.slots.release()
+
+
+	def submit(self, body, file, n):
+		"""Queue a bulk body, blocking until one of the max_in_flight slots is free."""
+		self.slots.acquire()
+
+		# fail fast rather than tokenising the rest of the file
+		with self.lock:
+			failed = [f for f in self.pending if f.done() and f.exception() is not None]
+		if failed:
+			self.slots.release()
+			raise failed[0].exception()
+
+		future = asyncio.run_coroutine_threadsafe(self._send(body, file, n), self.loop)
+		future.add_done_callback(self._done)
+		with self.lock:
+			self.pending.append(future)
+
+
+	def flush(self):
+		"""Wait for all outstanding bulk requests and return the number of documents inserted."""
+		with self.lock:
+			pending = self.pending
+			self.pending = []
+
+		done = 0
+		error = None
+		for future in pending:
+			try:
+				done += future.result()
+			except Exception as e:
+				if error is None:
+					error = e
+
+		if error is not None:
+			raise error
+
+		return done
+
+
+	def discard(self):
+		"""Wait for all outstanding bulk requests, ignoring their results (e.g. after a file error)."""
+		try:
+			self.flush()
+		except:
+			pass
+
+
+	def cancel(self):
+		"""Drop all outstanding bulk requests, cancelling those not yet sent or answered."""
+		with self.lock:
+			pending = self.pending
+			self.pending = []
+
+		for future in pending:
+			future.cancel()
+		for future in pending:
+			try:
+				future.result()
+			except:
+				pass
+
+
+	def close(self):
+		try:
+			self.flush()
+		finally:
+			self._call(self.es.close())
+			self.loop.call_soon_threadsafe(self.loop.stop)
+			self.thread.join()
+			self.loop.close()
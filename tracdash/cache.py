@@ -0,0 +1,53 @@
+from collections import OrderedDict
+
+
+
+class LRUCache:
+	"""Bounded least recently used cache, counting hits and misses for reporting."""
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.data = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+
+	def __len__(self):
+		return len(self.data)
+
+
+	def get(self, key, default=None):
+		try:
+			value = self.data[key]
+		except KeyError:
+			self.misses += 1
+			return default
+		self.data.move_to_end(key)
+		self.hits += 1
+		return value
+
+
+	def put(self, key, value):
+		self.data[key] = value
+		self.data.move_to_end(key)
+		if len(self.data) > self.maxsize:
+			self.data.popitem(last=False)
+
+
+	def clear(self):
+		self.data.clear()
+
+
+	def reset_stats(self):
+		self.hits = 0
+		self.misses = 0
+
+
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		if lookups == 0:
+			return 0.0
+		return self.hits / lookups
+
+
+	def stats(self):
+		return "{:.1f}% ({}/{})".format(100.0 * self.hit_rate(), self.hits, self.hits + self.misses)
@@ -4,3 +4,12 @@ class BulkInsertException(IOError):
 
 class SearchException(Exception):
 	pass
+
+class RejectRateException(Exception):
+	pass
+
+class IndexCreationException(Exception):
+	pass
+
+class ImportCancelledException(Exception):
+	pass
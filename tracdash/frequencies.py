@@ -0,0 +1,199 @@
+"""
+Per-day corpus frequency tables accumulated at import time.
+
+Each worker counts, per day (UTC), the docs containing each of the types, hashtags and websites,
+and the docs of each tweet kind (retweet / quote / reply combination), as it processes a file,
+then writes them sorted to a partial table (map), one per source file, replacing the file's
+partial from any earlier import of it.
+The totals are rebuilt from all the partial tables, merged into one compact table per field (reduce),
+streaming the sorted partials so memory does not grow with the number of files. Partials are kept,
+so re-importing or resuming never counts a file twice.
+
+Tables are gzipped TSV: day, key, doc count; sorted by day then key.
+A tweet seen more than once in a file (e.g. an original embedded in several retweets) is counted once.
+"""
+
+import os, glob, gzip, heapq, logging, time
+import multiprocessing
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from itertools import groupby
+
+from . import helpers
+from . import importer
+
+
+
+TABLES = ['types', 'hashtags', 'websites', 'kinds']
+PARTS_DIR = "parts"
+TABLE_SUFFIX = ".tsv.gz"
+
+# as app.elasticsearch, types rarer than this are left out of the reference file
+REFERENCE_MIN_PROPORTION = 1.0/1000000
+
+_frequency_dir = None
+
+
+
+class FrequencyCounter:
+	"""Per-day doc frequencies for the docs of one file (the map step)."""
+	def __init__(self):
+		# table -> day -> Counter
+		self.tables = { table: defaultdict(Counter) for table in TABLES }
+		self.seen = set()
+		self.docs = 0
+
+
+	def add(self, doc):
+		if doc['tweet_id'] in self.seen:
+			return
+		self.seen.add(doc['tweet_id'])
+		self.docs += 1
+
+		day = '-'
+		if doc.get('timestamp') is not None:
+			day = datetime.fromtimestamp(doc['timestamp'] / 1000.0, tz=timezone.utc).strftime('%Y-%m-%d')
+
+		# doc fields are already de-duplicated lists, so each entry is one doc
+		for table in ['types', 'hashtags', 'websites']:
+			self.tables[table][day].update(doc[table])
+		self.tables['kinds'][day][doc['tweet_kind']] += 1
+
+
+	def write(self, directory, name):
+		parts_dir = os.path.join(directory, PARTS_DIR)
+		os.makedirs(parts_dir, exist_ok=True)
+
+		for table in TABLES:
+			part_file = os.path.join(parts_dir, "{}.{}{}".format(helpers.escape_filename(name), table, TABLE_SUFFIX))
+			_write_table(part_file, (
+				(day, key, count)
+				for day in sorted(self.tables[table])
+				for key, count in sorted(self.tables[table][day].items())
+			))
+
+
+
+def _write_table(path, rows):
+	# write then rename, so a partial table is never merged
+	with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+		for day, key, count in rows:
+			if '\t' in key or '\n' in key:
+				continue
+			f.write("{}\t{}\t{}\n".format(day, key, count))
+	os.replace(path + '.tmp', path)
+
+
+
+def _read_table(path):
+	with gzip.open(path, 'rt', encoding='utf-8') as f:
+		for line in f:
+			day, key, count = line.rstrip('\n').split('\t')
+			yield day, key, int(count)
+
+
+
+def merge_frequency_tables(directory):
+	"""Rebuild the table for each field from the partial tables under directory, one per source file (the reduce step)."""
+	for table in TABLES:
+		table_file = os.path.join(directory, table + TABLE_SUFFIX)
+		parts = sorted(glob.glob(os.path.join(directory, PARTS_DIR, "*.{}{}".format(table, TABLE_SUFFIX))))
+		if not parts:
+			continue
+
+		sources = [ _read_table(part) for part in parts ]
+		merged = heapq.merge(*sources, key=lambda row: (row[0], row[1]))
+		_write_table(table_file, (
+			(day, key, sum(row[2] for row in rows))
+			for (day, key), rows in groupby(merged, key=lambda row: (row[0], row[1]))
+		))
+
+		logging.info("frequency table merged\t{}\t{} parts".format(table_file, len(parts)))
+
+
+
+def load_frequencies(directory, table, start_date=None, end_date=None):
+	"""Doc frequencies from a merged table, summed over days from start_date to end_date (YYYY-MM-DD, inclusive)."""
+	counts = Counter()
+	for day, key, count in _read_table(os.path.join(directory, table + TABLE_SUFFIX)):
+		if start_date is not None and day < start_date:
+			continue
+		if end_date is not None and day > end_date:
+			continue
+		counts[key] += count
+	return counts
+
+
+
+def count_frequencies(files, directory, pool_size = 16, geo_level = 0):
+	"""
+	Build the frequency tables for a list of jsonl.gz files without importing them,
+	e.g. for a tweet sample to use as the reference corpus (see build_reference_types).
+	"""
+	global _frequency_dir
+
+	helpers.init_tokeniser()
+
+	importer._geo_search_level = geo_level
+	importer._geo_helper = helpers.init_geo(geo_level)
+
+	_frequency_dir = directory
+
+	logging.info("starting frequency count\t{}".format(directory))
+	with multiprocessing.get_context('fork').Pool(pool_size, initializer=importer._init_caches) as pool:
+		result = pool.map(_count_file, files)
+
+	merge_frequency_tables(directory)
+	logging.info("frequency count finished\n{}".format( "\n".join(result) ))
+
+
+
+def _count_file(file):
+	logging.info("starting frequency count\t{}".format(file))
+
+	start_time = time.time()
+
+	counter = FrequencyCounter()
+	docs = []
+
+	try:
+		with gzip.open(file) as f:
+			for line in f:
+				line = line.strip()
+				if line:
+					importer._process_line(line, docs)
+					for doc in docs:
+						counter.add(doc)
+					docs.clear()
+
+		counter.write(_frequency_dir, file)
+
+	except:
+		logging.exception("frequency count error\t{}".format(file))
+		return "! " + file
+
+	logging.info("frequency count finished\t{}\t{}\t{:.1f}s".format(file, counter.docs, time.time() - start_time))
+
+	return "+ " + file
+
+
+
+def build_reference_types(directory, output_file, min_proportion = REFERENCE_MIN_PROPORTION):
+	"""
+	Write the reference type list used for keyness (doc proportion, tab, type; as app.elasticsearch.REFERENCE_TYPE_LIST)
+	from merged frequency tables, returning the corpus size to set as REFERENCE_CORPUS_SIZE.
+	"""
+	corpus_size = sum(load_frequencies(directory, 'kinds').values())
+	types = load_frequencies(directory, 'types')
+
+	written = 0
+	with open(output_file, 'w', encoding='utf-8') as f:
+		for type, freq in types.most_common():
+			doc_prop = freq / max(corpus_size, 1)
+			if doc_prop < min_proportion:
+				break
+			f.write("{}\t{}\n".format(doc_prop, type))
+			written += 1
+
+	logging.info("reference types written\t{}\t{} types\tcorpus size {}".format(output_file, written, corpus_size))
+	return corpus_size
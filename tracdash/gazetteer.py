@@ -0,0 +1,222 @@
+"""
+Matching of free-text profile locations ("Leeds, UK", "sunny Stockton-on-Tees") to NUTS regions.
+
+Place names, from the NUTS region names and optionally a TSV of further names, are normalised
+(accents, case and punctuation removed) and compiled into an Aho-Corasick automaton, so every name
+in a location is found in one pass over it, however many names there are.
+Names only match whole words. Of the names found, the most specific region wins, then the longest name.
+A name given for more than one region stands for the smallest region containing them all,
+or is dropped if there is none.
+
+Names are not taken as in the UK when a place outside it follows or contains them ("London, Ontario",
+"Perth, WA", "New South Wales"; data/gazetteer_foreign.txt), and names as often used elsewhere
+(data/gazetteer_ambiguous.txt) need a UK signal: a UK country or "UK" (UK_SIGNALS), or another UK name.
+"""
+
+import os, re, logging, unicodedata
+from collections import deque, defaultdict
+
+
+
+MIN_NAME_LENGTH = 4		# shorter names (and parts of names) are too often words
+NAME_SEPARATORS = re.compile(r' and |&|,')
+
+FOREIGN_FILE = os.path.join(os.path.dirname(__file__), 'data', 'gazetteer_foreign.txt')
+AMBIGUOUS_FILE = os.path.join(os.path.dirname(__file__), 'data', 'gazetteer_ambiguous.txt')
+UK_SIGNALS = ['uk', 'u k', 'united kingdom', 'britain', 'great britain', 'gb',
+	'england', 'scotland', 'wales', 'cymru', 'northern ireland']
+
+
+
+def read_names(file):
+	"""Normalised names from a file of one name per line, ignoring blank lines and # comments."""
+	names = set()
+	with open(file, encoding='utf-8') as f:
+		for line in f:
+			line = line.split('#')[0].strip()
+			if line:
+				names.add(normalise(line))
+	return names
+
+
+
+def normalise(text):
+	"""Lower case words without accents or punctuation, padded with a space so names match whole words."""
+	text = unicodedata.normalize('NFKD', text)
+	text = ''.join(c for c in text if not unicodedata.combining(c))
+	text = re.sub(r'[\W_]+', ' ', text.casefold())
+	return ' ' + ' '.join(text.split()) + ' '
+
+
+
+class Automaton:
+	"""
+	Aho-Corasick automaton over characters, finding every added pattern in a text in one pass.
+	search yields (end, value) for each occurrence, end being the index just past it.
+	"""
+	def __init__(self):
+		self.goto = [{}]
+		self.fail = [0]
+		self.out = [[]]
+
+
+	def add(self, pattern, value):
+		state = 0
+		for c in pattern:
+			if c not in self.goto[state]:
+				self.goto.append({})
+				self.fail.append(0)
+				self.out.append([])
+				self.goto[state][c] = len(self.goto) - 1
+			state = self.goto[state][c]
+		self.out[state].append(value)
+
+
+	def build(self):
+		# breadth first, so the fail state of a state's parent is done before it
+		queue = deque(self.goto[0].values())
+		while queue:
+			state = queue.popleft()
+			for c, next_state in self.goto[state].items():
+				queue.append(next_state)
+				fail = self.fail[state]
+				while fail and c not in self.goto[fail]:
+					fail = self.fail[fail]
+				self.fail[next_state] = self.goto[fail].get(c, 0)
+				self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+
+	def search(self, text):
+		state = 0
+		for i, c in enumerate(text):
+			while state and c not in self.goto[state]:
+				state = self.fail[state]
+			state = self.goto[state].get(c, 0)
+			for value in self.out[state]:
+				yield i + 1, value
+
+
+
+class Gazetteer:
+	"""
+	Place names for the NUTS regions of a GeoHelper, up to its loaded levels,
+	plus those in file (TSV: place name, NUTS code; codes below the loaded levels are cut to them).
+	"""
+	def __init__(self, geo_helper, file=None, foreign_file=FOREIGN_FILE, ambiguous_file=AMBIGUOUS_FILE):
+		self.names = {}		# NUTS code -> region name
+		self.levels = {}	# NUTS code -> level
+		self.max_level = 0
+		for level in [1, 2, 3]:
+			gdf = getattr(geo_helper, 'gdf_level_{}'.format(level))
+			if gdf is not None:
+				for code, name in zip(gdf['CODE'], gdf['NAME']):
+					self.names[str(code)] = str(name)
+					self.levels[str(code)] = level
+				self.max_level = level
+
+		places = defaultdict(set)		# normalised name -> codes
+		for code, name in self.names.items():
+			for place in self.variants(name):
+				places[place].add(code)
+
+		if file is not None:
+			with open(file, encoding='utf-8') as f:
+				for line in f:
+					fields = line.rstrip('\n').split('\t')
+					if len(fields) >= 2 and fields[0].strip():
+						code = fields[1].strip()
+						if code not in self.names:
+							code = code[:self.max_level + 2]
+						if code in self.names:
+							places[normalise(fields[0])].add(code)
+
+		ambiguous = read_names(ambiguous_file) if ambiguous_file else set()
+
+		# values: (kind, pattern length, then for places: level, code, ambiguous)
+		self.automaton = Automaton()
+		dropped = 0
+		for place, codes in places.items():
+			code = self.common_region(codes)
+			if code is None:
+				dropped += 1
+				continue
+			self.automaton.add(place, ('place', len(place), self.levels[code], code, place in ambiguous))
+		for name in UK_SIGNALS:
+			self.automaton.add(normalise(name), ('uk', len(normalise(name))))
+		for name in (read_names(foreign_file) if foreign_file else []):
+			self.automaton.add(name, ('foreign', len(name)))
+		self.automaton.build()
+
+		logging.info("gazetteer built\t{} names\t{} ambiguous dropped\t{}".format(len(places) - dropped, dropped, file or '-'))
+
+
+	@staticmethod
+	def variants(name):
+		# the name, without any bracketed part ("North East (England)"), and the places in a combined name
+		# ("Hartlepool and Stockton-on-Tees")
+		variants = { normalise(name) }
+		name = re.sub(r'\(.*?\)', ' ', name)
+		variants.add(normalise(name))
+		for part in NAME_SEPARATORS.split(name):
+			if len(part.strip()) >= MIN_NAME_LENGTH:
+				variants.add(normalise(part))
+		return [ variant for variant in variants if len(variant.strip()) >= MIN_NAME_LENGTH ]
+
+
+	def common_region(self, codes):
+		if len(codes) == 1:
+			return next(iter(codes))
+		prefix = ''
+		for chars in zip(*codes):
+			if len(set(chars)) > 1:
+				break
+			prefix += chars[0]
+		return prefix if prefix in self.names else None
+
+
+	def match(self, location):
+		"""(NUTS level, [(code, name)] for levels 1 to 3) for the best place name in location, or None."""
+		return self.match_normalised(normalise(location))
+
+
+	def match_normalised(self, text):
+		"""As match, for a location already normalised."""
+		places = []
+		uk = []
+		foreign = []
+		for end, value in self.automaton.search(text):
+			# the span of the words, without the padding spaces (shared by adjacent names)
+			span = (end - value[1] + 1, end - 1)
+			if value[0] == 'place':
+				places.append((span, value))
+			elif value[0] == 'uk':
+				uk.append(span)
+			else:
+				foreign.append(span)
+		if not places:
+			return None
+
+		# a foreign name within a longer UK one (e.g. Ireland in Northern Ireland) doesn't count, nor the other way round
+		foreign = [ f for f in foreign if not any(_contains(s, f) for s in uk + [span for span, value in places]) ]
+		uk = [ u for u in uk if not any(_contains(f, u) for f in foreign) ]
+
+		# names followed by, or part of, a place outside the UK
+		places = [ value for span, value in places if not any(f[1] > span[0] for f in foreign) ]
+		if not places:
+			return None
+		# ambiguous names only with a UK signal or another name
+		if not uk and all(ambiguous for kind, length, level, code, ambiguous in places):
+			return None
+
+		level, length, code = max((level, length, code) for kind, length, level, code, ambiguous in places)
+		regions = [(None, None)] * 3
+		# NUTS codes are the country (UK), then one character per level
+		for prefix in [code[:3], code[:4], code]:
+			if prefix in self.levels:
+				regions[self.levels[prefix] - 1] = (prefix, self.names[prefix])
+		return level, regions
+
+
+
+def _contains(outer, inner):
+	return outer[0] <= inner[0] and inner[1] <= outer[1] and outer[1] - outer[0] > inner[1] - inner[0]
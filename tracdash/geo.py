@@ -1,7 +1,194 @@
 
+import json, math, hashlib
 import numpy as np
 import geopandas as gpd
-from shapely.geometry import Point
+from shapely.geometry import Point, box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+
+
+GRID_OUTSIDE = -1		# cell outside every region
+GRID_BOUNDARY = -2		# cell crossing a region boundary, its points get the exact test
+
+
+
+class GeoIndex:
+	"""
+	Point in polygon lookup over the regions of one NUTS level.
+	An STRtree gives the regions whose bounding box holds the point, which are then tested
+	with prepared geometries in gdf row order, so the first containing row wins as in search_geo.
+	"""
+	def __init__(self, gdf):
+		self.codes = [str(code) for code in gdf['CODE']]
+		self.names = [str(name) for name in gdf['NAME']]
+		
+		self.rows = []
+		self.geoms = []
+		for row, geom in enumerate(gdf['geometry']):
+			if geom is not None and not geom.is_empty:
+				self.rows.append(row)
+				self.geoms.append(geom)
+		
+		self.prepared = [prep(geom) for geom in self.geoms]
+		self.tree = STRtree(self.geoms)
+		# Shapely 1.x queries return the geometries themselves
+		self.positions = { id(geom): i for i, geom in enumerate(self.geoms) }
+		
+		self.grid = None
+	
+	
+	def digest(self, resolution):
+		# identifies the regions (by their geometries) and the cell size a grid was built for
+		h = hashlib.md5("{!r}\n".format(float(resolution)).encode('utf-8'))
+		for row, geom in zip(self.rows, self.geoms):
+			h.update("{}\t{}\n".format(row, self.codes[row]).encode('utf-8'))
+			h.update(geom.wkb)
+		return h.hexdigest()
+	
+	
+	def candidates(self, point):
+		res = self.tree.query(point)
+		if len(res) > 0 and not isinstance(res[0], (int, np.integer)):
+			return sorted(self.positions[id(geom)] for geom in res)
+		return sorted(int(i) for i in res)
+	
+	
+	def search(self, lng, lat):
+		if self.grid is not None:
+			row = self.grid.lookup(lng, lat)
+			if row >= 0:
+				return (self.codes[row], self.names[row])
+			if row == GRID_OUTSIDE:
+				return (None, None)
+		
+		point = Point(lng, lat)
+		for i in self.candidates(point):
+			if self.prepared[i].contains(point):
+				row = self.rows[i]
+				return (self.codes[row], self.names[row])
+		
+		return (None, None)
+	
+	
+	def search_batch(self, gdf, lngs, lats):
+		# one spatial join for all the points, keeping the first containing row for each as search does
+		if self.grid is not None:
+			# only the points in boundary cells are joined
+			found = [(None, None)] * len(lngs)
+			exact = []
+			for i, (lng, lat) in enumerate(zip(lngs, lats)):
+				row = self.grid.lookup(lng, lat)
+				if row >= 0:
+					found[i] = (self.codes[row], self.names[row])
+				elif row == GRID_BOUNDARY:
+					exact.append(i)
+			if exact:
+				for i, result in zip(exact, self.search_batch_exact(gdf, [lngs[i] for i in exact], [lats[i] for i in exact])):
+					found[i] = result
+			return found
+		
+		return self.search_batch_exact(gdf, lngs, lats)
+	
+	
+	def search_batch_exact(self, gdf, lngs, lats):
+		points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(lngs, lats), crs=gdf.crs)
+		regions = gdf[['geometry']].reset_index(drop=True)
+		try:
+			joined = gpd.sjoin(points, regions, how='inner', predicate='within')
+		except TypeError:
+			# geopandas < 0.10
+			joined = gpd.sjoin(points, regions, how='inner', op='within')
+		
+		found = [(None, None)] * len(points)
+		for i, row in joined['index_right'].groupby(level=0).min().items():
+			found[i] = (self.codes[row], self.names[row])
+		return found
+
+
+class GeoGrid:
+	"""
+	Raster over the bounds of one level's regions, resolution degrees (crs units) per cell.
+	A cell holds the gdf row of the region containing all of it, GRID_OUTSIDE if no region
+	touches it, or GRID_BOUNDARY; so only points in boundary cells need a polygon test.
+	Cells are a numpy array, saved as .npy and memory mapped when loaded.
+	"""
+	def __init__(self, cells, min_x, min_y, resolution):
+		self.cells = cells
+		self.min_x = min_x
+		self.min_y = min_y
+		self.resolution = resolution
+		self.n_rows, self.n_cols = cells.shape
+		self.max_x = min_x + self.n_cols * resolution
+		self.max_y = min_y + self.n_rows * resolution
+	
+	
+	def lookup(self, lng, lat):
+		# points outside the grid are outside every region (or on the edge of one, where contains is false)
+		if not (self.min_x <= lng < self.max_x and self.min_y <= lat < self.max_y):
+			return GRID_OUTSIDE
+		col = min(int((lng - self.min_x) / self.resolution), self.n_cols - 1)
+		row = min(int((lat - self.min_y) / self.resolution), self.n_rows - 1)
+		return int(self.cells[row, col])
+	
+	
+	@staticmethod
+	def build(index, bounds, resolution):
+		min_x, min_y, max_x, max_y = bounds
+		n_cols = max(1, int(math.ceil((max_x - min_x) / resolution)))
+		n_rows = max(1, int(math.ceil((max_y - min_y) / resolution)))
+		cells = np.full((n_rows, n_cols), GRID_OUTSIDE, dtype=np.int32)
+		
+		# cells are grown slightly, so a point rounded into a neighbouring cell is still covered by it
+		margin = resolution * 1e-6
+		for row in range(n_rows):
+			y = min_y + row * resolution
+			for col in range(n_cols):
+				x = min_x + col * resolution
+				cell = box(x - margin, y - margin, x + resolution + margin, y + resolution + margin)
+				# in row order, as search: an earlier region touching the cell could hold some of its points
+				for i in index.candidates(cell):
+					if index.prepared[i].contains_properly(cell):
+						cells[row, col] = index.rows[i]
+						break
+					if index.prepared[i].intersects(cell):
+						cells[row, col] = GRID_BOUNDARY
+						break
+		
+		return GeoGrid(cells, min_x, min_y, resolution)
+	
+	
+	def stats(self):
+		return {
+			'cells': int(self.cells.size),
+			'inside': int(np.count_nonzero(self.cells >= 0)),
+			'boundary': int(np.count_nonzero(self.cells == GRID_BOUNDARY))
+		}
+	
+	
+	def save(self, path, digest):
+		# the cells, and a json file of what is needed to use them
+		np.save(path + '.npy', self.cells)
+		with open(path + '.json', 'w') as f:
+			json.dump({
+				'min_x': self.min_x,
+				'min_y': self.min_y,
+				'resolution': self.resolution,
+				'digest': digest
+			}, f)
+	
+	
+	@staticmethod
+	def load(path, index, resolution=None):
+		# only for the regions of index, and at resolution if given
+		with open(path + '.json') as f:
+			meta = json.load(f)
+		if resolution is not None and meta['resolution'] != resolution:
+			raise ValueError("grid resolution {}, expected {}\t{}".format(meta['resolution'], resolution, path))
+		if meta['digest'] != index.digest(meta['resolution']):
+			raise ValueError("grid built from different regions\t{}".format(path))
+		cells = np.load(path + '.npy', mmap_mode='r')
+		return GeoGrid(cells, meta['min_x'], meta['min_y'], meta['resolution'])
 
 
 class GeoHelper:
@@ -10,20 +197,40 @@ class GeoHelper:
 		self.gdf_level_1 = gdf_1
 		self.gdf_level_2 = gdf_2
 		self.gdf_level_3 = gdf_3
+		
+		self.index_level_1 = GeoIndex(gdf_1) if gdf_1 is not None else None
+		self.index_level_2 = GeoIndex(gdf_2) if gdf_2 is not None else None
+		self.index_level_3 = GeoIndex(gdf_3) if gdf_3 is not None else None
 	
 	
 	def search_nuts_1(self, lng, lat):
-		return GeoHelper.search_geo(self.gdf_level_1, lng, lat, self.crs)
+		return GeoHelper.search_index(self.index_level_1, lng, lat)
 	
 	def search_nuts_2(self, lng, lat):
-		return GeoHelper.search_geo(self.gdf_level_2, lng, lat, self.crs)
+		return GeoHelper.search_index(self.index_level_2, lng, lat)
 	
 	def search_nuts_3(self, lng, lat):
-		return GeoHelper.search_geo(self.gdf_level_3, lng, lat, self.crs)
+		return GeoHelper.search_index(self.index_level_3, lng, lat)
+	
+	
+	def search_nuts_batch(self, level, lngs, lats):
+		"""(code, name) at a NUTS level for each of a batch of points, with one spatial join."""
+		index = getattr(self, 'index_level_{}'.format(level))
+		if index is None or len(lngs) == 0:
+			return [(None, None)] * len(lngs)
+		return index.search_batch(getattr(self, 'gdf_level_{}'.format(level)), lngs, lats)
+	
+	
+	@staticmethod
+	def search_index(index, lng, lat):
+		if index is not None:
+			return index.search(lng, lat)
+		return (None, None)
 	
 	
 	@staticmethod
 	def search_geo(gdf, lng, lat, crs):
+		# exhaustive search over every region, kept as the reference for GeoIndex
 		if gdf is not None:
 			target_series = gpd.GeoSeries([Point(lng, lat)] * gdf.shape[0], crs=crs)
 			res = gdf['geometry'].contains(target_series)
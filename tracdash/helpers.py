@@ -1,5 +1,5 @@
 
-import os, logging, re
+import os, logging, re, itertools, time, pickle
 from datetime import datetime
 import hashlib
 from pprint import pprint
@@ -7,6 +7,7 @@ from collections import Counter
 import html
 
 import geopandas as gpd
+import shapely.wkb
 
 from . import unicodetokeniser
 from . import geo
@@ -43,6 +44,40 @@ def counter_to_object_list(counter, key = 'key', val = 'val'):
 
 
 
+# tweet_kind names the combination of flags, e.g. 'rt', 'qt+re', or 'original' for none
+TWEET_KIND_FLAGS = ['rt', 'qt', 're']
+ORIGINAL_KIND = 'original'
+
+
+def tweet_kind(is_retweet, is_quote, is_reply):
+	kind = '+'.join(name for name, flag in zip(TWEET_KIND_FLAGS, [is_retweet, is_quote, is_reply]) if flag)
+	return kind or ORIGINAL_KIND
+
+
+def tweet_kinds(include_rt=False, include_qt=False, include_re=False):
+	# the kinds kept by the dashboard's retweet / quote / reply filter:
+	# originals, plus any kind with one of the included flags
+	kinds = []
+	for flags in itertools.product([False, True], repeat=3):
+		kind = tweet_kind(*flags)
+		is_retweet, is_quote, is_reply = flags
+		if kind == ORIGINAL_KIND or (is_retweet and include_rt) or (is_quote and include_qt) or (is_reply and include_re):
+			kinds.append(kind)
+	return kinds
+
+
+
+def pairs_to_object_list(pairs, key = 'key', val = 'val'):
+	list = []
+	for k, v in pairs:
+		list.append({
+			key: k,
+			val: v
+		})
+	return list
+
+
+
 ##########
 # text
 ##########
@@ -112,6 +147,17 @@ def include_link(link, tweet_id):
 	return True
 
 
+def link_status_id(link):
+	if not link:
+		return None
+	
+	m = TWEET_URL_REGEX.search(link)
+	if m:
+		return m.group(1)
+	
+	return None
+
+
 TWITTER_REGEX = re.compile(r'^\w+://(?:www\.)?twitter\.com')
 TWEET_URL_SUB_REGEX = re.compile(r'twitter\.com/.*/status/')
 OTHER_TWITTER_URL_SUB_REGEX = re.compile(r'twitter\.com/.*/(lists|events|broadcasts|moments|timelines)/')
@@ -191,46 +237,196 @@ NUTS_1_SHP_FILE = "NUTS_Level_1__January_2018__Boundaries.shp"
 NUTS_2_SHP_FILE = "NUTS_Level_2__January_2018__Boundaries.shp"
 NUTS_3_SHP_FILE = "NUTS_Level_3__January_2018__Boundaries.shp"
 
+NUTS_ARTEFACT_FILE = "NUTS_January_2018.geo.pickle"
+NUTS_ARTEFACT_VERSION = 2
+SHP_PARTS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+NUTS_GRID_FILE = "NUTS_Level_{}__January_2018.grid"		# .npy cells and .json metadata
+GRID_RESOLUTION = 0.01		# degrees, about 1km
+
+NUTS_COLUMNS = {
+	1: ('nuts118cd', 'nuts118nm'),
+	2: ('nuts218cd', 'nuts218nm'),
+	3: ('nuts318cd', 'nuts318nm')
+}
+
+
 def init_geo(geo_search_level, crs="EPSG:4326", shp_path=None,
 		level1=NUTS_1_SHP_FILE,
 		level2=NUTS_2_SHP_FILE,
-		level3=NUTS_3_SHP_FILE):
-	gdf_nuts_1 = None
-	gdf_nuts_2 = None
-	gdf_nuts_3 = None
+		level3=NUTS_3_SHP_FILE,
+		artefact=None, grid_path=None, grid_resolution=None):
+	"""
+	Boundaries for NUTS levels up to geo_search_level, from the artefact written by build_geo_artefact
+	if there is one (by default NUTS_ARTEFACT_FILE in shp_path) for the same crs and shape files, otherwise from
+	the shape files. An artefact is not used if the shape files in shp_path have changed since it was built
+	(by size and modification time); without the shape files it is used as it is.
+	Lookup grids written by build_geo_grids (in grid_path, by default shp_path) are used for the levels they
+	were built for, if the boundary geometries are the same (and the resolution is grid_resolution, if set).
+	"""
+	start_time = time.time()
+	gdfs = {}
+	source = None
 	
 	if not shp_path:
 		shp_path = os.path.join(os.path.dirname(__file__), "NUTS")
+	if artefact is None:
+		artefact = os.path.join(shp_path, NUTS_ARTEFACT_FILE)
 	
-	if geo_search_level >= 1:
+	if geo_search_level >= 1 and os.path.exists(artefact):
 		try:
-			gdf_nuts_1 = gpd.read_file( os.path.join(shp_path, level1) )
-			gdf_nuts_1.to_crs(crs=crs, inplace=True)
-			gdf_nuts_1.rename({'nuts118cd': 'CODE', 'nuts118nm': 'NAME'}, axis=1, inplace=True)
-			logging.info("Loaded shape file for NUTS Level 1")
+			gdfs = _load_geo_artefact(artefact, geo_search_level, crs, _shp_sources(shp_path, [level1, level2, level3]))
+			source = artefact
 		except:
-			logging.exception("Failed to load shape file for NUTS Level 1")
+			logging.exception("Failed to load NUTS artefact, using shape files\t{}".format(artefact))
 	
-	if geo_search_level >= 2:
-		try:
-			gdf_nuts_2 = gpd.read_file( os.path.join(shp_path, level2) )
-			gdf_nuts_2.to_crs(crs=crs, inplace=True)
-			gdf_nuts_2.rename({'nuts218cd': 'CODE', 'nuts218nm': 'NAME'}, axis=1, inplace=True)
-			logging.info("Loaded shape file for NUTS Level 2")
-		except:
-			logging.exception("Failed to load shape file for NUTS Level 2")
+	if source is None:
+		source = shp_path
+		for level, shp_file in [(1, level1), (2, level2), (3, level3)]:
+			if geo_search_level >= level:
+				try:
+					gdfs[level] = _read_nuts_shp(os.path.join(shp_path, shp_file), level, crs)
+					logging.info("Loaded shape file for NUTS Level {}".format(level))
+				except:
+					logging.exception("Failed to load shape file for NUTS Level {}".format(level))
 	
-	if geo_search_level >= 3:
-		try:
-			gdf_nuts_3 = gpd.read_file( os.path.join(shp_path, level3) )
-			gdf_nuts_3.to_crs(crs=crs, inplace=True)
-			gdf_nuts_3.rename({'nuts318cd': 'CODE', 'nuts318nm': 'NAME'}, axis=1, inplace=True)
-			logging.info("Loaded shape file for NUTS Level 3")
-		except:
-			logging.exception("Failed to load shape file for NUTS Level 3")
+	geohelper = geo.GeoHelper(crs, gdfs.get(1), gdfs.get(2), gdfs.get(3))
 	
-	geohelper = geo.GeoHelper(crs, gdf_nuts_1, gdf_nuts_2, gdf_nuts_3)
+	if grid_path is None:
+		grid_path = shp_path
+	for level in range(1, min(geo_search_level, 3) + 1):
+		index = getattr(geohelper, 'index_level_{}'.format(level))
+		if not grid_path or index is None:
+			continue
+		grid_file = os.path.join(grid_path, NUTS_GRID_FILE.format(level))
+		if os.path.exists(grid_file + '.npy'):
+			try:
+				index.grid = geo.GeoGrid.load(grid_file, index, grid_resolution)
+				logging.info("Loaded lookup grid for NUTS Level {}".format(level))
+			except:
+				logging.exception("Failed to load lookup grid for NUTS Level {}".format(level))
+	
+	logging.info("geo loaded\t{}\tlevel {}\t{:.2f}s".format(source, geo_search_level, time.time() - start_time))
 	return geohelper
+
+
+def _read_nuts_shp(path, level, crs):
+	gdf = gpd.read_file(path)
+	gdf.to_crs(crs=crs, inplace=True)
+	code, name = NUTS_COLUMNS[level]
+	gdf.rename({code: 'CODE', name: 'NAME'}, axis=1, inplace=True)
+	return gdf
+
+
+def _shp_sources(shp_path, shp_files):
+	# file -> (size, modification time) of the parts of the shape files there are, to tell what an artefact was built from
+	sources = {}
+	for shp_file in shp_files:
+		stem = os.path.splitext(os.path.join(shp_path, shp_file))[0]
+		for ext in SHP_PARTS:
+			if os.path.exists(stem + ext):
+				stat = os.stat(stem + ext)
+				sources[os.path.basename(stem + ext)] = (stat.st_size, int(stat.st_mtime))
+	return sources
+
+
+def build_geo_artefact(output_file=None, crs="EPSG:4326", shp_path=None, simplify_tolerance=0.0,
+		level1=NUTS_1_SHP_FILE,
+		level2=NUTS_2_SHP_FILE,
+		level3=NUTS_3_SHP_FILE):
+	"""
+	Write the boundaries of all three NUTS levels, reprojected to crs and optionally simplified
+	(tolerance in crs units, e.g. 0.0001 degrees is about 10m), to a pickle for init_geo to load
+	instead of the shape files: codes, names and WKB geometries per level, and the size and modification time
+	of the shape files, so init_geo can tell when they have changed.
+	The spatial indexes aren't stored, GeoHelper builds them on load in well under a millisecond per level.
+	Returns the artefact path (by default NUTS_ARTEFACT_FILE in shp_path).
+	"""
+	if not shp_path:
+		shp_path = os.path.join(os.path.dirname(__file__), "NUTS")
+	if output_file is None:
+		output_file = os.path.join(shp_path, NUTS_ARTEFACT_FILE)
+	
+	levels = {}
+	for level, shp_file in [(1, level1), (2, level2), (3, level3)]:
+		gdf = _read_nuts_shp(os.path.join(shp_path, shp_file), level, crs)
+		if simplify_tolerance:
+			gdf['geometry'] = gdf['geometry'].simplify(simplify_tolerance, preserve_topology=True)
+		
+		levels[level] = {
+			'codes': [str(code) for code in gdf['CODE']],
+			'names': [str(name) for name in gdf['NAME']],
+			'wkb': [geom.wkb if geom is not None else None for geom in gdf['geometry']]
+		}
+	
+	artefact = {
+		'version': NUTS_ARTEFACT_VERSION,
+		'crs': crs,
+		'simplify_tolerance': simplify_tolerance,
+		'levels': levels,
+		'sources': _shp_sources(shp_path, [level1, level2, level3])
+	}
+	with open(output_file + '.tmp', 'wb') as f:
+		pickle.dump(artefact, f, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(output_file + '.tmp', output_file)
+	
+	logging.info("NUTS artefact written\t{}\t{}\tsimplify {}\t{:.1f} MB".format(
+		output_file, crs, simplify_tolerance, os.path.getsize(output_file) / 1000000))
+	return output_file
+
+
+def build_geo_grids(resolution=GRID_RESOLUTION, crs="EPSG:4326", shp_path=None, artefact=None, grid_path=None):
+	"""
+	Write a lookup grid (see geo.GeoGrid) for each NUTS level, at resolution degrees (crs units) per cell,
+	from the boundaries init_geo loads; by default next to the shape files, where init_geo looks for them.
+	Build them again after rebuilding the artefact, grids for other boundaries are not used.
+	"""
+	# without loading existing grids, which would be used while building
+	geohelper = init_geo(3, crs=crs, shp_path=shp_path, artefact=artefact, grid_path=False)
+	
+	if not grid_path:
+		grid_path = shp_path or os.path.join(os.path.dirname(__file__), "NUTS")
+	
+	for level in [1, 2, 3]:
+		index = getattr(geohelper, 'index_level_{}'.format(level))
+		gdf = getattr(geohelper, 'gdf_level_{}'.format(level))
+		if index is None:
+			continue
+		
+		start_time = time.time()
+		grid = geo.GeoGrid.build(index, gdf.total_bounds, resolution)
+		grid_file = os.path.join(grid_path, NUTS_GRID_FILE.format(level))
+		grid.save(grid_file, index.digest(resolution))
+		
+		stats = grid.stats()
+		logging.info("lookup grid written\t{}\tlevel {}\t{} cells\t{:.1f}% inside\t{:.1f}% boundary\t{:.1f}s".format(
+			grid_file, level, stats['cells'], 100.0 * stats['inside'] / stats['cells'], 100.0 * stats['boundary'] / stats['cells'], time.time() - start_time))
+
+
+def _load_geo_artefact(path, geo_search_level, crs, sources):
+	with open(path, 'rb') as f:
+		artefact = pickle.load(f)
+	
+	if artefact.get('version') != NUTS_ARTEFACT_VERSION:
+		raise ValueError("artefact version {}, expected {}".format(artefact.get('version'), NUTS_ARTEFACT_VERSION))
+	if artefact['crs'] != crs:
+		raise ValueError("artefact crs {}, expected {}".format(artefact['crs'], crs))
+	if sources and sources != artefact['sources']:
+		changed = sorted(file for file in set(sources) | set(artefact['sources']) if sources.get(file) != artefact['sources'].get(file))
+		raise ValueError("artefact built from other shape files, rebuild it (build_geo.py)\t{}".format(", ".join(changed)))
+	
+	gdfs = {}
+	for level in range(1, min(geo_search_level, 3) + 1):
+		data = artefact['levels'][level]
+		gdfs[level] = gpd.GeoDataFrame({
+				'CODE': data['codes'],
+				'NAME': data['names']
+			},
+			geometry=[shapely.wkb.loads(b) if b is not None else None for b in data['wkb']],
+			crs=artefact['crs'])
+		logging.info("Loaded NUTS Level {} from artefact (simplify {})".format(level, artefact['simplify_tolerance']))
+	
+	return gdfs
 	
 
 
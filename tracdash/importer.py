@@ -1,14 +1,22 @@
 
-import json, re, logging, gzip, pytz
-import multiprocessing
+import sys, json, re, logging, gzip, pytz, time, math, hashlib
+import multiprocessing, multiprocessing.util, threading
 from datetime import datetime
 from pprint import pprint
 from collections import Counter, deque
+from copy import deepcopy
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, RoundRobinSelector
 
 from . import helpers
-from .exceptions import BulkInsertException
+from .cache import LRUCache
+from .progress import ProgressReporter, ProgressMonitor
+from .seekindex import open_source, SeekIndexWriter
+from .profiler import FileProfiler, profile_path, merge_profiles
+from .frequencies import FrequencyCounter, merge_frequency_tables
+from .rejects import RejectWriter, describe_error
+from .gazetteer import Gazetteer, normalise as normalise_location
+from .exceptions import BulkInsertException, IndexCreationException, ImportCancelledException
 from . import unicodetokeniser
 from . import stopwords, stopsources
 
@@ -16,25 +24,130 @@ from . import stopwords, stopsources
 
 MAX_DOCS_SIZE = 50000
 MAX_BODY_SIZE = int(100000000 / 4)
+ES_TIMEOUT = 60*60
+ES_MAXSIZE = 4				# connections kept per node by each worker client
+ES_SNIFFER_TIMEOUT = 60
+AUTO_TUNE_LINES = 20000
+AUTO_TUNE_POOL_LINES = 2000			# lines each worker transforms when timing pool sizes
+AUTO_TUNE_POOL_GAIN = 0.1			# throughput gain a doubled pool must give to be chosen
+AUTO_TUNE_BULKS_PER_NODE = 8		# concurrent bulks per ElasticSearch node before it is considered overloaded
+AUTO_TUNE_SYNC_RATIO = 0.1			# bulk time / transform time below which synchronous bulks are used
+AUTO_TUNE_INDEX_SUFFIX = "-auto-tune"	# scratch index for the calibration bulk, deleted after
+PROGRESS_INTERVAL = 60				# seconds
+BATCHES_PER_WORKER = 2				# line batches queued per worker when splitting files
+MAX_REJECT_RATE = 0.01				# share of lines a file may have rejected under the quarantine policy
+URL_CACHE_SIZE = 100000				# url entities cached per worker
+TEXT_CACHE_SIZE = 20000				# tokenised texts cached per worker
+PROFILE_CACHE_SIZE = 20000			# tokenised user descriptions cached per worker
+GEO_CACHE_SIZE = 100000				# region lookups cached per worker
+GAZETTEER_CACHE_SIZE = 100000		# profile location matches cached per worker, by location
 STOPWORDS = stopwords.STOPWORDS_EN
 STOPSOURCES = stopsources.STOPSOURCES
 
 _es_ips = None
 _index_name = None
 _pool_size = None
+_bulk_in_flight = 1
+_es_sniff = False
+_es = None
+_sender = None
+_progress_queue = None
+_progress_interval = None
+_progress = None
+_seek_index = False
+_url_cache_size = URL_CACHE_SIZE
+_url_cache = None
+_text_cache_size = TEXT_CACHE_SIZE
+_text_cache = None
+_profile_cache_size = PROFILE_CACHE_SIZE
+_profile_cache = None
+_geo_cache_size = GEO_CACHE_SIZE
+_geo_cache_precision = None
+_geo_cache = None
+_geo_batch = False
+_geo_pending = []		# (doc, lng, lat, nuts level, place id) waiting for batch region assignment
+_gazetteer = None
+_gazetteer_cache_size = GAZETTEER_CACHE_SIZE
+_gazetteer_cache = None
+_caches = {}
+_profile_run = None
+_profile_tweets = None
+_index_profile = 'default'
+_frequency_dir = None
+_error_policy = 'fail'
+_sample_modulo = None
+_batch_lines = None
+_batch_ordered = False
+_batch_abort = None		# set while the batches queued for a failed file are skipped
+_cancel_file = None		# threading.Event, set to abandon the file being imported (e.g. its queue lease was lost)
+_max_reject_rate = MAX_REJECT_RATE
 _geo_helper = None
 _geo_search_level = 0
+_auto_tune_lines = []
 
 
 
-def import_files(files, es_ips, index_name, pool_size = 16, geo_level = 0):
+def import_files(files, es_ips, index_name, pool_size = 16, geo_level = 0, bulk_in_flight = 1, es_sniff = False, auto_tune = False,
+		progress_interval = PROGRESS_INTERVAL, status_file = None, seek_index = False,
+		url_cache_size = URL_CACHE_SIZE, text_cache_size = TEXT_CACHE_SIZE, profile_cache_size = PROFILE_CACHE_SIZE,
+		profile = False, profile_tweets = None, index_profile = 'default', frequency_dir = None,
+		error_policy = 'fail', max_reject_rate = MAX_REJECT_RATE, sample_modulo = None,
+		batch_lines = None, batch_ordered = False, geo_cache_size = GEO_CACHE_SIZE, geo_cache_precision = None,
+		geo_batch = False, gazetteer = False, gazetteer_file = None, gazetteer_cache_size = GAZETTEER_CACHE_SIZE):
 	"""
 	Take a list of paths to jsonl.gz files for import,
 	along with a list of ElasticSearch ip:port locations
 	and the name of the ElasticSearch index to update.
 	Files are processed in parallel using a pool of size pool_size.
+	If bulk_in_flight is greater than 1, each worker keeps up to that many bulk requests in flight
+	(spread across es_ips) using an asyncio transport, rather than waiting for each bulk in turn.
+	Each worker process keeps one ElasticSearch client for all the files it handles,
+	balancing requests round robin across es_ips (and nodes found by sniffing if es_sniff is set).
+	If auto_tune is set, pool_size and bulk_in_flight are chosen by a short calibration on the first
+	AUTO_TUNE_LINES lines: transform throughput for doubling pool sizes up to the number of cores, and
+	bulk latency, measured on a scratch index deleted afterwards; the chosen values are logged.
+	Every progress_interval seconds workers report compressed bytes read, tweets processed and docs indexed,
+	and the overall rate and ETA are logged (and written as JSON to status_file if set).
+	Set progress_interval to None to turn progress reporting off.
+	If seek_index is set, sidecar seek indexes are written next to each file for random access
+	to individual tweets (see seekindex.lookup_tweets).
+	Each worker caches up to url_cache_size processed url entities (websites, anonymised links,
+	title and description tokens), as the same links appear in many tweets; 0 turns the cache off.
+	Likewise up to text_cache_size tokenised texts (anonymised text, tokens and n-grams) are cached
+	by a digest of the text, as retweets repeat the same text many times,
+	and up to profile_cache_size tokenised profile descriptions by (user, digest of the description).
+	Cache hit rates are logged per file.
+	If profile is set, each file is profiled (cProfile) in its worker, for the whole file or only
+	the first profile_tweets lines; profiles are written next to the log and merged into one
+	hot function report (tottime and cumulative) when the import finishes.
+	index_profile selects the mapping used if the index is created (see INDEX_PROFILES):
+	'default', or 'aggregation' tuned for the dashboard's aggregations.
+	If frequency_dir is set, workers also count per-day doc frequencies of types, hashtags, websites
+	and tweet kinds, merged into tables in frequency_dir when the import finishes (see frequencies).
+	error_policy decides what happens to a line that can't be parsed or processed:
+	'fail' stops the file, 'quarantine' writes it to a reject file next to the log and carries on,
+	only failing the file if more than max_reject_rate of its lines are rejected (see rejects).
+	If sample_modulo is set, only lines whose tweet_id hashes to 0 modulo sample_modulo are imported
+	(with their embedded retweets and quotes), e.g. 1000, 100 and 10 for 0.1%, 1% and 10% samples.
+	The hash is stable, so the same tweets are kept on every run.
+	If batch_lines is set, files are read one at a time and streamed in batches of batch_lines lines
+	to the pool, so a single very large file uses every worker; at most BATCHES_PER_WORKER batches per
+	worker are queued at once. Workers insert their own batches, in any order; with batch_ordered set
+	they return the bulk bodies and these are inserted in file order, so duplicate tweets end as in
+	a whole-file import. If a batch fails, the file's batches still queued are skipped and those being
+	processed are waited for, so nothing more of the file is indexed once it is reported as failed.
+	seek_index, frequency_dir and profile only apply to whole-file import.
 	Geo boundary processing (i.e. assigning regions to tweets) is turned on if geo_level is set 
 	(values 1, 2 or 3; corresponding to NUTS levels).
+	Region lookups are cached per worker (up to geo_cache_size), by place id for coordinates taken from
+	a place, otherwise by coordinates; if geo_cache_precision is set, coordinates are rounded to that
+	many decimal places (e.g. 3 for about 100m) and the rounded point is looked up.
+	With geo_batch, regions are not looked up tweet by tweet but for each batch of docs before
+	it is inserted, with one spatial join per NUTS level (needs rtree for geopandas' spatial index).
+	With gazetteer set, tweets without coordinates, a place or a derived profile location are given the
+	regions of the place names found in the user's free-text profile location (geo_source 'profile_location'),
+	matched against the NUTS region names and those in gazetteer_file (see gazetteer.Gazetteer);
+	matches are cached per worker by normalised location (up to gazetteer_cache_size).
 	
 	First the index is created to ensure the correct type for each field.
 	Then files are processed in parallel.
@@ -43,82 +156,656 @@ def import_files(files, es_ips, index_name, pool_size = 16, geo_level = 0):
 	ElasticSearch bulk called when body size reaches MAX_BODY_SIZE
 	Duplicate tweets (with identical IDs) overwrite tweets in the ElasticSearch database.
 	"""
-	global _es_ips, _index_name, _pool_size, _geo_helper, _geo_search_level
+	global _pool_size, _bulk_in_flight, _progress_queue, _progress_interval, _batch_abort
+	
+	_configure(es_ips, index_name, pool_size = pool_size, geo_level = geo_level, bulk_in_flight = bulk_in_flight,
+		es_sniff = es_sniff, seek_index = seek_index, url_cache_size = url_cache_size, text_cache_size = text_cache_size,
+		profile_cache_size = profile_cache_size, profile = profile, profile_tweets = profile_tweets,
+		index_profile = index_profile, frequency_dir = frequency_dir, error_policy = error_policy,
+		max_reject_rate = max_reject_rate, sample_modulo = sample_modulo, batch_lines = batch_lines,
+		batch_ordered = batch_ordered, geo_cache_size = geo_cache_size, geo_cache_precision = geo_cache_precision,
+		geo_batch = geo_batch, gazetteer = gazetteer, gazetteer_file = gazetteer_file, gazetteer_cache_size = gazetteer_cache_size)
+	
+	logging.info("creating index")
+	_create_index()
+	logging.info("index created")
+	
+	if auto_tune:
+		try:
+			_pool_size, _bulk_in_flight = _auto_tune(files)
+		except:
+			logging.exception("auto tune failed, keeping pool_size {} bulk_in_flight {}".format(_pool_size, _bulk_in_flight))
+	
+	logging.info("starting import")
+	
+	context = multiprocessing.get_context('fork')
+	
+	monitor = None
+	_progress_interval = progress_interval
+	if _progress_interval:
+		_progress_queue = context.Queue()
+		monitor = ProgressMonitor(_progress_queue, files, _progress_interval, status_file=status_file)
+	
+	# inherited by the workers
+	_batch_abort = context.Event() if _batch_lines else None
+	
+	with context.Pool(_pool_size, initializer=_init_worker) as pool:
+		if _batch_lines:
+			result = [ _import_file_batched(pool, file, monitor) for file in files ]
+			if monitor is not None:
+				monitor.report()
+		elif monitor is None:
+			result = pool.map(_process_file, files)
+		else:
+			async_result = pool.map_async(_process_file, files)
+			while not async_result.ready():
+				monitor.poll(_progress_interval, async_result.ready)
+			result = async_result.get()
+			monitor.drain()
+			monitor.report()
+		
+		# let the workers exit, closing their bulk senders, before the pool is terminated
+		pool.close()
+		pool.join()
+	
+	if _profile_run is not None:
+		merge_profiles(_profile_run)
+	
+	if _frequency_dir is not None:
+		merge_frequency_tables(_frequency_dir)
+
+	logging.info("import finished\n{}".format( "\n".join(result) ))
+
+
+
+def _configure(es_ips, index_name, pool_size = 16, geo_level = 0, bulk_in_flight = 1, es_sniff = False, seek_index = False,
+		url_cache_size = URL_CACHE_SIZE, text_cache_size = TEXT_CACHE_SIZE, profile_cache_size = PROFILE_CACHE_SIZE,
+		profile = False, profile_tweets = None, index_profile = 'default', frequency_dir = None,
+		error_policy = 'fail', max_reject_rate = MAX_REJECT_RATE, sample_modulo = None,
+		batch_lines = None, batch_ordered = False, geo_cache_size = GEO_CACHE_SIZE, geo_cache_precision = None,
+		geo_batch = False, gazetteer = False, gazetteer_file = None, gazetteer_cache_size = GAZETTEER_CACHE_SIZE):
+	# the import options (see import_files), set before the pool is forked so the workers inherit them;
+	# shared with workqueue.import_queue so both import alike
+	global _es_ips, _index_name, _pool_size, _bulk_in_flight, _es_sniff, _seek_index, _url_cache_size, _text_cache_size, _profile_cache_size, _profile_run, _profile_tweets, _index_profile, _frequency_dir, _error_policy, _max_reject_rate, _sample_modulo, _batch_lines, _batch_ordered, _geo_cache_size, _geo_cache_precision, _geo_batch, _gazetteer, _gazetteer_cache_size, _geo_helper, _geo_search_level
 	
 	helpers.init_tokeniser()
 	
 	_geo_search_level = geo_level
 	_geo_helper = helpers.init_geo(_geo_search_level)
 	
+	_gazetteer = None
+	if gazetteer and _geo_search_level > 0:
+		_gazetteer = Gazetteer(_geo_helper, gazetteer_file)
+	_gazetteer_cache_size = gazetteer_cache_size
+	
 	_es_ips = es_ips
 	_index_name = index_name
 	_pool_size = pool_size
+	_bulk_in_flight = bulk_in_flight
+	_es_sniff = es_sniff
+	_seek_index = seek_index
+	_url_cache_size = url_cache_size
+	_text_cache_size = text_cache_size
+	_profile_cache_size = profile_cache_size
+	_profile_run = None
+	_profile_tweets = profile_tweets
+	_index_profile = index_profile
+	_frequency_dir = frequency_dir
+	_error_policy = error_policy
+	_max_reject_rate = max_reject_rate
+	_sample_modulo = sample_modulo
+	_batch_lines = batch_lines
+	_batch_ordered = batch_ordered
+	_geo_cache_size = geo_cache_size
+	_geo_cache_precision = geo_cache_precision
+	_geo_batch = geo_batch
 	
-	logging.info("creating index")
-	_create_index()
-	logging.info("index created")
+	if _error_policy not in ['fail', 'quarantine']:
+		raise ValueError("unknown error_policy: {}".format(_error_policy))
+	if _batch_lines and (_seek_index or _frequency_dir or profile):
+		logging.warning("seek_index, frequency_dir and profile ignored with batch_lines")
+		_seek_index = False
+		_frequency_dir = None
+		profile = False
+	if profile:
+		_profile_run = datetime.now().strftime("%Y_%m_%d-%H_%M_%S")
+
+
+
+def _auto_tune(files):
+	logging.info("auto tune\tcalibrating")
 	
-	logging.info("starting import")
+	global _auto_tune_lines
+	
+	docs = []
+	lines = []
+	transform_time = 0.0
+	
+	for file in files:
+		with gzip.open(file) as f:
+			for line in f:
+				line = line.strip()
+				if line:
+					start = time.perf_counter()
+					_process_line(line, docs, _geo_batch)
+					transform_time += time.perf_counter() - start
+					lines.append(line)
+				if len(lines) >= AUTO_TUNE_LINES:
+					break
+		if len(lines) >= AUTO_TUNE_LINES:
+			break
+	
+	# with geo_batch, regions are looked up per batch rather than per line
+	start = time.perf_counter()
+	_assign_nuts_regions()
+	transform_time += time.perf_counter() - start
+	
+	if len(docs) == 0:
+		logging.warning("auto tune\tno documents, keeping pool_size {} bulk_in_flight {}".format(_pool_size, _bulk_in_flight))
+		return _pool_size, _bulk_in_flight
+	
+	# the calibration docs go to a scratch index with the same mapping, not the one being imported to
+	n_docs = len(docs)
+	es = _create_client()
+	tune_index = _index_name + AUTO_TUNE_INDEX_SUFFIX
+	es.indices.create(index=tune_index, body=INDEX_PROFILES[_index_profile], ignore=400)
+	try:
+		start = time.perf_counter()
+		for body in _bulk_bodies(docs):
+			res = es.bulk(index=tune_index, body=body)
+			if res['errors']:
+				logging.warning("auto tune\tbulk errors")
+		bulk_time = time.perf_counter() - start
+	finally:
+		es.indices.delete(index=tune_index, ignore=[400, 404])
 	
-	with multiprocessing.get_context('fork').Pool(_pool_size) as pool:
-		result = pool.map(_process_file, files)
+	docs_rate = n_docs / max(transform_time, 0.000001)
+	bulk_ratio = bulk_time / max(transform_time, 0.000001)		# bulk time per unit of transform time, for any batch size
+	
+	logging.info("auto tune\ttransform {} lines {} docs in {:.2f}s ({:.1f} docs/s per worker)\tbulk {:.2f}s ({:.1f} docs/s)".format(
+		len(lines), n_docs, transform_time, docs_rate, bulk_time, n_docs / max(bulk_time, 0.000001)))
+	
+	# transform is CPU bound, but how well it scales depends on the cores (and memory bandwidth) free:
+	# double the pool while that still raises throughput enough, up to the cores (and files, unless batched)
+	max_pool = multiprocessing.cpu_count()
+	if not _batch_lines:
+		max_pool = min(max_pool, len(files))
+	_auto_tune_lines = lines[:AUTO_TUNE_POOL_LINES]
+	pool_size = 1
+	best_rate = _auto_tune_pool_rate(1)
+	size = 1
+	while size < max_pool:
+		size = min(size * 2, max_pool)
+		rate = _auto_tune_pool_rate(size)
+		if rate < best_rate * (1 + AUTO_TUNE_POOL_GAIN):
+			break
+		pool_size, best_rate = size, rate
+	_auto_tune_lines = []
+	
+	# enough bulks in flight per worker that a worker never waits on ElasticSearch
+	bulk_in_flight = 1
+	if bulk_ratio >= AUTO_TUNE_SYNC_RATIO:
+		bulk_in_flight = 1 + math.ceil(bulk_ratio)
+	
+	# without overloading ElasticSearch: past the limit, extra workers would only wait on bulks
+	max_bulks = AUTO_TUNE_BULKS_PER_NODE * len(_es_ips)
+	if pool_size * bulk_ratio > max_bulks:
+		pool_size = max(1, min(pool_size, int(max_bulks / bulk_ratio)))
+	if pool_size * bulk_in_flight > max_bulks:
+		bulk_in_flight = max(1, max_bulks // pool_size)
+	
+	logging.info("auto tune\tpool_size {}\tbulk_in_flight {}".format(pool_size, bulk_in_flight))
+	
+	return pool_size, bulk_in_flight
 
-	logging.info("import finished\n{}".format( "\n".join(result) ))
+
+
+def _auto_tune_pool_rate(size):
+	# lines per second transformed by a pool of size workers, each transforming the calibration lines
+	with multiprocessing.get_context('fork').Pool(size, initializer=_init_caches) as pool:
+		start = time.perf_counter()
+		pool.map(_auto_tune_transform, range(size), chunksize=1)
+		elapsed = time.perf_counter() - start
+	
+	rate = size * len(_auto_tune_lines) / max(elapsed, 0.000001)
+	logging.info("auto tune\tpool {}\t{:.1f} lines/s".format(size, rate))
+	return rate
+
+
+
+def _auto_tune_transform(n):
+	docs = []
+	for line in _auto_tune_lines:
+		_process_line(line, docs, _geo_batch)
+	_assign_nuts_regions()
+	return len(docs)
+
+
+
+def _es_options():
+	options = {
+		'maxsize': ES_MAXSIZE,
+		'selector_class': RoundRobinSelector,
+	}
+	if _es_sniff:
+		options['sniff_on_start'] = True
+		options['sniff_on_connection_fail'] = True
+		options['sniffer_timeout'] = ES_SNIFFER_TIMEOUT
+	return options
+
+
+def _create_client():
+	return Elasticsearch(_es_ips, timeout=ES_TIMEOUT, **_es_options())
+
+
+def _init_worker():
+	# pool initializer: one long-lived client (and bulk sender) per worker process
+	global _es, _sender, _progress
+	
+	_es = None
+	_sender = None
+	
+	_progress = None
+	if _progress_queue is not None:
+		_progress = ProgressReporter(_progress_queue, _progress_interval)
+	
+	_init_caches()
+	
+	try:
+		_es = _create_client()
+		if _bulk_in_flight > 1:
+			from .bulk import AsyncBulkSender		# requires aiohttp
+			options = _es_options()
+			del options['maxsize']
+			_sender = AsyncBulkSender(_es_ips, _index_name, max_in_flight=_bulk_in_flight, timeout=ES_TIMEOUT, **options)
+			# run when the worker exits normally, i.e. the pool is closed and joined rather than terminated
+			multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+	except:
+		# don't raise, or the pool will keep replacing the worker
+		logging.exception("elasticsearch error\tworker init")
+
+
+
+def _close_worker():
+	# flush and close the bulk sender, so no request in flight is dropped and its session is closed
+	global _sender
+	
+	if _sender is not None:
+		try:
+			_sender.close()
+		except:
+			logging.exception("elasticsearch error\tworker exit")
+		_sender = None
+
+
+
+def _init_caches():
+	global _url_cache, _text_cache, _profile_cache, _geo_cache, _gazetteer_cache
+	
+	_caches.clear()
+	
+	_url_cache = None
+	if _url_cache_size > 0:
+		_url_cache = _caches['url'] = LRUCache(_url_cache_size)
+	
+	_text_cache = None
+	if _text_cache_size > 0:
+		_text_cache = _caches['text'] = LRUCache(_text_cache_size)
+	
+	_profile_cache = None
+	if _profile_cache_size > 0:
+		_profile_cache = _caches['profile'] = LRUCache(_profile_cache_size)
+	
+	_geo_cache = None
+	if _geo_cache_size > 0 and _geo_search_level > 0:
+		_geo_cache = _caches['geo'] = LRUCache(_geo_cache_size)
+	
+	_gazetteer_cache = None
+	if _gazetteer_cache_size > 0 and _gazetteer is not None:
+		_gazetteer_cache = _caches['gazetteer'] = LRUCache(_gazetteer_cache_size)
 
 
 
 def _process_file(file):
+	if _profile_run is None:
+		return _import_file(file)
+	
+	profiler = FileProfiler(profile_path(_profile_run, file), _profile_tweets)
+	profiler.start()
+	try:
+		return _import_file(file, profiler)
+	finally:
+		profiler.write()
+
+
+
+def _import_file(file, profiler=None):
 	logging.info("starting file\t{}".format(file))
 	
-	es = None
+	es = _es
+	sender = _sender
+	progress = _progress
+	seek_index = None
+	frequencies = None
+	rejects = None
+	offset = 0
 	docs = []
 	insert_count = 0
 	tweet_count = 0
+	line_count = 0
+	start_time = time.time()
 	
-	try:
-		es = Elasticsearch(_es_ips, timeout=(60*60))
-	except:
-		logging.exception("elasticsearch error\t{}".format(file))
+	for cache in _caches.values():
+		cache.reset_stats()
+	
+	# left over from a failed file
+	del _geo_pending[:]
+	
+	# with the sender, docs are counted for progress as its requests complete, rather than when it's flushed
+	sender_start = sender.sent if sender is not None else 0
+	
+	if es is None:
+		logging.error("elasticsearch error\t{}".format(file))
+		if progress is not None:
+			progress.update(file, 0, 0, 0, finished=True)
 		return "! " + file
 	
 	try:
-		with gzip.open(file) as f:
+		# the raw file position gives the compressed bytes consumed for progress reporting
+		if _seek_index:
+			seek_index = SeekIndexWriter(file)
+		
+		if _frequency_dir is not None:
+			frequencies = FrequencyCounter()
+		
+		if _error_policy == 'quarantine':
+			rejects = RejectWriter(file, _max_reject_rate)
+		
+		with open(file, 'rb') as raw, open_source(file, raw, build_index=_seek_index) as f:
 			for line in f:
+				if _cancel_file is not None and _cancel_file.is_set():
+					raise ImportCancelledException("import cancelled")
+				length = len(line)
 				line = line.strip()
 				if line:
+					n_docs = len(docs)
 					try:
-						tweet = json.loads(line)
-					except:
-						logging.exception("json parse error\t{}".format(line))
-						raise
-				
-					if 'info' in tweet and 'activity_count' in tweet['info']:
-						continue
+						_process_line(line, docs, _geo_batch)
+					except Exception as e:
+						if rejects is None:
+							raise
+						# drop any docs from the line (e.g. an embedded retweet processed before the error)
+						del docs[n_docs:]
+						rejects.add(offset, line, e)
+					line_count += 1
+					
+					if rejects is not None:
+						rejects.check(line_count)
+					
+					if profiler is not None:
+						profiler.tick(line_count)
 					
-					if 'lang' in tweet and tweet['lang'] == 'en':				
-						_process_tweet(tweet, docs)
-					else:
-						logging.warning("no lang field\t{}".format(line))
+					if seek_index is not None:
+						for doc in docs[n_docs:]:
+							seek_index.add(doc['tweet_id'], offset, length)
+					
+					if frequencies is not None:
+						for doc in docs[n_docs:]:
+							frequencies.add(doc)
 					
 					if len(docs) > MAX_DOCS_SIZE:
 						insert_count += 1
-						tweet_count += _insert_docs(es, docs, file, insert_count)
+						tweet_count += _insert_docs(es, docs, file, insert_count, sender)
+					
+					if progress is not None:
+						progress.update(file, raw.tell(), line_count, tweet_count if sender is None else sender.sent - sender_start)
+				
+				offset += length
 					
 		
+			if rejects is not None:
+				rejects.check(line_count, final=True)
+			
 			if len(docs) > 0:
-				tweet_count += _insert_docs(es, docs, file, 0)
+				tweet_count += _insert_docs(es, docs, file, 0, sender)
+			
+			if sender is not None:
+				tweet_count += sender.flush()
+			
+			if seek_index is not None:
+				seek_index.write(f)
+			
+			if frequencies is not None:
+				frequencies.write(_frequency_dir, file)
+	
+	except:
+		logging.exception("file error\t{}".format(file))
+		if rejects is not None:
+			rejects.close()
+		if sender is not None:
+			# a cancelled file's bulks may now be another worker's to send
+			if isinstance(sys.exc_info()[1], ImportCancelledException):
+				sender.cancel()
+			else:
+				sender.discard()
+		if progress is not None:
+			progress.update(file, 0, line_count, tweet_count, finished=True)
+		return "! " + file
+	
+	if progress is not None:
+		progress.update(file, 0, line_count, tweet_count, finished=True)
+	
+	if rejects is not None:
+		rejects.close()
+	
+	if _caches:
+		logging.info("cache hits\t{}\t{}".format(file, "\t".join( "{} {}".format(name, cache.stats()) for name, cache in _caches.items() )))
+	
+	elapsed = time.time() - start_time
+	logging.info("file finished\t{}\t{}\t{:.1f}s\t{:.1f} docs/s".format(file, tweet_count, elapsed, tweet_count / max(elapsed, 0.001)))
+	
+	return "+ " + file
+
+
+
+def _import_file_batched(pool, file, monitor=None):
+	# the reader (this process) streams batches of lines to the pool, at most BATCHES_PER_WORKER per worker
+	# queued at once, as the pool takes tasks from the iterator as fast as it can
+	logging.info("starting file\t{}".format(file))
+	
+	in_flight = threading.Semaphore(_pool_size * BATCHES_PER_WORKER)
+	stop = threading.Event()
+	bytes_read = [0]
+	
+	es = None
+	rejects = None
+	results = None
+	line_count = 0
+	tweet_count = 0
+	cache_stats = {}
+	start_time = time.time()
+	
+	def batches():
+		with open(file, 'rb') as raw, gzip.GzipFile(fileobj=raw) as f:
+			batch = []
+			batch_num = 0
+			offset = 0
+			for line in f:
+				length = len(line)
+				line = line.strip()
+				if line:
+					batch.append((offset, line))
+				offset += length
+				
+				if len(batch) >= _batch_lines:
+					in_flight.acquire()
+					if stop.is_set():
+						return
+					batch_num += 1
+					bytes_read[0] = raw.tell()
+					yield file, batch_num, batch
+					batch = []
+			
+			if batch:
+				in_flight.acquire()
+				if stop.is_set():
+					return
+				bytes_read[0] = raw.tell()
+				yield file, 0, batch
+	
+	try:
+		if _batch_ordered:
+			es = _create_client()
+		if _error_policy == 'quarantine':
+			rejects = RejectWriter(file, _max_reject_rate)
+		
+		results = pool.imap(_process_batch, batches()) if _batch_ordered else pool.imap_unordered(_process_batch, batches())
+		for batch_num, lines, count, bodies, rejected, batch_cache_stats in results:
+			in_flight.release()
+			
+			for name, (hits, misses) in batch_cache_stats.items():
+				total_hits, total_misses = cache_stats.get(name, (0, 0))
+				cache_stats[name] = (total_hits + hits, total_misses + misses)
+			
+			for n, body in enumerate(bodies):
+				count += _insert_bulk(es, body, file, "{}.{}".format(batch_num, n))
+			
+			line_count += lines
+			tweet_count += count
+			
+			if rejects is not None:
+				for offset, line, error in rejected:
+					rejects.add(offset, line, error)
+				rejects.check(line_count)
+			
+			if monitor is not None:
+				monitor.update((file, bytes_read[0], line_count, tweet_count, False))
+		
+		if rejects is not None:
+			rejects.check(line_count, final=True)
 	
 	except:
 		logging.exception("file error\t{}".format(file))
+		# let the reader finish, so the pool's task feeder isn't left blocked, and have the workers skip
+		# the batches already queued, waiting for them so none is indexed after the file is reported
+		stop.set()
+		_batch_abort.set()
+		for i in range(_pool_size * BATCHES_PER_WORKER + 1):
+			in_flight.release()
+		if results is not None:
+			_drain(results)
+		_batch_abort.clear()
+		if rejects is not None:
+			rejects.close()
+		if monitor is not None:
+			monitor.update((file, 0, line_count, tweet_count, True))
 		return "! " + file
 	
-	logging.info("file finished\t{}\t{}".format(file, tweet_count))
+	if rejects is not None:
+		rejects.close()
+	
+	if monitor is not None:
+		monitor.update((file, 0, line_count, tweet_count, True))
+	
+	if cache_stats:
+		logging.info("cache hits\t{}\t{}".format(file, "\t".join( "{} {:.1f}% ({}/{})".format(name, 100.0 * hits / max(hits + misses, 1), hits, hits + misses) for name, (hits, misses) in cache_stats.items() )))
+	
+	elapsed = time.time() - start_time
+	logging.info("file finished\t{}\t{}\t{:.1f}s\t{:.1f} docs/s".format(file, tweet_count, elapsed, tweet_count / max(elapsed, 0.001)))
 	
 	return "+ " + file
 
 
 
-def _process_tweet(tweet, docs):
+def _drain(results):
+	while True:
+		try:
+			next(results)
+		except StopIteration:
+			return
+		except Exception:
+			pass
+
+
+
+def _process_batch(batch):
+	file, batch_num, lines = batch
+	
+	docs = []
+	rejected = []
+	count = 0
+	bodies = []
+	
+	if _batch_abort is not None and _batch_abort.is_set():
+		return batch_num, 0, 0, [], [], {}
+	
+	# progress isn't sent to _progress_queue from here: the reader records it as each batch result comes back
+	for cache in _caches.values():
+		cache.reset_stats()
+	
+	# left over from a failed batch
+	del _geo_pending[:]
+	
+	for offset, line in lines:
+		n_docs = len(docs)
+		try:
+			_process_line(line, docs, _geo_batch)
+		except Exception as e:
+			if _error_policy != 'quarantine':
+				raise
+			del docs[n_docs:]
+			rejected.append((offset, line, describe_error(e)))
+	
+	_assign_nuts_regions()
+	
+	if _batch_abort is not None and _batch_abort.is_set():
+		return batch_num, 0, 0, [], [], {}
+	
+	if _batch_ordered:
+		# inserted by the reader, in file order
+		bodies = list(_bulk_bodies(docs))
+	elif len(docs) > 0:
+		count = _insert_docs(_es, docs, file, batch_num, _sender)
+		if _sender is not None:
+			count += _sender.flush()
+	
+	cache_stats = { name: (cache.hits, cache.misses) for name, cache in _caches.items() }
+	
+	return batch_num, len(lines), count, bodies, rejected, cache_stats
+
+
+
+def _process_line(line, docs, geo_batch=False):
+	# with geo_batch, the caller must call _assign_nuts_regions before using the docs
+	try:
+		tweet = json.loads(line)
+	except:
+		logging.exception("json parse error\t{}".format(line))
+		raise
+	
+	if 'info' in tweet and 'activity_count' in tweet['info']:
+		return
+	
+	if _sample_modulo and not in_sample(tweet.get('id_str'), _sample_modulo):
+		return
+	
+	if 'lang' in tweet and tweet['lang'] == 'en':
+		_process_tweet(tweet, docs, geo_batch)
+	else:
+		logging.warning("no lang field\t{}".format(line))
+
+
+
+def in_sample(tweet_id, modulo):
+	# md5 rather than hash(), which is salted per process
+	if tweet_id is None:
+		return False
+	digest = hashlib.md5(tweet_id.encode('utf-8')).digest()
+	return int.from_bytes(digest[:8], 'little') % modulo == 0
+
+
+
+def _process_tweet(tweet, docs, geo_batch=False):
 	try:
 		# this really should be split into separate functions
 		# but parts of the process depend on prior processed data from the tweet
@@ -129,15 +816,16 @@ def _process_tweet(tweet, docs):
 		
 		anon_text = ""
 		computed_text = ""
-		types = Counter()
-		unfiltered_types = Counter()
-		bi_grams = Counter()
-		tri_grams = Counter()
+		types = []
+		unfiltered_types = []
+		bi_grams = []
+		tri_grams = []
+		unfiltered_type_counts = []
 		
 		username = '-'
 		anon_profile = ""
-		profile_types = Counter()
-		unfiltered_profile_types = Counter()
+		profile_types = []
+		unfiltered_profile_types = []
 		user_verified = False
 		user_followers_count = 0
 		user_friends_count = 0
@@ -166,6 +854,7 @@ def _process_tweet(tweet, docs):
 		tweet_lng = None
 		tweet_lat = None
 		tweet_nuts_level = 0
+		tweet_place_id = None
 		tweet_nuts1_code = None
 		tweet_nuts1_name = None
 		tweet_nuts2_code = None
@@ -189,6 +878,7 @@ def _process_tweet(tweet, docs):
 		geo_nuts_level = 0
 		geo_lng = None
 		geo_lat = None
+		geo_place_id = None
 		geo_nuts1_code = None
 		geo_nuts1_name = None
 		geo_nuts2_code = None
@@ -370,43 +1060,28 @@ def _process_tweet(tweet, docs):
 			mentions[ helpers.hash('uname', uname) ] += 1
 	
 		for url in entities['urls']:
-			link = url['expanded_url']
-			simple_links[ link ] += 1
+			simple_link, simple_website, unwound_link, unwound_website, anon_title, title_tokens, desc_tokens, status_id, link, website = _cached_link_info(url)
 			
-			website = helpers.extract_website(link)
-			if website:
-				simple_websites[ website ] += 1
+			simple_links[ simple_link ] += 1
+			if simple_website:
+				simple_websites[ simple_website ] += 1
 			
-			if 'unwound' in url:
-				if 'url' in url['unwound'] and url['unwound']['url']:
-					link = url['unwound']['url']
-					unwound_links[ link ] += 1
-				
-					website = helpers.extract_website(link)
-					if website:
-						unwound_websites[ website ] += 1
-				
-				if 'title' in url['unwound'] and url['unwound']['title']:
-					anon_title = helpers.anonymize_text(url['unwound']['title'])
-					link_titles[ anon_title ] += 1
-					
-					title_tokens = helpers.tokenise_text(anon_title)
-					for token in title_tokens:
-						link_title_types[token] += 1
-				
-				if 'description' in url['unwound'] and url['unwound']['description']:
-					anon_desc = helpers.anonymize_text(url['unwound']['description'])
-					
-					desc_tokens = helpers.tokenise_text(anon_desc)
-					for token in desc_tokens:
-						link_description_types[token] += 1
-				
-			# unwound url if available, otherwise expanded url
-			if helpers.include_link(link, tweet_id):
-				link = helpers.anon_twitter_link(link)
+			if unwound_link:
+				unwound_links[ unwound_link ] += 1
+				if unwound_website:
+					unwound_websites[ unwound_website ] += 1
+			
+			if anon_title is not None:
+				link_titles[ anon_title ] += 1
+			for token in title_tokens:
+				link_title_types[token] += 1
+			
+			for token in desc_tokens:
+				link_description_types[token] += 1
+			
+			# unwound url if available, otherwise expanded url (excluding links to the tweet itself)
+			if link is not None and status_id != tweet_id:
 				links[ link ] += 1
-				
-				website = helpers.extract_website(link)
 				if website:
 					websites[ website ] += 1
 		
@@ -449,6 +1124,7 @@ def _process_tweet(tweet, docs):
 		
 			bbox = tweet['place']['bounding_box']['coordinates'][0]
 			tweet_lng, tweet_lat = _geo_helper.average_coord(bbox)
+			tweet_place_id = tweet['place'].get('id')
 		
 			if place_type == 'country':
 				tweet_nuts_level = 0
@@ -483,23 +1159,14 @@ def _process_tweet(tweet, docs):
 		if _geo_search_level > 0:
 	
 			if tweet_lng and tweet_lat:
-				if _geo_search_level >= 1 and tweet_nuts_level >= 1:
-					tweet_nuts1_code, tweet_nuts1_name = _geo_helper.search_nuts_1(tweet_lng, tweet_lat)
-				if _geo_search_level >= 2 and tweet_nuts_level >= 2:
-					tweet_nuts2_code, tweet_nuts2_name = _geo_helper.search_nuts_2(tweet_lng, tweet_lat)
-				if _geo_search_level >= 3 and tweet_nuts_level >= 3:
-					tweet_nuts3_code, tweet_nuts3_name = _geo_helper.search_nuts_3(tweet_lng, tweet_lat)
-		
-				if tweet_nuts3_code is not None and tweet_nuts2_code is None:
-					tweet_nuts2_code = tweet_nuts3_code[:4]
-					tweet_nuts2_name = 'auto'
-				if tweet_nuts2_code is not None and tweet_nuts1_code is None:
-					tweet_nuts1_code = tweet_nuts2_code[:3]
-					tweet_nuts1_name = 'auto'
+				if not geo_batch:
+					(tweet_nuts1_code, tweet_nuts1_name, tweet_nuts2_code, tweet_nuts2_name,
+						tweet_nuts3_code, tweet_nuts3_name) = _cached_nuts_regions(tweet_lng, tweet_lat, tweet_nuts_level, tweet_place_id)
 			
 				geo_source = "tweet"
 				geo_lng = tweet_lng
 				geo_lat = tweet_lat
+				geo_place_id = tweet_place_id
 				geo_nuts_level = tweet_nuts_level
 				geo_nuts1_code = tweet_nuts1_code
 				geo_nuts1_name = tweet_nuts1_name
@@ -510,19 +1177,9 @@ def _process_tweet(tweet, docs):
 		
 	
 			elif user_lng and user_lat:		
-				if _geo_search_level >= 1 and user_nuts_level >= 1:
-					user_nuts1_code, user_nuts1_name = _geo_helper.search_nuts_1(user_lng, user_lat)
-				if _geo_search_level >= 2 and user_nuts_level >= 2:
-					user_nuts2_code, user_nuts2_name = _geo_helper.search_nuts_2(user_lng, user_lat)
-				if _geo_search_level >= 3 and user_nuts_level >= 3:
-					user_nuts3_code, user_nuts3_name = _geo_helper.search_nuts_3(user_lng, user_lat)
-		
-				if user_nuts3_code is not None and user_nuts2_code is None:
-					user_nuts2_code = user_nuts3_code[:4]
-					user_nuts2_name = 'auto'
-				if user_nuts2_code is not None and user_nuts1_code is None:
-					user_nuts1_code = user_nuts2_code[:3]
-					user_nuts1_name = 'auto'
+				if not geo_batch:
+					(user_nuts1_code, user_nuts1_name, user_nuts2_code, user_nuts2_name,
+						user_nuts3_code, user_nuts3_name) = _cached_nuts_regions(user_lng, user_lat, user_nuts_level)
 			
 				geo_source = "profile"
 				geo_lng = user_lng
@@ -534,44 +1191,24 @@ def _process_tweet(tweet, docs):
 				geo_nuts2_name = user_nuts2_name
 				geo_nuts3_code = user_nuts3_code
 				geo_nuts3_name = user_nuts3_name
+			
+			elif _gazetteer is not None and user_geo_desc:
+				match = _cached_gazetteer_match(user_geo_desc)
+				if match is not None:
+					geo_source = "profile_location"
+					geo_nuts_level, ((geo_nuts1_code, geo_nuts1_name), (geo_nuts2_code, geo_nuts2_name),
+						(geo_nuts3_code, geo_nuts3_name)) = match
 		
 		
 		# types
 	
-		anon_text = helpers.anonymize_text(text)
-		tokens = helpers.tokenise_text(anon_text)
-		computed_text = " ".join(tokens)
-		bi_memory = deque([])
-		tri_memory = deque([])
-
-		for token in tokens:
-			unfiltered_types[ token ] += 1
-			if len(token) > 1 and not token in STOPWORDS and not token in hashtags:
-				types[ token ] += 1
-			
-			bi_memory.append(token)
-			if len(bi_memory) == 2:
-				bi_gram = ' '.join(bi_memory)
-				bi_grams[bi_gram] += 1
-				bi_memory.popleft()
-			
-			tri_memory.append(token)
-			if len(tri_memory) == 3:
-				tri_gram = ' '.join(tri_memory)
-				tri_grams[tri_gram] += 1
-				tri_memory.popleft()
+		anon_text, computed_text, types, unfiltered_types, bi_grams, tri_grams, unfiltered_type_counts = _cached_text_types(text, hashtags)
 		
 		
 		# profile types
 		
 		if user_desc is not None and user_desc != "":
-			anon_profile = helpers.anonymize_text(user_desc)
-			profile_tokens = helpers.tokenise_text(anon_profile)
-
-			for token in profile_tokens:
-				unfiltered_profile_types[ token ] += 1
-				if len(token) > 1 and not token in STOPWORDS:
-					profile_types[ token ] += 1
+			anon_profile, profile_types, unfiltered_profile_types = _cached_profile_types(username, user_desc)
 		
 		
 		# user connections combined
@@ -619,6 +1256,8 @@ def _process_tweet(tweet, docs):
 			'retweeted_id':				retweeted_id,
 			'retweeted_username':		retweeted_username,
 			
+			'tweet_kind':				helpers.tweet_kind(is_retweet, is_quote, is_reply),
+			
 			'quote_count':				quote_count,
 			'reply_count':				reply_count,
 			'retweet_count':			retweet_count,
@@ -628,11 +1267,11 @@ def _process_tweet(tweet, docs):
 			'has_extended':				has_extended,
 			'text': 					anon_text,
 			'computed_text':			computed_text,
-			'types':					helpers.counter_to_list(types),
-			'unfiltered_types':			helpers.counter_to_list(unfiltered_types),
-			'bi_grams':					helpers.counter_to_list(bi_grams),
-			'tri_grams':				helpers.counter_to_list(tri_grams),
-			'unfiltered_type_counts':	helpers.counter_to_object_list(unfiltered_types, key='type', val='freq'),
+			'types':					types,
+			'unfiltered_types':			unfiltered_types,
+			'bi_grams':					bi_grams,
+			'tri_grams':				tri_grams,
+			'unfiltered_type_counts':	helpers.pairs_to_object_list(unfiltered_type_counts, key='type', val='freq'),
 			
 			'hashtags':					helpers.counter_to_list(hashtags),
 			'user_mentions':			helpers.counter_to_list(mentions),
@@ -652,8 +1291,8 @@ def _process_tweet(tweet, docs):
 			'symbols':					helpers.counter_to_list(symbols),
 			
 			'profile_text':				anon_profile,
-			'profile_types': 			helpers.counter_to_list(profile_types),
-			'unfiltered_profile_types':	helpers.counter_to_list(unfiltered_profile_types),
+			'profile_types': 			profile_types,
+			'unfiltered_profile_types':	unfiltered_profile_types,
 			'profile_verified':			user_verified,
 			'profile_followers_count':	user_followers_count,
 			'profile_friends_count':	user_friends_count,
@@ -684,6 +1323,10 @@ def _process_tweet(tweet, docs):
 			doc['geo_nuts2_name'] = 		geo_nuts2_name
 			doc['geo_nuts3_code'] = 		geo_nuts3_code
 			doc['geo_nuts3_name'] = 		geo_nuts3_name
+			
+			if geo_batch and geo_lng is not None:
+				# regions filled in by _assign_nuts_regions before the doc is inserted
+				_geo_pending.append((doc, geo_lng, geo_lat, geo_nuts_level, geo_place_id))
 	
 		docs.append(doc)
 	
@@ -693,14 +1336,291 @@ def _process_tweet(tweet, docs):
 	
 	# retweets and quote tweets
 	if retweet:
-		_process_tweet(retweet, docs)
+		_process_tweet(retweet, docs, geo_batch)
 	
 	if qtweet:
-		_process_tweet(qtweet, docs)
+		_process_tweet(qtweet, docs, geo_batch)
 
 
 
-def _insert_docs(es, docs, file, insert_num):
+def _link_info(url):
+	# everything derived from a url entity apart from the check against the current tweet id,
+	# so that it can be cached by url
+	link = url['expanded_url']
+	simple_link = link
+	simple_website = helpers.extract_website(link)
+	
+	unwound_link = None
+	unwound_website = None
+	anon_title = None
+	title_tokens = []
+	desc_tokens = []
+	
+	if 'unwound' in url:
+		if 'url' in url['unwound'] and url['unwound']['url']:
+			link = url['unwound']['url']
+			unwound_link = link
+			unwound_website = helpers.extract_website(link)
+		
+		if 'title' in url['unwound'] and url['unwound']['title']:
+			anon_title = helpers.anonymize_text(url['unwound']['title'])
+			title_tokens = helpers.tokenise_text(anon_title)
+		
+		if 'description' in url['unwound'] and url['unwound']['description']:
+			anon_desc = helpers.anonymize_text(url['unwound']['description'])
+			desc_tokens = helpers.tokenise_text(anon_desc)
+	
+	status_id = helpers.link_status_id(link)
+	anon_link = None
+	website = None
+	if helpers.include_link(link, None):
+		anon_link = helpers.anon_twitter_link(link)
+		website = helpers.extract_website(anon_link)
+	
+	return simple_link, simple_website, unwound_link, unwound_website, anon_title, title_tokens, desc_tokens, status_id, anon_link, website
+
+
+
+def _cached_link_info(url):
+	if _url_cache is None:
+		return _link_info(url)
+	
+	key = (url['expanded_url'], None, None, None)
+	if url.get('unwound'):
+		key = (url['expanded_url'], url['unwound'].get('url'), url['unwound'].get('title'), url['unwound'].get('description'))
+	
+	info = _url_cache.get(key)
+	if info is None:
+		info = _link_info(url)
+		_url_cache.put(key, info)
+	return info
+
+
+
+def _text_tokens(anon_text):
+	# lists in counter_to_list order, with types not yet filtered by the tweet's hashtags
+	# (so the result only depends on the text and can be cached)
+	types = Counter()
+	unfiltered_types = Counter()
+	bi_grams = Counter()
+	tri_grams = Counter()
+	
+	tokens = helpers.tokenise_text(anon_text)
+	computed_text = " ".join(tokens)
+	bi_memory = deque([])
+	tri_memory = deque([])
+
+	for token in tokens:
+		unfiltered_types[ token ] += 1
+		if len(token) > 1 and not token in STOPWORDS:
+			types[ token ] += 1
+		
+		bi_memory.append(token)
+		if len(bi_memory) == 2:
+			bi_gram = ' '.join(bi_memory)
+			bi_grams[bi_gram] += 1
+			bi_memory.popleft()
+		
+		tri_memory.append(token)
+		if len(tri_memory) == 3:
+			tri_gram = ' '.join(tri_memory)
+			tri_grams[tri_gram] += 1
+			tri_memory.popleft()
+	
+	return (
+		computed_text,
+		helpers.counter_to_list(types),
+		helpers.counter_to_list(unfiltered_types),
+		helpers.counter_to_list(bi_grams),
+		helpers.counter_to_list(tri_grams),
+		unfiltered_types.most_common()
+	)
+
+
+
+def _filter_hashtags(types, hashtags):
+	if not hashtags:
+		return types
+	return [token for token in types if not token in hashtags]
+
+
+
+def _text_types(anon_text, hashtags):
+	# shared with rederive, which recomputes these from the stored text
+	computed_text, types, unfiltered_types, bi_grams, tri_grams, unfiltered_type_counts = _text_tokens(anon_text)
+	return computed_text, _filter_hashtags(types, hashtags), unfiltered_types, bi_grams, tri_grams, unfiltered_type_counts
+
+
+
+def _cached_text_types(text, hashtags):
+	if _text_cache is None:
+		anon_text = helpers.anonymize_text(text)
+		return (anon_text,) + _text_types(anon_text, hashtags)
+	
+	key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+	
+	entry = _text_cache.get(key)
+	if entry is None:
+		anon_text = helpers.anonymize_text(text)
+		entry = (anon_text,) + _text_tokens(anon_text)
+		_text_cache.put(key, entry)
+	
+	anon_text, computed_text, types, unfiltered_types, bi_grams, tri_grams, unfiltered_type_counts = entry
+	return anon_text, computed_text, _filter_hashtags(types, hashtags), unfiltered_types, bi_grams, tri_grams, unfiltered_type_counts
+
+
+
+def _profile_types(anon_profile):
+	profile_types = Counter()
+	unfiltered_profile_types = Counter()
+	
+	profile_tokens = helpers.tokenise_text(anon_profile)
+
+	for token in profile_tokens:
+		unfiltered_profile_types[ token ] += 1
+		if len(token) > 1 and not token in STOPWORDS:
+			profile_types[ token ] += 1
+	
+	return profile_types, unfiltered_profile_types
+
+
+
+def _cached_profile_types(username, user_desc):
+	# users post many tweets with an unchanged description, keyed per user so a changed bio is a miss
+	key = None
+	if _profile_cache is not None:
+		key = (username, hashlib.blake2b(user_desc.encode('utf-8'), digest_size=16).digest())
+		entry = _profile_cache.get(key)
+		if entry is not None:
+			return entry
+	
+	anon_profile = helpers.anonymize_text(user_desc)
+	profile_types, unfiltered_profile_types = _profile_types(anon_profile)
+	entry = (anon_profile, helpers.counter_to_list(profile_types), helpers.counter_to_list(unfiltered_profile_types))
+	
+	if key is not None:
+		_profile_cache.put(key, entry)
+	
+	return entry
+
+
+
+def _cached_gazetteer_match(location):
+	key = normalise_location(location)
+	if _gazetteer_cache is None:
+		return _gazetteer.match_normalised(key)
+	
+	# wrapped, so a location with no match is cached too
+	cached = _gazetteer_cache.get(key)
+	if cached is not None:
+		return cached[0]
+	
+	match = _gazetteer.match_normalised(key)
+	_gazetteer_cache.put(key, (match,))
+	return match
+
+
+
+def _nuts_regions(lng, lat, nuts_level):
+	# (code, name) for NUTS levels 1 to 3, searched down to nuts_level (and the geo search level),
+	# missing upper levels are filled in from the lower level codes
+	nuts1_code, nuts1_name = None, None
+	nuts2_code, nuts2_name = None, None
+	nuts3_code, nuts3_name = None, None
+	
+	if _geo_search_level >= 1 and nuts_level >= 1:
+		nuts1_code, nuts1_name = _geo_helper.search_nuts_1(lng, lat)
+	if _geo_search_level >= 2 and nuts_level >= 2:
+		nuts2_code, nuts2_name = _geo_helper.search_nuts_2(lng, lat)
+	if _geo_search_level >= 3 and nuts_level >= 3:
+		nuts3_code, nuts3_name = _geo_helper.search_nuts_3(lng, lat)
+	
+	return _fill_nuts_regions(nuts1_code, nuts1_name, nuts2_code, nuts2_name, nuts3_code, nuts3_name)
+
+
+
+def _fill_nuts_regions(nuts1_code, nuts1_name, nuts2_code, nuts2_name, nuts3_code, nuts3_name):
+	if nuts3_code is not None and nuts2_code is None:
+		nuts2_code = nuts3_code[:4]
+		nuts2_name = 'auto'
+	if nuts2_code is not None and nuts1_code is None:
+		nuts1_code = nuts2_code[:3]
+		nuts1_name = 'auto'
+	
+	return nuts1_code, nuts1_name, nuts2_code, nuts2_name, nuts3_code, nuts3_name
+
+
+
+def _nuts_key(lng, lat, nuts_level, place_id=None):
+	# cache key, and the point to look up for it
+	if place_id is not None:
+		# coordinates from a place are the centre of its bounding box, the same every time
+		return ('place', place_id, nuts_level), lng, lat
+	if _geo_cache_precision is not None:
+		# look up the rounded point, so results don't depend on which point in the cell came first
+		lng = round(lng, _geo_cache_precision)
+		lat = round(lat, _geo_cache_precision)
+	return (lng, lat, nuts_level), lng, lat
+
+
+
+def _cached_nuts_regions(lng, lat, nuts_level, place_id=None):
+	if _geo_cache is None:
+		return _nuts_regions(lng, lat, nuts_level)
+	
+	key, lng, lat = _nuts_key(lng, lat, nuts_level, place_id)
+	regions = _geo_cache.get(key)
+	if regions is None:
+		regions = _nuts_regions(lng, lat, nuts_level)
+		_geo_cache.put(key, regions)
+	
+	return regions
+
+
+
+def _assign_nuts_regions():
+	# regions for the docs waiting in _geo_pending, each distinct point looked up once, with one spatial join per level
+	if not _geo_pending:
+		return
+	
+	regions = {}
+	lookups = {}	# key -> (lng, lat, nuts level)
+	keys = []
+	for doc, lng, lat, nuts_level, place_id in _geo_pending:
+		key, lng, lat = _nuts_key(lng, lat, nuts_level, place_id)
+		keys.append(key)
+		if key in regions or key in lookups:
+			continue
+		cached = _geo_cache.get(key) if _geo_cache is not None else None
+		if cached is not None:
+			regions[key] = cached
+		else:
+			lookups[key] = (lng, lat, nuts_level)
+	
+	found = { key: [(None, None)] * 3 for key in lookups }
+	for level in range(1, min(_geo_search_level, 3) + 1):
+		level_keys = [ key for key, (lng, lat, nuts_level) in lookups.items() if nuts_level >= level ]
+		results = _geo_helper.search_nuts_batch(level,
+			[ lookups[key][0] for key in level_keys ], [ lookups[key][1] for key in level_keys ])
+		for key, result in zip(level_keys, results):
+			found[key][level - 1] = result
+	
+	for key, ((nuts1_code, nuts1_name), (nuts2_code, nuts2_name), (nuts3_code, nuts3_name)) in found.items():
+		regions[key] = _fill_nuts_regions(nuts1_code, nuts1_name, nuts2_code, nuts2_name, nuts3_code, nuts3_name)
+		if _geo_cache is not None:
+			_geo_cache.put(key, regions[key])
+	
+	for (doc, lng, lat, nuts_level, place_id), key in zip(_geo_pending, keys):
+		(doc['geo_nuts1_code'], doc['geo_nuts1_name'], doc['geo_nuts2_code'], doc['geo_nuts2_name'],
+			doc['geo_nuts3_code'], doc['geo_nuts3_name']) = regions[key]
+	
+	del _geo_pending[:]
+
+
+
+def _insert_docs(es, docs, file, insert_num, sender=None):
+	_assign_nuts_regions()
+	
 	logging.info('start insert\t{}\t{}\t{}'.format( file, insert_num, len(docs) ))
 	
 	ops = 1
@@ -709,14 +1629,18 @@ def _insert_docs(es, docs, file, insert_num):
 	for doc in docs:
 		body += '{ "index" : { "_id" : "' + doc['tweet_id'] + '" } }\n' + json.dumps(doc) + '\n'
 		if len(body) > MAX_BODY_SIZE:
-			done += _insert_bulk(es, body, file, ops)
+			done += _insert_bulk(es, body, file, ops, sender)
 			ops += 1
 			body = ''
 
 	if len(body) > 0:
-		done += _insert_bulk(es, body, file, 0)
+		done += _insert_bulk(es, body, file, 0, sender)
 
-	logging.info('insert result\t{}\t{}\t{}'.format( file, insert_num, done ))
+	if sender is not None:
+		# results are counted when the sender is flushed
+		logging.info('insert queued\t{}\t{}\t{}'.format( file, insert_num, len(docs) ))
+	else:
+		logging.info('insert result\t{}\t{}\t{}'.format( file, insert_num, done ))
 		
 	docs.clear()
 	
@@ -724,7 +1648,24 @@ def _insert_docs(es, docs, file, insert_num):
 
 
 
-def _insert_bulk(es, body, file, n):
+def _bulk_bodies(docs):
+	body = ''
+	for doc in docs:
+		body += '{ "index" : { "_id" : "' + doc['tweet_id'] + '" } }\n' + json.dumps(doc) + '\n'
+		if len(body) > MAX_BODY_SIZE:
+			yield body
+			body = ''
+	
+	if len(body) > 0:
+		yield body
+
+
+
+def _insert_bulk(es, body, file, n, sender=None):
+	if sender is not None:
+		sender.submit(body, file, n)
+		return 0
+	
 	res = es.bulk(index=_index_name, body=body)
 	if res['errors']:
 		helpers.dump_es_error(res, file, n)
@@ -759,6 +1700,8 @@ INDEX_DEFINITION = {
 			"retweeted_id":               { "type": "keyword" },
 			"retweeted_username":         { "type": "keyword" },
 			
+			"tweet_kind":                 { "type": "keyword" },
+			
 			"quote_count":                { "type": "long" },
 			"reply_count":                { "type": "long" },
 			"retweet_count":              { "type": "long" },
@@ -838,17 +1781,121 @@ INDEX_DEFINITION = {
 }
 
 
+# fields the dashboard aggregates on (terms / cardinality), first aggregation needs their global ordinals
+AGGREGATION_FIELDS = ['types', 'bi_grams', 'tri_grams', 'hashtags', 'websites', 'urls', 'username']
+
+# keyword fields filtered on but never aggregated or sorted on, so no doc values
+FILTER_ONLY_FIELDS = [
+	'reply_id', 'reply_to_username', 'quoted_id', 'quoted_username', 'retweeted_id', 'retweeted_username',
+	'user_mentions', 'simple_urls', 'unwound_urls', 'simple_websites', 'unwound_websites',
+	'url_title_types', 'url_description_types', 'media_files', 'media_urls', 'media_websites', 'media_formats',
+	'symbols', 'profile_types', 'tweet_geo_description', 'profile_geo_descrption', 'source'
+]
+
+# keyword fields only kept in _source (for display and rederive), neither searched nor aggregated
+STORED_ONLY_FIELDS = ['computed_text', 'url_titles']
+
+# longer keyword values are not indexed (they stay in _source)
+IGNORE_ABOVE = {
+	'urls':             1024,
+	'simple_urls':      1024,
+	'unwound_urls':     1024,
+	'media_urls':       1024,
+	'media_files':      1024,
+	'bi_grams':         256,
+	'tri_grams':        256,
+	'types':            256,
+	'hashtags':         256,
+	'url_title_types':  256,
+	'url_description_types':	256,
+	'profile_types':    256
+}
+
+
+def _aggregation_index_definition():
+	definition = deepcopy(INDEX_DEFINITION)
+	properties = definition['mappings']['properties']
+	
+	for field in AGGREGATION_FIELDS:
+		properties[field]['eager_global_ordinals'] = True
+	
+	for field in FILTER_ONLY_FIELDS:
+		properties[field]['doc_values'] = False
+	
+	for field in STORED_ONLY_FIELDS:
+		properties[field]['index'] = False
+		properties[field]['doc_values'] = False
+	
+	for field, length in IGNORE_ABOVE.items():
+		properties[field]['ignore_above'] = length
+	
+	# nothing is scored, so no norms or positions
+	for field in ['text', 'profile_text']:
+		properties[field]['norms'] = False
+		properties[field]['index_options'] = 'docs'
+	
+	# no index sort (on timestamp, for the date ranges), as ElasticSearch refuses it with nested fields
+	return definition
+
+
+AGGREGATION_INDEX_DEFINITION = _aggregation_index_definition()
+
+INDEX_PROFILES = {
+	'default': INDEX_DEFINITION,
+	'aggregation': AGGREGATION_INDEX_DEFINITION
+}
+
+
 def _create_index():
 	try:
-		es = Elasticsearch(_es_ips, timeout=(60*60))
+		es = _create_client()
 		res = es.indices.create(
 			index = _index_name,
-			body = INDEX_DEFINITION,
+			body = INDEX_PROFILES[_index_profile],
 			ignore = 400
 		)
 		logging.info("result\t{}".format(res))
 	except:
 		logging.exception("index creation\t{}".format(_index_name))
+		return
+	
+	error = res.get('error')
+	if error is None:
+		return
+	
+	# any other refusal would leave ElasticSearch to create the index with dynamic mappings on the first bulk
+	if not isinstance(error, dict) or error.get('type') != 'resource_already_exists_exception':
+		raise IndexCreationException("index creation refused\t{}\t{}".format(_index_name, error))
+	
+	try:
+		_put_missing_mappings(es)
+	except:
+		logging.exception("index mappings\t{}".format(_index_name))
+
+
+
+def _put_missing_mappings(es, fields=None):
+	# fields added to the index definition since the index was created (e.g. tweet_kind) must be mapped
+	# before documents with them are indexed, or they are mapped dynamically (as text)
+	properties = INDEX_PROFILES[_index_profile]['mappings']['properties']
+	if fields is None:
+		fields = list(properties)
+	
+	res = es.indices.get_field_mapping(index=_index_name, fields=",".join(fields))
+	mapped = {}
+	for index in res.values():
+		for field, mapping in index['mappings'].items():
+			mapped[field] = mapping.get('mapping', {}).get(field, {}).get('type')
+	
+	missing = { field: properties[field] for field in fields if field not in mapped and field in properties }
+	if missing:
+		es.indices.put_mapping(index=_index_name, body={ 'properties': missing })
+		logging.info("mapping added\t{}\t{}".format(_index_name, ", ".join(missing)))
+	
+	for field in fields:
+		expected = properties.get(field, {}).get('type')
+		if field in mapped and mapped[field] is not None and expected is not None and mapped[field] != expected:
+			logging.warning("mapping differs\t{}\t{}\t{} not {}".format(_index_name, field, mapped[field], expected))
 
 
 
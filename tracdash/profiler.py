@@ -0,0 +1,77 @@
+import os, glob, io, logging, cProfile, pstats
+
+from . import helpers
+
+
+
+PROFILE_PREFIX = "prof_"
+REPORT_LINES = 40		# functions listed per sort order in the combined report
+
+
+
+class FileProfiler:
+	"""
+	Deterministic profile (cProfile) of one file processed in a worker,
+	optionally stopped once max_tweets lines have been processed.
+	"""
+	def __init__(self, path, max_tweets=None):
+		self.path = path
+		self.max_tweets = max_tweets
+		self.profile = cProfile.Profile()
+		self.running = False
+
+
+	def start(self):
+		self.profile.enable()
+		self.running = True
+
+
+	def tick(self, tweets):
+		if self.running and self.max_tweets is not None and tweets >= self.max_tweets:
+			self.stop()
+
+
+	def stop(self):
+		if self.running:
+			self.profile.disable()
+			self.running = False
+
+
+	def write(self):
+		self.stop()
+		try:
+			self.profile.dump_stats(self.path)
+		except:
+			logging.exception("profile write error\t{}".format(self.path))
+
+
+
+def profile_path(run_id, file):
+	"""Per worker and file profile, written next to the log."""
+	name = "{}{}_{}_{}.prof".format(PROFILE_PREFIX, run_id, os.getpid(), helpers.escape_filename(file))
+	return os.path.join(helpers.logging_path, name)
+
+
+
+def merge_profiles(run_id, lines=REPORT_LINES):
+	"""Merge the worker profiles of a run into one hot function report next to the log, returning its path."""
+	paths = sorted(glob.glob(os.path.join(helpers.logging_path, "{}{}_*.prof".format(PROFILE_PREFIX, run_id))))
+	if not paths:
+		logging.warning("no profiles to merge\t{}".format(run_id))
+		return None
+
+	out = io.StringIO()
+	stats = pstats.Stats(*paths, stream=out)
+	stats.dump_stats(os.path.join(helpers.logging_path, "{}{}.prof".format(PROFILE_PREFIX, run_id)))
+
+	print("{} worker profiles\n".format(len(paths)), file=out)
+	for sort in ['tottime', 'cumulative']:
+		print("by {}".format(sort), file=out)
+		stats.sort_stats(sort).print_stats(lines)
+
+	report_file = os.path.join(helpers.logging_path, "{}{}.txt".format(PROFILE_PREFIX, run_id))
+	with open(report_file, 'w') as f:
+		f.write(out.getvalue())
+
+	logging.info("profile report\t{}\t{} profiles".format(report_file, len(paths)))
+	return report_file
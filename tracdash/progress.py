@@ -0,0 +1,148 @@
+import os, json, time, logging, queue
+from datetime import datetime, timedelta
+
+
+READY_CHECK_INTERVAL = 0.5		# seconds
+
+
+class ProgressReporter:
+	"""
+	Worker side of import progress reporting.
+	Sends the running totals for the current file to the parent at most once per interval.
+	"""
+	def __init__(self, progress_queue, interval):
+		self.queue = progress_queue
+		self.interval = interval
+		self.last = 0.0
+
+
+	def update(self, file, bytes_read, tweets, docs, finished=False):
+		now = time.time()
+		if finished or now - self.last >= self.interval:
+			self.last = now
+			self.queue.put((file, bytes_read, tweets, docs, finished))
+
+
+
+class ProgressMonitor:
+	"""
+	Parent side of import progress reporting.
+	Aggregates worker updates, logs the overall rate and ETA (based on total compressed input bytes)
+	and optionally writes the same figures to a JSON status file for monitoring to poll.
+	"""
+	def __init__(self, progress_queue, files, interval, status_file=None):
+		self.queue = progress_queue
+		self.interval = interval
+		self.status_file = status_file
+
+		self.sizes = {}
+		for file in files:
+			try:
+				self.sizes[file] = os.path.getsize(file)
+			except OSError:
+				self.sizes[file] = 0
+		self.total_bytes = sum(self.sizes.values())
+
+		self.files = {}
+		self.start = time.time()
+		self.last = self.start
+
+
+	def poll(self, timeout, ready=None):
+		"""
+		Receive worker updates for up to timeout seconds, or until ready() is true (checked every READY_CHECK_INTERVAL),
+		reporting when the interval has passed.
+		"""
+		end = time.time() + timeout
+		while ready is None or not ready():
+			remaining = end - time.time()
+			if remaining <= 0:
+				break
+			try:
+				self.receive(self.queue.get(timeout=min(remaining, READY_CHECK_INTERVAL)))
+			except queue.Empty:
+				pass
+
+		if time.time() - self.last >= self.interval:
+			self.report()
+
+
+	def update(self, update):
+		"""Record progress made in this process rather than sent by a worker, reporting when the interval has passed."""
+		self.receive(update)
+		if time.time() - self.last >= self.interval:
+			self.report()
+
+
+	def drain(self):
+		while True:
+			try:
+				self.receive(self.queue.get_nowait())
+			except queue.Empty:
+				break
+
+
+	def receive(self, update):
+		file, bytes_read, tweets, docs, finished = update
+		if finished:
+			bytes_read = self.sizes.get(file, bytes_read)
+		self.files[file] = {
+			'bytes': bytes_read,
+			'tweets': tweets,
+			'docs': docs,
+			'finished': finished
+		}
+
+
+	def status(self):
+		now = time.time()
+		elapsed = max(now - self.start, 0.001)
+
+		bytes_read = sum(f['bytes'] for f in self.files.values())
+		tweets = sum(f['tweets'] for f in self.files.values())
+		docs = sum(f['docs'] for f in self.files.values())
+
+		byte_rate = bytes_read / elapsed
+		eta = None
+		if byte_rate > 0:
+			eta = (self.total_bytes - bytes_read) / byte_rate
+
+		return {
+			'time': str(datetime.now()),
+			'elapsed': elapsed,
+			'total_bytes': self.total_bytes,
+			'bytes': bytes_read,
+			'percent': 100.0 * bytes_read / max(self.total_bytes, 1),
+			'files': len(self.sizes),
+			'files_started': len(self.files),
+			'files_finished': sum(1 for f in self.files.values() if f['finished']),
+			'tweets': tweets,
+			'docs': docs,
+			'bytes_per_sec': byte_rate,
+			'tweets_per_sec': tweets / elapsed,
+			'docs_per_sec': docs / elapsed,
+			'eta': eta
+		}
+
+
+	def report(self):
+		self.last = time.time()
+		status = self.status()
+
+		eta = '-'
+		if status['eta'] is not None:
+			eta = str(timedelta(seconds=int(status['eta'])))
+
+		logging.info("progress\t{:.1f}%\t{:.1f} / {:.1f} MB\t{}/{} files\t{} tweets\t{} docs\t{:.2f} MB/s\t{:.1f} tweets/s\t{:.1f} docs/s\tETA {}".format(
+			status['percent'], status['bytes'] / 1000000, status['total_bytes'] / 1000000,
+			status['files_finished'], status['files'], status['tweets'], status['docs'],
+			status['bytes_per_sec'] / 1000000, status['tweets_per_sec'], status['docs_per_sec'], eta))
+
+		if self.status_file:
+			try:
+				tmp_file = self.status_file + '.tmp'
+				with open(tmp_file, 'w') as f:
+					json.dump(status, f, indent=2)
+				os.replace(tmp_file, self.status_file)
+			except:
+				logging.exception("progress status file error\t{}".format(self.status_file))
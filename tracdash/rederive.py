@@ -0,0 +1,259 @@
+import json, logging, gzip, time
+import multiprocessing
+from collections import Counter
+
+from elasticsearch.helpers import scan
+
+from . import helpers
+from . import importer
+from .exceptions import BulkInsertException
+
+
+
+SCROLL_SIZE = 5000
+SCROLL_TIME = '30m'
+
+# derived fields that can be recomputed from other stored fields:
+# field -> stored fields needed to derive it
+STORED_SOURCES = {
+	'computed_text':            ['text', 'hashtags'],
+	'types':                    ['text', 'hashtags'],
+	'unfiltered_types':         ['text', 'hashtags'],
+	'bi_grams':                 ['text', 'hashtags'],
+	'tri_grams':                ['text', 'hashtags'],
+	'unfiltered_type_counts':   ['text', 'hashtags'],
+	'profile_types':            ['profile_text'],
+	'unfiltered_profile_types': ['profile_text'],
+	'url_title_types':          ['url_titles'],
+	'websites':                 ['urls'],
+	'simple_websites':          ['simple_urls'],
+	'unwound_websites':         ['unwound_urls'],
+	'media_websites':           ['media_urls'],
+	'tweet_kind':               ['is_retweet', 'is_quote', 'is_reply'],
+}
+
+_fields = None
+_slices = None
+_query = None
+
+
+
+def rederive_fields(es_ips, index_name, fields, files = None, pool_size = 16, geo_level = 0, query = None):
+	"""
+	Recompute only the named derived fields of existing tweets and push them as partial updates,
+	e.g. after a change to STOPWORDS, the tokeniser rules or link normalisation.
+
+	Without files, fields are recomputed from other stored fields (see STORED_SOURCES),
+	scrolling the index in pool_size slices in parallel (optionally limited by query).
+	With files (a list of jsonl.gz paths, as for import_files) tweets are re-processed from the raw source,
+	which allows any field to be re-derived; tweets missing from the index are skipped.
+	"""
+	global _fields, _slices, _query
+
+	helpers.init_tokeniser()
+
+	importer._geo_search_level = geo_level
+	importer._geo_helper = helpers.init_geo(geo_level)
+
+	importer._es_ips = es_ips
+	importer._index_name = index_name
+	importer._pool_size = pool_size
+
+	_fields = list(fields)
+	_slices = pool_size
+	_query = query
+
+	importer._put_missing_mappings(importer._create_client(), _fields)
+
+	if files is None:
+		unknown = [f for f in _fields if f not in STORED_SOURCES]
+		if unknown:
+			raise ValueError("fields can't be derived from stored fields (use raw files): {}".format(", ".join(unknown)))
+
+		logging.info("starting rederive from index\t{}\t{}".format(index_name, ", ".join(_fields)))
+		with multiprocessing.get_context('fork').Pool(pool_size, initializer=importer._init_worker) as pool:
+			result = pool.map(_rederive_slice, range(pool_size))
+			pool.close()
+			pool.join()
+	else:
+		logging.info("starting rederive from files\t{}\t{}".format(index_name, ", ".join(_fields)))
+		with multiprocessing.get_context('fork').Pool(pool_size, initializer=importer._init_worker) as pool:
+			result = pool.map(_rederive_file, files)
+			pool.close()
+			pool.join()
+
+	logging.info("rederive finished\n{}".format( "\n".join(result) ))
+
+
+
+def derive_stored_fields(source, fields):
+	"""Recompute the named fields from a document's stored _source."""
+	doc = {}
+
+	if any(f in fields for f in ['computed_text', 'types', 'unfiltered_types', 'bi_grams', 'tri_grams', 'unfiltered_type_counts']):
+		hashtags = set(source.get('hashtags') or [])
+		computed_text, types, unfiltered_types, bi_grams, tri_grams, unfiltered_type_counts = importer._text_types(source.get('text') or '', hashtags)
+
+		text_fields = {
+			'computed_text':			computed_text,
+			'types':					types,
+			'unfiltered_types':			unfiltered_types,
+			'bi_grams':					bi_grams,
+			'tri_grams':				tri_grams,
+			'unfiltered_type_counts':	helpers.pairs_to_object_list(unfiltered_type_counts, key='type', val='freq'),
+		}
+		for field in text_fields:
+			if field in fields:
+				doc[field] = text_fields[field]
+
+	if 'profile_types' in fields or 'unfiltered_profile_types' in fields:
+		profile_types = Counter()
+		unfiltered_profile_types = Counter()
+		if source.get('profile_text'):
+			profile_types, unfiltered_profile_types = importer._profile_types(source['profile_text'])
+		if 'profile_types' in fields:
+			doc['profile_types'] = helpers.counter_to_list(profile_types)
+		if 'unfiltered_profile_types' in fields:
+			doc['unfiltered_profile_types'] = helpers.counter_to_list(unfiltered_profile_types)
+
+	if 'url_title_types' in fields:
+		link_title_types = Counter()
+		for title in source.get('url_titles') or []:
+			for token in helpers.tokenise_text(title):
+				link_title_types[token] += 1
+		doc['url_title_types'] = helpers.counter_to_list(link_title_types)
+
+	for field in ['websites', 'simple_websites', 'unwound_websites', 'media_websites']:
+		if field in fields:
+			websites = Counter()
+			for link in source.get(STORED_SOURCES[field][0]) or []:
+				website = helpers.extract_website(link)
+				if website:
+					websites[ website ] += 1
+			doc[field] = helpers.counter_to_list(websites)
+
+	if 'tweet_kind' in fields:
+		doc['tweet_kind'] = helpers.tweet_kind(source.get('is_retweet'), source.get('is_quote'), source.get('is_reply'))
+
+	return doc
+
+
+
+def _rederive_slice(slice_id):
+	name = "slice {}".format(slice_id)
+	logging.info("starting rederive\t{}".format(name))
+
+	start_time = time.time()
+
+	sources = set()
+	for field in _fields:
+		sources.update(STORED_SOURCES[field])
+
+	body = {
+		"_source": sorted(sources),
+		"query": _query or { "match_all": {} }
+	}
+	if _slices > 1:
+		body["slice"] = { "id": slice_id, "max": _slices }
+
+	updates = []
+	update_count = 0
+
+	try:
+		for hit in scan(importer._es, query=body, index=importer._index_name, size=SCROLL_SIZE, scroll=SCROLL_TIME):
+			updates.append((hit['_id'], derive_stored_fields(hit['_source'], _fields)))
+
+			if len(updates) >= importer.MAX_DOCS_SIZE:
+				update_count += _update_docs(importer._es, updates, name)
+
+		if len(updates) > 0:
+			update_count += _update_docs(importer._es, updates, name)
+
+	except:
+		logging.exception("rederive error\t{}".format(name))
+		return "! " + name
+
+	logging.info("rederive finished\t{}\t{}\t{:.1f}s".format(name, update_count, time.time() - start_time))
+
+	return "+ " + name
+
+
+
+def _rederive_file(file):
+	logging.info("starting rederive\t{}".format(file))
+
+	start_time = time.time()
+
+	docs = []
+	updates = []
+	update_count = 0
+
+	try:
+		with gzip.open(file) as f:
+			for line in f:
+				line = line.strip()
+				if line:
+					importer._process_line(line, docs)
+
+					for doc in docs:
+						updates.append((doc['tweet_id'], { field: doc[field] for field in _fields if field in doc }))
+					docs.clear()
+
+					if len(updates) >= importer.MAX_DOCS_SIZE:
+						update_count += _update_docs(importer._es, updates, file)
+
+		if len(updates) > 0:
+			update_count += _update_docs(importer._es, updates, file)
+
+	except:
+		logging.exception("rederive error\t{}".format(file))
+		return "! " + file
+
+	logging.info("rederive finished\t{}\t{}\t{:.1f}s".format(file, update_count, time.time() - start_time))
+
+	return "+ " + file
+
+
+
+def _update_docs(es, updates, name):
+	ops = 1
+	done = 0
+	body = ''
+	for doc_id, doc in updates:
+		body += '{ "update" : { "_id" : "' + doc_id + '" } }\n' + json.dumps({ 'doc': doc }) + '\n'
+		if len(body) > importer.MAX_BODY_SIZE:
+			done += _update_bulk(es, body, name, ops)
+			ops += 1
+			body = ''
+
+	if len(body) > 0:
+		done += _update_bulk(es, body, name, 0)
+
+	updates.clear()
+
+	return done
+
+
+
+def _update_bulk(es, body, name, n):
+	res = es.bulk(index=importer._index_name, body=body)
+
+	updated = 0
+	missing = 0
+	failed = 0
+	for item in res['items']:
+		status = item['update']['status']
+		if status < 300:
+			updated += 1
+		elif status == 404:
+			missing += 1		# tweet not in the index (e.g. not imported), nothing to update
+		else:
+			failed += 1
+
+	if failed > 0:
+		helpers.dump_es_error(res, name, n)
+		logging.warning('bulk update error\t{}\t{}\t{}'.format( name, n, failed ))
+		raise BulkInsertException('es.bulk returned errors')
+
+	logging.info('bulk update success\t{}\t{}\t{}\t{} missing'.format( name, n, updated, missing ))
+	return updated
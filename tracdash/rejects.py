@@ -0,0 +1,122 @@
+"""
+Quarantine of malformed tweets.
+
+With the 'quarantine' error policy, a line that fails to parse or process is written to a
+per-file reject file next to the log (one JSON record per line: file, byte offset of the line in the
+uncompressed file, error, original line) and the import carries on. Reject files are appended to,
+so the rejects of earlier runs are kept. The file only fails if the share of rejected lines exceeds the threshold.
+Fixed up or not, rejected lines can then be replayed on their own with replay_rejects.
+"""
+
+import os, json, logging
+
+from . import helpers
+from . import importer
+from .exceptions import RejectRateException
+
+
+
+REJECT_PREFIX = "rej_"
+REJECT_MIN_LINES = 1000		# lines read before the rejection rate is checked mid-file
+
+
+
+def reject_path(file):
+	return os.path.join(helpers.logging_path, REJECT_PREFIX + helpers.escape_filename(file) + ".jsonl")
+
+
+
+def describe_error(error):
+	return "{}: {}".format(type(error).__name__, error)
+
+
+
+class RejectWriter:
+	"""Collects the rejected lines of one file, failing it if more than max_rate of its lines are rejected."""
+	def __init__(self, file, max_rate):
+		self.file = file
+		self.path = reject_path(file)
+		self.max_rate = max_rate
+		self.count = 0
+		self.f = None
+
+
+	def add(self, offset, line, error, file=None):
+		# file and offset default to this file's, but are the original ones for a replayed line
+		if self.f is None:
+			self.f = open(self.path, 'a', encoding='utf-8')
+		self.count += 1
+		self.f.write(json.dumps({
+			'file': file or self.file,
+			'offset': offset,
+			'error': error if isinstance(error, str) else describe_error(error),
+			# surrogateescape keeps lines that are not valid utf-8 byte for byte
+			'line': line.decode('utf-8', errors='surrogateescape')
+		}) + '\n')
+
+
+	def check(self, lines, final=False):
+		if not final and lines < REJECT_MIN_LINES:
+			return
+		if self.count > 0 and self.count > self.max_rate * lines:
+			raise RejectRateException("{} of {} lines rejected".format(self.count, lines))
+
+
+	def close(self):
+		if self.f is not None:
+			self.f.close()
+			self.f = None
+			logging.warning("lines rejected\t{}\t{}\t{}".format(self.file, self.count, self.path))
+
+
+
+def read_rejects(reject_file):
+	"""The original lines from a reject file, as bytes."""
+	for record in _read_reject_records(reject_file):
+		yield record['line']
+
+
+
+def _read_reject_records(reject_file):
+	with open(reject_file, encoding='utf-8') as f:
+		for line in f:
+			if line.strip():
+				record = json.loads(line)
+				record['line'] = record['line'].encode('utf-8', errors='surrogateescape')
+				yield record
+
+
+
+def replay_rejects(reject_files, es_ips, index_name, geo_level = 0):
+	"""
+	Process and insert the lines of reject files (e.g. after fixing the importer).
+	Lines that fail again are written to a new reject file for the reject file, with their original file and offset.
+	"""
+	helpers.init_tokeniser()
+
+	importer._geo_search_level = geo_level
+	importer._geo_helper = helpers.init_geo(geo_level)
+
+	importer._es_ips = es_ips
+	importer._index_name = index_name
+
+	es = importer._create_client()
+
+	for reject_file in reject_files:
+		rejects = RejectWriter(reject_file, 1.0)
+		docs = []
+		count = 0
+
+		for record in _read_reject_records(reject_file):
+			n_docs = len(docs)
+			try:
+				importer._process_line(record['line'], docs)
+			except Exception as e:
+				del docs[n_docs:]
+				rejects.add(record['offset'], record['line'], e, record['file'])
+
+		if len(docs) > 0:
+			count = importer._insert_docs(es, docs, reject_file, 0)
+
+		rejects.close()
+		logging.info("rejects replayed\t{}\t{} docs\t{} rejected again".format(reject_file, count, rejects.count))
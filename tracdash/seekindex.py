@@ -0,0 +1,161 @@
+"""
+Sidecar seek indexes for random access into jsonl.gz source files.
+
+For each input file two sidecars are written next to it:
+FILE.seek maps tweet_id to the (uncompressed offset, length) of the line containing it,
+as fixed width records sorted by tweet_id so lookups are a binary search on a memory map.
+FILE.gzidx holds the compressed block checkpoints (zran style, via indexed_gzip)
+so a line can be read without decompressing the file from the start.
+Without indexed_gzip only FILE.seek is written, and lookups fall back to decompressing up to the offset.
+"""
+
+import os, gzip, logging
+from array import array
+import numpy as np
+
+try:
+	import indexed_gzip
+except ImportError:
+	indexed_gzip = None
+
+from . import helpers
+from . import importer
+
+
+
+SEEK_SUFFIX = ".seek"
+GZ_INDEX_SUFFIX = ".gzidx"
+CHECKPOINT_SPACING = 1024 * 1024		# uncompressed bytes between compressed block checkpoints
+READ_BUFFER_SIZE = 256 * 1024			# must be below the spacing or checkpoints are skipped
+
+SEEK_DTYPE = np.dtype([('id', '<u8'), ('offset', '<u8'), ('length', '<u4')])
+
+
+
+def open_source(file, raw, build_index=False):
+	"""Open a jsonl.gz file for sequential reading, building compressed checkpoints as it is read if build_index is set."""
+	if build_index and indexed_gzip is not None:
+		return indexed_gzip.IndexedGzipFile(fileobj=raw, spacing=CHECKPOINT_SPACING, buffer_size=READ_BUFFER_SIZE)
+	return gzip.GzipFile(fileobj=raw)
+
+
+
+class SeekIndexWriter:
+	"""Collects tweet_id -> line positions while a file is imported, then writes the sidecars."""
+	def __init__(self, file):
+		self.file = file
+		# compact arrays rather than lists, there can be millions of docs per file
+		self.ids = array('Q')
+		self.offsets = array('Q')
+		self.lengths = array('Q')
+
+
+	def add(self, tweet_id, offset, length):
+		self.ids.append(int(tweet_id))
+		self.offsets.append(offset)
+		self.lengths.append(length)
+
+
+	def write(self, f):
+		records = np.empty(len(self.ids), dtype=SEEK_DTYPE)
+		records['id'] = np.frombuffer(self.ids, dtype=np.uint64)
+		records['offset'] = np.frombuffer(self.offsets, dtype=np.uint64)
+		records['length'] = np.frombuffer(self.lengths, dtype=np.uint64)
+		records.sort(order='id', kind='stable')
+
+		# write then rename, so a partial sidecar is never used
+		seek_file = self.file + SEEK_SUFFIX
+		records.tofile(seek_file + '.tmp')
+		os.replace(seek_file + '.tmp', seek_file)
+
+		if indexed_gzip is not None and isinstance(f, indexed_gzip.IndexedGzipFile):
+			gz_index_file = self.file + GZ_INDEX_SUFFIX
+			f.export_index(gz_index_file + '.tmp')
+			os.replace(gz_index_file + '.tmp', gz_index_file)
+		else:
+			logging.warning("seek index written without compressed checkpoints (indexed_gzip not available)\t{}".format(self.file))
+
+		logging.info("seek index written\t{}\t{}".format(self.file, len(records)))
+
+
+
+class SeekIndex:
+	"""Random access to the tweets of one jsonl.gz file, using the sidecars written during import."""
+	def __init__(self, file):
+		self.file = file
+		seek_file = file + SEEK_SUFFIX
+		if os.path.getsize(seek_file) == 0:
+			# a file with no docs, which np.memmap can't map
+			self.records = np.empty(0, dtype=SEEK_DTYPE)
+		else:
+			self.records = np.memmap(seek_file, dtype=SEEK_DTYPE, mode='r')
+
+		self.gz = None
+		gz_index_file = file + GZ_INDEX_SUFFIX
+		if indexed_gzip is not None and os.path.exists(gz_index_file):
+			self.gz = indexed_gzip.IndexedGzipFile(file, index_file=gz_index_file)
+		else:
+			self.gz = gzip.open(file)
+
+
+	def close(self):
+		self.gz.close()
+		del self.records
+
+
+	def locate(self, tweet_id):
+		"""Return the (offset, length) of the line containing tweet_id (embedded retweets and quotes included), or None."""
+		ids = self.records['id']
+		tid = int(tweet_id)
+		i = int(np.searchsorted(ids, tid))
+		if i < len(ids) and ids[i] == tid:
+			return int(self.records['offset'][i]), int(self.records['length'][i])
+		return None
+
+
+	def read_line(self, tweet_id):
+		location = self.locate(tweet_id)
+		if location is None:
+			return None
+		offset, length = location
+		self.gz.seek(offset)
+		return self.gz.read(length)
+
+
+	def lookup(self, tweet_ids):
+		"""Re-process the lines containing tweet_ids, returning the resulting docs for those ids."""
+		targets = set(str(tweet_id) for tweet_id in tweet_ids)
+		lines = {}
+		for tweet_id in targets:
+			location = self.locate(tweet_id)
+			if location is not None:
+				lines[location] = True
+
+		docs = []
+		for offset, length in sorted(lines):
+			self.gz.seek(offset)
+			line = self.gz.read(length).strip()
+			line_docs = []
+			importer._process_line(line, line_docs)
+			docs.extend(doc for doc in line_docs if doc['tweet_id'] in targets)
+
+		return docs
+
+
+
+def lookup_tweets(file, tweet_ids, geo_level = 0):
+	"""
+	Fetch and re-process tweets by id from a jsonl.gz file imported with seek_index set,
+	returning the docs that would be indexed for them.
+	"""
+	helpers.init_tokeniser()
+
+	if importer._geo_helper is None or importer._geo_search_level != geo_level:
+		importer._geo_search_level = geo_level
+		importer._geo_helper = helpers.init_geo(geo_level)
+
+	index = SeekIndex(file)
+	try:
+		return index.lookup(tweet_ids)
+	finally:
+		index.close()
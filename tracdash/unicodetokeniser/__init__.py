@@ -3,6 +3,7 @@
 from .helpers import load_properties as load
 
 from .core import tokenise
+from .core import tokenise_rules
 
 from .util import remove_control
 from .util import normalise
@@ -10,6 +10,51 @@ def tokenise(text):
 	# check properties are loaded
 	helpers.load_properties()
 	
+	# as tokenise_rules, with is_word_break looked up in the table built from it
+	table, n, n_rr, ll_classes, rr_classes = helpers.get_word_break_table()
+	
+	tokens = []
+	
+	cp = helpers.get_codepoints(text)
+	l = len(cp)
+	classes = helpers.get_classes(cp)
+	
+	# codepoint 0 stands in either side of the text
+	zero = helpers.get_classes([0])[0]
+	
+	start = 0
+	ll = ll_classes[zero]
+	lc = classes[0]
+	
+	# break between codepoints j - 1 and j
+	for j in range(1, l - 1):
+		rc = classes[j]
+		if table[((ll * n + lc) * n + rc) * n_rr + rr_classes[classes[j + 1]]]:
+			tokens.append(cp[start:j])
+			start = j
+		ll = ll_classes[lc]
+		lc = rc
+	
+	# last pair, with nothing to the right
+	if l > 1 and cp[l - 2] != 0 and cp[l - 1] != 0:
+		if table[((ll * n + lc) * n + classes[l - 1]) * n_rr + rr_classes[zero]]:
+			tokens.append(cp[start:l - 1])
+			start = l - 1
+	
+	# whatever remains must be a token
+	tokens.append(cp[start:l])
+	
+	return [ helpers.get_unicode(token) for token in tokens ]
+
+
+def tokenise_rules(text):
+	"""tokenise testing is_word_break at each codepoint, kept as the reference for the word break table."""
+	if text == None or len(text) == 0:
+		return []
+	
+	# check properties are loaded
+	helpers.load_properties()
+	
 	tokens = []
 	
 	# codepoints and length
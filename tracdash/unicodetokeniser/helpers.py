@@ -3,10 +3,23 @@
 import os, re
 import codepoints
 import logging
+from array import array
+
+MAX_CODEPOINT = 0x110000
+BLOCK_BITS = 8
+BLOCK_SIZE = 1 << BLOCK_BITS
+BLOCK_MASK = BLOCK_SIZE - 1
 
 _props_loaded = False
-_grapheme_props = {}
-_word_props = {}
+_grapheme_props = None
+_word_props = None
+
+# word break table, see build_word_break_table
+_classes = None
+_class_props = []
+_ll_classes = []
+_rr_classes = []
+_word_break_table = b''
 
 _G_Any                   = 0
 _G_CR                    = 1
@@ -85,6 +98,39 @@ _word_props_map = {
 }
 
 
+class PropertyTable:
+	"""
+	Two-stage lookup of a property for every codepoint: stage1 gives the block of BLOCK_SIZE
+	codepoints holding a codepoint, stage2 holds the values of each distinct block once
+	(most blocks are all 0, or repeat another).
+	"""
+	def __init__(self, values, typecode):
+		self.stage1 = array('H')
+		self.stage2 = array(typecode)
+		blocks = {}
+		for start in range(0, MAX_CODEPOINT, BLOCK_SIZE):
+			block = values[start:start + BLOCK_SIZE]
+			key = block.tobytes()
+			if key not in blocks:
+				blocks[key] = len(blocks)
+				self.stage2.extend(block)
+			self.stage1.append(blocks[key])
+	
+	
+	def get(self, cp):
+		if cp < MAX_CODEPOINT:
+			return self.stage2[(self.stage1[cp >> BLOCK_BITS] << BLOCK_BITS) | (cp & BLOCK_MASK)]
+		return 0
+	
+	
+	def block(self, n):
+		return self.stage2[n << BLOCK_BITS:(n + 1) << BLOCK_BITS]
+	
+	
+	def nbytes(self):
+		return len(self.stage1) * self.stage1.itemsize + len(self.stage2) * self.stage2.itemsize
+
+
 def get_codepoints(string):
 	"""Convert a Unicode string into a list of codepoints."""
 	return codepoints.from_unicode(string)
@@ -96,9 +142,10 @@ def get_unicode(cplist):
 
 	
 def is_grapheme_break(lcp, rcp):
-	lprop = get_grapheme_property(lcp)
-	rprop = get_grapheme_property(rcp)
-	
+	return _is_grapheme_break(get_grapheme_property(lcp), get_grapheme_property(rcp))
+
+
+def _is_grapheme_break(lprop, rprop):
 	# only non breaks should be included here (to make sure we don't break on graphemes after testing word breaks)
 	
 	# line feeds
@@ -129,17 +176,15 @@ def is_grapheme_break(lcp, rcp):
 
 
 def get_grapheme_property(cp):
-	if cp in _grapheme_props:
-		return _grapheme_props[cp]
-	return _W_Any
+	return _grapheme_props.get(cp)
 	
 	
 def is_word_break(llcp, lcp, rcp, rrcp):
-	llprop = get_word_property(llcp)
-	lprop = get_word_property(lcp)
-	rprop = get_word_property(rcp)
-	rrprop = get_word_property(rrcp)
-	
+	return _is_word_break(get_word_property(llcp), get_word_property(lcp), get_word_property(rcp), get_word_property(rrcp),
+		get_grapheme_property(lcp), get_grapheme_property(rcp))
+
+
+def _is_word_break(llprop, lprop, rprop, rrprop, lgprop, rgprop):
 	# line feeds and new lines
 	if lprop & (_W_CR) and rprop & (_W_LF):
 		return False
@@ -206,14 +251,12 @@ def is_word_break(llcp, lcp, rcp, rrcp):
 	if lprop & (_W_Regional_Indicator) and rprop & (_W_Regional_Indicator):
 		return False
 	
-	return is_grapheme_break(lcp, rcp)
+	return _is_grapheme_break(lgprop, rgprop)
 	
 	
 
 def get_word_property(cp):
-	if cp in _word_props:
-		return _word_props[cp]
-	return _W_Any
+	return _word_props.get(cp)
 	
 
 	
@@ -226,165 +269,118 @@ def load_properties():
 	try:
 		load_grapheme_props()
 		load_word_props()
-		load_emoji_data_props()
 	except Exception as e:
 		print(e)
 		return False
 	
-	logging.info('{} grapheme properties loaded'.format(len(_grapheme_props)))
-	logging.info('{} word properties loaded'.format(len(_word_props)))
+	logging.info('{} byte grapheme property table loaded'.format(_grapheme_props.nbytes()))
+	logging.info('{} byte word property table loaded'.format(_word_props.nbytes()))
 	
+	build_word_break_table()
+	logging.info('{} byte word break table built'.format(len(_word_break_table)))
 	
 	_props_loaded = True
 	return True
 
 
+# the only word properties is_word_break tests either side of the pair of codepoints it breaks between
+_LL_MASK = _W_Extend | _W_ALetter | _W_Hebrew_Letter | _W_Numeric
+_RR_MASK = _W_ALetter | _W_Hebrew_Letter | _W_Numeric
+
+
+def build_word_break_table():
+	"""
+	Compile is_word_break into a table over codepoint classes, so tokenise does one lookup per codepoint.
+	A class is a combination of word and grapheme properties (class 0 has neither);
+	the codepoints either side of the pair are reduced to the properties the rules test.
+	The table has a byte for each (ll, l, r, rr) class combination, 1 for a break.
+	"""
+	global _classes, _class_props, _ll_classes, _rr_classes, _word_break_table
+	
+	# classes are also a property table, built a block at a time
+	class_ids = { (_W_Any, _G_Any): 0 }
+	class_blocks = {}
+	values = array('B', bytes(MAX_CODEPOINT))
+	for n in range(MAX_CODEPOINT >> BLOCK_BITS):
+		blocks = (_word_props.stage1[n], _grapheme_props.stage1[n])
+		if blocks not in class_blocks:
+			block = array('B')
+			for props in zip(_word_props.block(blocks[0]), _grapheme_props.block(blocks[1])):
+				if props not in class_ids:
+					class_ids[props] = len(class_ids)
+				block.append(class_ids[props])
+			class_blocks[blocks] = block
+		values[n << BLOCK_BITS:(n + 1) << BLOCK_BITS] = class_blocks[blocks]
+	_classes = PropertyTable(values, 'B')
+	_class_props = sorted(class_ids, key=class_ids.get)
+	
+	ll_props = sorted(set(word & _LL_MASK for word, grapheme in _class_props))
+	rr_props = sorted(set(word & _RR_MASK for word, grapheme in _class_props))
+	_ll_classes = [ ll_props.index(word & _LL_MASK) for word, grapheme in _class_props ]
+	_rr_classes = [ rr_props.index(word & _RR_MASK) for word, grapheme in _class_props ]
+	
+	table = bytearray()
+	for llprop in ll_props:
+		for lprop, lgprop in _class_props:
+			for rprop, rgprop in _class_props:
+				for rrprop in rr_props:
+					table.append(1 if _is_word_break(llprop, lprop, rprop, rrprop, lgprop, rgprop) else 0)
+	_word_break_table = bytes(table)
+
+
+def get_word_break_table():
+	"""(table, classes, rr classes, ll class of each class, rr class of each class), as used by tokenise."""
+	return _word_break_table, len(_class_props), len(set(_rr_classes)), _ll_classes, _rr_classes
+
+
+def get_classes(cplist):
+	"""Word break table class of each codepoint."""
+	stage1 = _classes.stage1
+	stage2 = _classes.stage2
+	return [ stage2[(stage1[cp >> BLOCK_BITS] << BLOCK_BITS) | (cp & BLOCK_MASK)] if cp < MAX_CODEPOINT else 0 for cp in cplist ]
+
+
 def load_grapheme_props():
 	global _grapheme_props
 	
-	_grapheme_props = {}
-	
-	props_comment_pat = re.compile(r'#.*')
-	props_entry_pat = re.compile(r'^\s*([0-9A-F]+)(?:\.+([0-9A-F]+))?\s*;\s*(\w+)')
-	
-	with open(os.path.join(os.path.dirname(__file__), 'GraphemeBreakProperty.txt'), 'r', encoding='utf-8') as f:
-		for line in f:
-			#print(line.strip())
-			line = props_comment_pat.sub('', line).strip()
-			#print('>> ' + line)
-			if line:
-				m = props_entry_pat.search(line)
-				if m:
-					#print('**** {} .. {} = {}'.format(m.group(1), m.group(2), m.group(3)))
-					
-					prop = 0
-					if m.group(3) in _grapheme_props_map:
-						prop = _grapheme_props_map[m.group(3)]
-					else:
-						print('!!!!!! {}'.format(line))
-						continue
-					
-					#if m.group(3) not in prop_types:
-						#prop_types[m.group(3)] = True
-					
-					if m.group(2):
-						start = int(m.group(1), 16)
-						end = int(m.group(2), 16)
-						for cp in range(start, end + 1):
-							if cp in _grapheme_props:
-								#print('~~~~~~ {} | {} = {} | {}'.format(hex(cp), cp, prop, _grapheme_props[cp]))
-								_grapheme_props[cp] = _grapheme_props[cp] | prop
-							else:
-								#print('++++++ {} | {} = {}'.format(hex(cp), cp, prop))
-								_grapheme_props[cp] = prop
-					else:
-						cp = int(m.group(1), 16)
-						if cp in _grapheme_props:
-							#print('~~~~~~ {} | {} = {} | {}'.format(hex(cp), cp, prop, _grapheme_props[cp]))
-							_grapheme_props[cp] = _grapheme_props[cp] | prop
-						else:
-							#print('++++++ {} | {} = {}'.format(hex(cp), cp, prop))
-							_grapheme_props[cp] = prop
-				else:
-					print('!!!! {}'.format(line))
+	values = array('H', bytes(MAX_CODEPOINT * 2))
+	read_props(values, 'GraphemeBreakProperty.txt', _grapheme_props_map)
+	_grapheme_props = PropertyTable(values, 'H')
 	
 	
 def load_word_props():
 	global _word_props
 	
-	_word_props = {}
-	
+	# Extended_Pictographic is only read from emoji-data.txt
+	values = array('I', bytes(MAX_CODEPOINT * array('I').itemsize))
+	read_props(values, 'WordBreakProperty.txt', _word_props_map)
+	read_props(values, 'emoji-data.txt', _word_props_map, only='Extended_Pictographic')
+	_word_props = PropertyTable(values, 'I')
+
+
+def read_props(values, filename, props_map, only=None):
+	"""Combine the properties of each codepoint listed in a Unicode data file into values."""
 	props_comment_pat = re.compile(r'#.*')
 	props_entry_pat = re.compile(r'^\s*([0-9A-F]+)(?:\.+([0-9A-F]+))?\s*;\s*(\w+)')
 	
-	with open(os.path.join(os.path.dirname(__file__), 'WordBreakProperty.txt'), 'r', encoding='utf-8') as f:
+	with open(os.path.join(os.path.dirname(__file__), filename), 'r', encoding='utf-8') as f:
 		for line in f:
-			#print(line.strip())
 			line = props_comment_pat.sub('', line).strip()
-			#print('>> ' + line)
 			if line:
 				m = props_entry_pat.search(line)
 				if m:
-					#print('**** {} .. {} = {}'.format(m.group(1), m.group(2), m.group(3)))
+					if only is not None and m.group(3) != only:
+						continue
 					
-					prop = 0
-					if m.group(3) in _word_props_map:
-						prop = _word_props_map[m.group(3)]
+					if m.group(3) in props_map:
+						prop = props_map[m.group(3)]
 					else:
 						print('!!!!!! {}'.format(line))
 						continue
 					
-					#if m.group(3) not in prop_types:
-						#prop_types[m.group(3)] = True
-					
-					if m.group(2):
-						start = int(m.group(1), 16)
-						end = int(m.group(2), 16)
-						for cp in range(start, end + 1):
-							if cp in _word_props:
-								#print('~~~~~~ {} | {} = {} | {}'.format(hex(cp), cp, prop, _word_props[cp]))
-								_word_props[cp] = _word_props[cp] | prop
-							else:
-								#print('++++++ {} | {} = {}'.format(hex(cp), cp, prop))
-								_word_props[cp] = prop
-					else:
-						cp = int(m.group(1), 16)
-						if cp in _word_props:
-							#print('~~~~~~ {} | {} = {} | {}'.format(hex(cp), cp, prop, _word_props[cp]))
-							_word_props[cp] = _word_props[cp] | prop
-						else:
-							#print('++++++ {} | {} = {}'.format(hex(cp), cp, prop))
-							_word_props[cp] = prop
+					start = int(m.group(1), 16)
+					end = int(m.group(2), 16) if m.group(2) else start
+					for cp in range(start, end + 1):
+						values[cp] |= prop
 				else:
 					print('!!!! {}'.format(line))
-
-	
-def load_emoji_data_props():
-	global _word_props
-	
-	props_comment_pat = re.compile(r'#.*')
-	props_entry_pat = re.compile(r'^\s*([0-9A-F]+)(?:\.+([0-9A-F]+))?\s*;\s*(\w+)')
-	
-	with open(os.path.join(os.path.dirname(__file__), 'emoji-data.txt'), 'r', encoding='utf-8') as f:
-		for line in f:
-			#print(line.strip())
-			line = props_comment_pat.sub('', line).strip()
-			#print('>> ' + line)
-			if line:
-				m = props_entry_pat.search(line)
-				if m:
-					#print('**** {} .. {} = {}'.format(m.group(1), m.group(2), m.group(3)))
-					
-					if m.group(3) == 'Extended_Pictographic':
-						prop = 0
-						if m.group(3) in _word_props_map:
-							prop = _word_props_map[m.group(3)]
-						else:
-							print('!!!!!! {}'.format(line))
-							continue
-						
-						#if m.group(3) not in prop_types:
-							#prop_types[m.group(3)] = True
-						
-						if m.group(2):
-							start = int(m.group(1), 16)
-							end = int(m.group(2), 16)
-							for cp in range(start, end + 1):
-								if cp in _word_props:
-									#print('~~~~~~ {} | {} = {} | {}'.format(hex(cp), cp, prop, _word_props[cp]))
-									_word_props[cp] = _word_props[cp] | prop
-								else:
-									#print('++++++ {} | {} = {}'.format(hex(cp), cp, prop))
-									_word_props[cp] = prop
-						else:
-							cp = int(m.group(1), 16)
-							if cp in _word_props:
-								#print('~~~~~~ {} | {} = {} | {}'.format(hex(cp), cp, prop, _word_props[cp]))
-								_word_props[cp] = _word_props[cp] | prop
-							else:
-								#print('++++++ {} | {} = {}'.format(hex(cp), cp, prop))
-								_word_props[cp] = prop
-				else:
-					print('!!!! {}'.format(line))
-
-	
\ No newline at end of file
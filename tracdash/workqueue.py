@@ -0,0 +1,264 @@
+"""
+Shared work queue so several importer processes, on one or more hosts, can import one set of files.
+
+The queue is a SQLite database on storage all hosts can reach.
+Files are claimed with a lease that the claiming worker renews with heartbeats while it runs;
+work whose lease has expired (e.g. the host died) is claimed again by another worker,
+up to MAX_ATTEMPTS times. Every coordinator keeps running until all files are finished,
+then logs the same aggregated completion report.
+Note SQLite relies on file locking, which must work on the shared filesystem (e.g. NFS with locking enabled).
+"""
+
+import os, time, socket, sqlite3, logging, threading
+import multiprocessing
+from datetime import timedelta
+
+from . import importer
+from .profiler import merge_profiles
+from .frequencies import merge_frequency_tables
+
+
+
+LEASE_TIME = 10 * 60			# seconds a claim is held without a heartbeat
+HEARTBEAT_INTERVAL = 60			# seconds between lease renewals while a file is processed
+POLL_INTERVAL = 30				# seconds between checks for reclaimable work while other workers finish
+MAX_ATTEMPTS = 3				# claims of a file before it is left as failed
+DB_TIMEOUT = 60					# seconds to wait for the database lock
+
+_queue_path = None
+_lease_time = LEASE_TIME
+
+
+
+class WorkQueue:
+	"""Durable queue of files to import, with leases, shared through a SQLite database."""
+	def __init__(self, path, lease_time=LEASE_TIME):
+		self.path = path
+		self.lease_time = lease_time
+		self.db = None
+		self.pid = None
+
+
+	def connection(self):
+		# sqlite connections must not be shared with forked workers
+		if self.db is None or self.pid != os.getpid():
+			self.db = sqlite3.connect(self.path, timeout=DB_TIMEOUT, isolation_level=None)
+			self.pid = os.getpid()
+			self.db.execute("""
+				CREATE TABLE IF NOT EXISTS work (
+					file TEXT PRIMARY KEY,
+					state TEXT NOT NULL DEFAULT 'pending',
+					owner TEXT,
+					lease_expires REAL,
+					attempts INTEGER NOT NULL DEFAULT 0,
+					started REAL,
+					finished REAL
+				)""")
+		return self.db
+
+
+	def close(self):
+		if self.db is not None and self.pid == os.getpid():
+			self.db.close()
+		self.db = None
+
+
+	def add(self, files):
+		"""Queue files, ignoring any already queued (so each coordinator can be given the same list)."""
+		db = self.connection()
+		db.execute("BEGIN IMMEDIATE")
+		try:
+			added = 0
+			for file in files:
+				added += db.execute("INSERT OR IGNORE INTO work (file) VALUES (?)", (file,)).rowcount
+			db.execute("COMMIT")
+		except:
+			db.execute("ROLLBACK")
+			raise
+		return added
+
+
+	def claim(self, owner):
+		"""Claim the next pending file, or one whose lease has expired; None if nothing is claimable."""
+		db = self.connection()
+		now = time.time()
+		db.execute("BEGIN IMMEDIATE")
+		try:
+			row = db.execute("""
+				SELECT file, state, owner FROM work
+				WHERE (state = 'pending' OR (state = 'claimed' AND lease_expires < ?)) AND attempts < ?
+				ORDER BY state = 'claimed', rowid LIMIT 1""", (now, MAX_ATTEMPTS)).fetchone()
+			if row is not None:
+				db.execute("""
+					UPDATE work SET state = 'claimed', owner = ?, lease_expires = ?, attempts = attempts + 1, started = ?
+					WHERE file = ?""", (owner, now + self.lease_time, now, row[0]))
+			# abandoned work that has used up its attempts is given up
+			db.execute("""
+				UPDATE work SET state = 'failed', finished = ?
+				WHERE state = 'claimed' AND lease_expires < ? AND attempts >= ?""", (now, now, MAX_ATTEMPTS))
+			db.execute("COMMIT")
+		except:
+			db.execute("ROLLBACK")
+			raise
+
+		if row is None:
+			return None
+		if row[1] == 'claimed':
+			logging.warning("reclaimed abandoned work\t{}\t{}".format(row[0], row[2]))
+		return row[0]
+
+
+	def heartbeat(self, owner, file):
+		"""Renew the lease on file, returning False if it has been lost to another worker."""
+		db = self.connection()
+		cur = db.execute("""
+			UPDATE work SET lease_expires = ?
+			WHERE file = ? AND owner = ? AND state = 'claimed'""", (time.time() + self.lease_time, file, owner))
+		return cur.rowcount > 0
+
+
+	def finish(self, owner, file, success):
+		db = self.connection()
+		db.execute("""
+			UPDATE work SET state = ?, finished = ?, lease_expires = NULL
+			WHERE file = ? AND owner = ?""", ('done' if success else 'failed', time.time(), file, owner))
+
+
+	def unfinished(self):
+		db = self.connection()
+		return db.execute("SELECT COUNT(*) FROM work WHERE state IN ('pending', 'claimed')").fetchone()[0]
+
+
+	def report(self):
+		"""Aggregated completion report across all workers and hosts."""
+		db = self.connection()
+		lines = []
+
+		states = dict(db.execute("SELECT state, COUNT(*) FROM work GROUP BY state").fetchall())
+		lines.append("queue\t{}\t{}".format(self.path, "\t".join("{} {}".format(state, states.get(state, 0)) for state in ['done', 'failed', 'claimed', 'pending'])))
+
+		start, end = db.execute("SELECT MIN(started), MAX(finished) FROM work").fetchone()
+		if start is not None and end is not None:
+			lines.append("elapsed\t{}".format(timedelta(seconds=int(end - start))))
+
+		for host, files, seconds in db.execute("""
+				SELECT substr(owner, 1, instr(owner, ':') - 1) AS host, COUNT(*), SUM(finished - started)
+				FROM work WHERE state = 'done' GROUP BY host ORDER BY host"""):
+			lines.append("host\t{}\t{} files\t{:.1f}s".format(host, files, seconds or 0.0))
+
+		for file, owner, attempts in db.execute("SELECT file, owner, attempts FROM work WHERE state = 'failed' ORDER BY rowid"):
+			lines.append("! {}\t{}\t{} attempts".format(file, owner, attempts))
+
+		return "\n".join(lines)
+
+
+
+def import_queue(queue_path, es_ips, index_name, files = None, pool_size = 16, geo_level = 0, bulk_in_flight = 1,
+		es_sniff = False, seek_index = False, index_profile = 'default', lease_time = LEASE_TIME, **options):
+	"""
+	Coordinator mode for import_files: import the files in the shared work queue at queue_path
+	(a SQLite database on storage reachable by every host), with pool_size workers on this host.
+	Run it on each host taking part; files, if given, are added to the queue first
+	(files already queued are ignored, so every host can be given the same list).
+	Workers claim one file at a time and renew their lease every HEARTBEAT_INTERVAL seconds;
+	files whose lease (lease_time seconds) expires are claimed again by another worker.
+	A worker that finds its lease lost stops importing the file and drops its bulk requests still in flight.
+	Once every file is done or failed, the aggregated report for all hosts is logged.
+	Other options are as for import_files (error_policy, sample_modulo, cache sizes, geo_batch, gazetteer, ...),
+	except auto_tune, batch_lines and progress reporting, which need every file in one coordinator.
+	"""
+	global _queue_path, _lease_time
+
+	unsupported = [ option for option in ['auto_tune', 'batch_lines', 'batch_ordered', 'progress_interval', 'status_file'] if options.get(option) ]
+	if unsupported:
+		raise ValueError("not supported by import_queue: {}".format(", ".join(unsupported)))
+	for option in ['auto_tune', 'progress_interval', 'status_file']:
+		options.pop(option, None)
+
+	importer._configure(es_ips, index_name, pool_size = pool_size, geo_level = geo_level, bulk_in_flight = bulk_in_flight,
+		es_sniff = es_sniff, seek_index = seek_index, index_profile = index_profile, **options)
+	importer._progress_queue = None
+
+	_queue_path = queue_path
+	_lease_time = lease_time
+
+	queue = WorkQueue(queue_path, lease_time)
+	if files:
+		logging.info("queued files\t{}\t{} new of {}".format(queue_path, queue.add(files), len(files)))
+
+	logging.info("creating index")
+	importer._create_index()
+	logging.info("index created")
+
+	logging.info("starting queue import\t{}\t{}".format(queue_path, socket.gethostname()))
+
+	with multiprocessing.get_context('fork').Pool(pool_size, initializer=importer._init_worker) as pool:
+		result = pool.map(_queue_worker, range(pool_size))
+		pool.close()
+		pool.join()
+
+	if importer._profile_run is not None:
+		merge_profiles(importer._profile_run)
+
+	# rebuilt from every file's partial tables so far, so whichever coordinator finishes last has the totals
+	if importer._frequency_dir is not None:
+		merge_frequency_tables(importer._frequency_dir)
+
+	logging.info("queue import finished\t{}\n{}".format( socket.gethostname(), "\n".join(r for r in result if r) ))
+	logging.info("queue report\n{}".format( queue.report() ))
+	queue.close()
+
+
+
+def _queue_worker(worker_id):
+	owner = "{}:{}".format(socket.gethostname(), os.getpid())
+	queue = WorkQueue(_queue_path, _lease_time)
+	result = []
+
+	while True:
+		file = queue.claim(owner)
+		if file is None:
+			# nothing claimable; wait in case work held by other workers is abandoned
+			if queue.unfinished() == 0:
+				break
+			time.sleep(POLL_INTERVAL)
+			continue
+
+		stop = threading.Event()
+		lost = threading.Event()
+		heartbeat = threading.Thread(target=_heartbeat, args=(owner, file, stop, lost), daemon=True)
+		heartbeat.start()
+		importer._cancel_file = lost
+		try:
+			status = importer._process_file(file)
+		finally:
+			importer._cancel_file = None
+			stop.set()
+			heartbeat.join()
+
+		# the file is now another worker's to finish
+		if lost.is_set():
+			status = "! {}\tlease lost".format(file)
+		else:
+			queue.finish(owner, file, status.startswith("+"))
+		result.append(status)
+
+	queue.close()
+	return "\n".join(result)
+
+
+
+def _heartbeat(owner, file, stop, lost):
+	# own connection, sqlite connections can't be shared between threads
+	queue = WorkQueue(_queue_path, _lease_time)
+	try:
+		while not stop.wait(HEARTBEAT_INTERVAL):
+			try:
+				if not queue.heartbeat(owner, file):
+					logging.warning("lease lost\t{}\t{}".format(file, owner))
+					lost.set()
+					return
+			except:
+				logging.exception("heartbeat error\t{}\t{}".format(file, owner))
+	finally:
+		queue.close()